@@ -0,0 +1,49 @@
+# Gunicorn configuration, used by the Procfile:
+# python microblog/manage.py run_gunicorn -c microblog/gunicorn_conf.py
+#
+# GUNICORN_WORKER_CLASS=gevent runs green thread workers, each one serving up to
+# GUNICORN_WORKER_CONNECTIONS concurrent requests, so a request waiting on SMTP, the
+# database or a slow client doesn't hold a whole process.
+#
+# With GUNICORN_PRELOAD=1 (the default for sync workers) the app is loaded and warmed up
+# once in the master (see microblog.startup), and workers are forked with it loaded, so
+# scaling out and replacing workers doesn't import anything. Code changes then need a
+# restart of the master, a HUP only replaces the workers.
+import os
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+
+green = worker_class in ('gevent', 'egg:gunicorn#gevent')
+
+# Green workers monkey patch the standard library after forking, too late for the modules
+# a preloaded app has already imported.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0' if green else '1') == '1'
+
+# Green threads get their own database connection each, so they must share a pool.
+GREEN_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 0)) or 10
+
+
+def when_ready(server):
+    if preload_app:
+        from microblog.startup import warm_up
+        warm_up(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    # Persistent connections must never be shared between processes, drop anything
+    # opened in the master before forking so each worker opens its own.
+    from django.conf import settings
+    from django.db import connections
+    from microblog.postgresql_persistent.base import reset_pools
+    for conn in connections.all():
+        conn.connection = None
+    reset_pools()
+
+    if green:
+        from microblog.green import make_psycopg_green
+        make_psycopg_green()
+        for alias in settings.DATABASES:
+            settings.DATABASES[alias]['POOL_SIZE'] = GREEN_POOL_SIZE
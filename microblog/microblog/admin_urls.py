@@ -0,0 +1,10 @@
+"""
+URLs of the admin, included lazily by microblog.urls: the admin module of every app is only
+imported (and the admin site built) by the first request to /admin/, not by every worker
+and management command at startup.
+"""
+from django.contrib import admin
+
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
@@ -0,0 +1,32 @@
+"""
+Support for running the app with green thread (gevent) gunicorn workers.
+
+The gevent worker monkey patches the standard library, so sockets used for SMTP and
+HTTP yield cooperatively. psycopg2 talks to the database through libpq instead, which
+blocks the whole process unless a wait callback is installed, that's what
+make_psycopg_green does.
+"""
+
+
+def make_psycopg_green():
+    """
+    Configures psycopg2 to yield to other greenlets while waiting on the database.
+    """
+    from psycopg2 import extensions
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def gevent_wait_callback(conn, timeout=None):
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError('Bad result from poll: %r' % state)
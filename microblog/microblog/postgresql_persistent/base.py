@@ -0,0 +1,134 @@
+"""
+PostgreSQL backend that keeps connections open across requests.
+
+Django 1.4 opens a new connection for every request and closes it when the request
+finishes. This backend keeps the connection of each worker open for up to
+``CONN_MAX_AGE`` seconds, or hands it back to a process wide pool shared by threads
+(or green threads) when ``POOL_SIZE`` is set. Reused connections are health checked
+before use, so a connection dropped by the server is replaced transparently.
+
+Extra keys read from the database settings:
+- CONN_MAX_AGE: seconds a connection may be reused, 0 closes it after every request (stock behaviour).
+- POOL_SIZE: when bigger than 0, connections are shared through a pool of that size.
+- POOL_TIMEOUT: seconds to wait for a pooled connection, defaults to 30.
+"""
+import threading
+import time
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.backends.postgresql_psycopg2 import base
+from django.db.backends.postgresql_psycopg2.base import *
+from microblog.postgresql_persistent.pool import ConnectionPool
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def reset_pools():
+    """
+    Forgets every pool without closing its connections, to be called in forked
+    children so they don't share sockets inherited from the parent process.
+    """
+    with _pools_lock:
+        _pools.clear()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.conn_max_age = self.settings_dict.get('CONN_MAX_AGE', 0)
+        self.pool_size = self.settings_dict.get('POOL_SIZE', 0)
+        self.pool_timeout = self.settings_dict.get('POOL_TIMEOUT', 30)
+        self._opened_at = None
+        self._needs_health_check = False
+
+    def get_pool(self):
+        with _pools_lock:
+            pool = _pools.get(self.alias)
+            if pool is None:
+                pool = ConnectionPool(self._connect, self.pool_size,
+                                      timeout=self.pool_timeout, max_age=self.conn_max_age)
+                _pools[self.alias] = pool
+            return pool
+
+    def _connect(self):
+        """
+        Opens and sets up a raw connection, like the stock _cursor does.
+        """
+        settings_dict = self.settings_dict
+        conn_params = {
+            'database': settings_dict['NAME'],
+        }
+        conn_params.update(settings_dict['OPTIONS'])
+        conn_params.pop('autocommit', None)
+        for key, param in (('USER', 'user'), ('PASSWORD', 'password'), ('HOST', 'host'), ('PORT', 'port')):
+            if settings_dict[key]:
+                conn_params[param] = settings_dict[key]
+        conn = Database.connect(**conn_params)
+        conn.set_client_encoding('UTF8')
+        tz = 'UTC' if settings.USE_TZ else settings_dict.get('TIME_ZONE')
+        if tz and conn.get_parameter_status('TimeZone') != tz:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(self.ops.set_time_zone_sql(), [tz])
+        conn.set_isolation_level(self.isolation_level)
+        return conn
+
+    def is_usable(self):
+        if self.connection is None or self.connection.closed:
+            return False
+        try:
+            self.connection.cursor().execute('SELECT 1')
+        except Database.Error:
+            return False
+        return True
+
+    def _cursor(self):
+        if self.connection is not None and self._needs_health_check:
+            self._needs_health_check = False
+            if not self.is_usable():
+                self._drop_connection()
+        if self.connection is None and self.pool_size:
+            pool = self.get_pool()
+            while self.connection is None:
+                self.connection, is_new = pool.get()
+                if is_new:
+                    self._get_pg_version()
+                    connection_created.send(sender=self.__class__, connection=self)
+                elif not self.is_usable():
+                    pool.discard(self.connection)
+                    self.connection = None
+        if self.connection is None:
+            self._opened_at = time.time()
+        return super(DatabaseWrapper, self)._cursor()
+
+    def _drop_connection(self):
+        if self.pool_size:
+            self.get_pool().discard(self.connection)
+            self.connection = None
+        else:
+            super(DatabaseWrapper, self).close()
+        self._opened_at = None
+
+    def close(self):
+        """
+        Called by Django when every request finishes. Ends the open transaction and
+        keeps the connection around unless it's too old or broken.
+        """
+        self.validate_thread_sharing()
+        if self.connection is None:
+            return
+        if not self.pool_size and (not self.conn_max_age or time.time() - (self._opened_at or 0) > self.conn_max_age):
+            self._drop_connection()
+            return
+        try:
+            self.connection.rollback()
+        except Database.Error:
+            self._drop_connection()
+            return
+        if self.pool_size:
+            self.get_pool().put(self.connection)
+            self.connection = None
+        else:
+            self._needs_health_check = True
@@ -0,0 +1,91 @@
+import threading
+import time
+from Queue import LifoQueue, Empty, Full
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A small thread safe pool of raw DB-API connections.
+
+    Connections are created lazily with the given ``connect`` callable, up to ``size``
+    connections. Callers asking for a connection when all of them are checked out wait
+    up to ``timeout`` seconds before PoolExhausted is raised.
+    Connections older than ``max_age`` seconds (0 means no limit) are closed when they
+    are returned to the pool instead of being kept around.
+    """
+
+    def __init__(self, connect, size, timeout=30, max_age=0):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        # LIFO so the most recently used (warmest) connections get reused first.
+        self._idle = LifoQueue(maxsize=size)
+        self._created = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        with self._lock:
+            if len(self._created) + self._pending >= self.size:
+                return None
+            # Reserve the slot before connecting, so concurrent callers don't go over size.
+            self._pending += 1
+        try:
+            conn = self.connect()
+            with self._lock:
+                self._created[id(conn)] = time.time()
+        finally:
+            with self._lock:
+                self._pending -= 1
+        return conn
+
+    def age(self, conn):
+        created = self._created.get(id(conn))
+        return 0 if created is None else time.time() - created
+
+    def get(self):
+        """
+        Returns a ``(connection, is_new)`` tuple, ``is_new`` is True for connections that
+        were just opened and still need session setup.
+        """
+        try:
+            return self._idle.get_nowait(), False
+        except Empty:
+            pass
+        conn = self._new_connection()
+        if conn is not None:
+            return conn, True
+        try:
+            return self._idle.get(timeout=self.timeout), False
+        except Empty:
+            raise PoolExhausted('No database connection available after %s seconds' % self.timeout)
+
+    def put(self, conn):
+        if self.max_age and self.age(conn) > self.max_age:
+            self.discard(conn)
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            self.discard(conn)
+
+    def discard(self, conn):
+        with self._lock:
+            self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            self.discard(conn)
@@ -1,5 +1,7 @@
 # Django settings for microblog project.
 
+import os
+import sys
 import dj_database_url
 
 
@@ -14,9 +16,64 @@ MANAGERS = ADMINS
 
 # Parse database configuration from $DATABASE_URL
 DATABASES = {'default': dj_database_url.config()}
+# Keep PostgreSQL connections open across requests, see microblog.postgresql_persistent.
+# DATABASE_CONN_MAX_AGE is the max age in seconds of a connection (0 closes it after each request),
+# DATABASE_POOL_SIZE enables a pool shared by the threads of a worker when bigger than 0.
+if DATABASES['default'].get('ENGINE') == 'django.db.backends.postgresql_psycopg2':
+    DATABASES['default']['ENGINE'] = 'microblog.postgresql_persistent'
+DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DATABASE_CONN_MAX_AGE', 600))
+DATABASES['default']['POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 0))
+# Databases the posts are sharded over by user id (see microblog_app.sharding), set
+# SHARD_DATABASE_URLS to a comma separated list of database URLs, named shard0, shard1, etc.
+# Without it everything is kept in the default database.
+SHARDS = []
+for i, shard_url in enumerate(filter(None, os.environ.get('SHARD_DATABASE_URLS', '').split(','))):
+    shard = dj_database_url.parse(shard_url)
+    if shard.get('ENGINE') == 'django.db.backends.postgresql_psycopg2':
+        shard['ENGINE'] = 'microblog.postgresql_persistent'
+    shard['CONN_MAX_AGE'] = DATABASES['default']['CONN_MAX_AGE']
+    shard['POOL_SIZE'] = DATABASES['default']['POOL_SIZE']
+    DATABASES['shard%i' % i] = shard
+    SHARDS.append('shard%i' % i)
+DATABASE_ROUTERS = ['microblog_app.sharding.ShardRouter']
 # To drop database use:
 # python manage.py sqlclear microblog_app | python manage.py dbshell 
 
+# Cache shared by all the gunicorn workers (used for API throttling), set MEMCACHE_SERVERS to a
+# comma separated list of memcached servers. Falls back to a per process cache.
+if os.environ.get('MEMCACHE_SERVERS'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHE_SERVERS'].split(','),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Memory mapped file caching hot users and posts, shared by the gunicorn workers of a host
+# (see microblog_app.shared_cache), set SHARED_CACHE_PATH to enable it, e.g. to a file in
+# /dev/shm. Its versions, slots, bytes per slot and seconds entries are kept.
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', '')
+SHARED_CACHE_VERSIONS = 65536
+SHARED_CACHE_SLOTS = 65536
+SHARED_CACHE_SLOT_SIZE = 1024
+SHARED_CACHE_TIMEOUT = 300
+
+# Identical searches and follower pages running at once share one read (see
+# microblog_app.coalesce), across workers when memcached is used. Seconds a request
+# waits for another one's read, seconds its result is kept for the other workers, and seconds
+# between checks for it.
+COALESCE_ENABLED = True
+COALESCE_SHARED = bool(os.environ.get('MEMCACHE_SERVERS'))
+COALESCE_TIMEOUT = 5
+COALESCE_RESULT_TIMEOUT = 2
+COALESCE_POLL_INTERVAL = 0.05
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -155,6 +212,11 @@ LOGGING = {
 
 HAYSTACK_SITECONF = 'microblog_app.search_sites'
 
+# Importing haystack doesn't import the search site (it walks the stack and imports every
+# search_indexes module), the API imports it on the first Haystack search. The haystack
+# commands need it to find the indexes.
+HAYSTACK_ENABLE_REGISTRATIONS = bool(set(sys.argv[1:2]) & set(['update_index', 'rebuild_index', 'clear_index', 'haystack_info']))
+
 HAYSTACK_SEARCH_ENGINE = 'simple'
 
 HAYSTACK_CONNECTIONS = {
@@ -163,6 +225,74 @@ HAYSTACK_CONNECTIONS = {
     },
 }
 
+# API throttling, max requests per API key (or IP address for anonymous requests) and endpoint
+# in any API_THROTTLE_TIMEFRAME seconds.
+API_THROTTLE_AT = 150
+API_THROTTLE_TIMEFRAME = 60
+
+# Seconds the access tokens issued by the login resource are valid for.
+ACCESS_TOKEN_LIFETIME = 3600
+
+# Posts older than POST_ARCHIVE_AGE_DAYS are moved to the archive tables by the archiveposts
+# command, POST_ARCHIVE_CHUNK_SIZE posts per transaction.
+POST_ARCHIVE_AGE_DAYS = 365
+POST_ARCHIVE_CHUNK_SIZE = 500
+
+# Feed stream: seconds between heartbeats, seconds before a stream is closed (clients
+# reconnect with Last-Event-ID), and seconds between polls for posts created by other workers.
+# Polls and resumed streams read again the posts created FEED_STREAM_LOOKBACK seconds before
+# the last one seen, the ones committed later than that after being created are missed.
+FEED_STREAM_HEARTBEAT = 15
+FEED_STREAM_TIMEOUT = 300
+FEED_STREAM_POLL_INTERVAL = 2
+FEED_STREAM_LOOKBACK = 10
+
+# Feed engine, 'merge' reads each source of the feed separately and merges them, 'query'
+# reads it with a single query (see microblog_app.feed). Followed users past
+# FEED_MERGE_MAX_STREAMS share a single stream.
+FEED_ENGINE = 'merge'
+FEED_MERGE_MAX_STREAMS = 50
+
+# Rows deleted per transaction when purging deleted users and posts (see microblog_app.purge).
+PURGE_CHUNK_SIZE = 500
+
+# Rows rolled up into the daily stats per transaction (see microblog_app.rollups).
+ROLLUP_CHUNK_SIZE = 5000
+
+# Rows created less than this many seconds ago are left for the next rollup, so rows whose
+# transaction is still open aren't skipped.
+ROLLUP_LAG = 300
+
+# Days served by /api/v1/user/<pk>/stats/ when the request has no since date.
+STATS_DEFAULT_DAYS = 30
+
+# Tables with more rows are not counted by the admin changelists, their count is estimated
+# from the PostgreSQL statistics (see microblog_app.paginator.estimate_count).
+ADMIN_EXACT_COUNT_LIMIT = 100000
+
+# Posts indexed per transaction by the backfilltags command (see microblog_app.tags).
+TAGS_BACKFILL_CHUNK_SIZE = 500
+
+# Seconds the dehydrated public fields of a user stay cached (see microblog_app.fragments).
+# Without memcached, changes made by other workers aren't seen until they expire, so they're
+# kept USER_FRAGMENT_LOCAL_TIMEOUT seconds instead.
+USER_FRAGMENT_TIMEOUT = 3600
+USER_FRAGMENT_LOCAL_TIMEOUT = 5
+
+# Ids of sharded tables reserved at a time by each process (see microblog_app.sharding).
+SHARD_ID_BLOCK_SIZE = 100
+
+# Usernames and emails the signup availability filter of each process is sized for, and its
+# false positive rate; seconds between reads of the users created by other processes, and
+# between rebuilds of the whole filter (see microblog_app.availability). Every read goes
+# back AVAILABILITY_REFRESH_LOOKBACK seconds before the newest user read, for the users
+# committed late.
+AVAILABILITY_FILTER_CAPACITY = 100000
+AVAILABILITY_FILTER_ERROR_RATE = 0.01
+AVAILABILITY_REFRESH_INTERVAL = 5
+AVAILABILITY_REFRESH_LOOKBACK = 60
+AVAILABILITY_REBUILD_INTERVAL = 3600
+
 # Email settings
 EMAIL_HOST = 'smtp.mandrillapp.com'
 EMAIL_PORT = 587
@@ -0,0 +1,99 @@
+"""
+Startup of a worker process, measured by the profilestartup command and run once in the
+gunicorn master when the app is preloaded (see gunicorn_conf.py), so the forked workers
+start with everything already loaded.
+
+A worker reads the settings, loads the models of every app, imports the URLconf (which
+imports the API and builds the resources) and loads the middleware. The admin and the
+Haystack search site aren't part of it, they are imported the first time /admin/ (see
+microblog.admin_urls) or a Haystack search is requested.
+
+Run ``python -m microblog.startup`` from the project directory to time a cold startup,
+or ``python -m microblog.startup --profile 25`` for the 25 slowest calls of one.
+"""
+import json
+import sys
+import time
+
+
+def load_settings():
+    from django.conf import settings
+    # Settings are lazy, reading one imports the settings module.
+    settings.INSTALLED_APPS
+
+
+def load_models():
+    from django.db.models.loading import get_models
+    get_models()
+
+
+def load_urlconf():
+    from django.core.urlresolvers import get_resolver
+    # Reversing needs every pattern, this imports the URLconf and compiles them.
+    get_resolver(None).reverse_dict
+
+
+def load_middleware(application=None):
+    if application is None:
+        from django.core.handlers.wsgi import WSGIHandler
+        application = WSGIHandler()
+    # Handlers wrapping another one (static files) have their own middleware too.
+    while application is not None:
+        if getattr(application, '_request_middleware', False) is None:
+            application.load_middleware()
+        application = getattr(application, 'application', None)
+
+
+PHASES = (
+    ('settings', load_settings),
+    ('models', load_models),
+    ('urlconf', load_urlconf),
+    ('middleware', load_middleware),
+)
+
+
+def measure():
+    """
+    Runs the phases in order, returns the seconds each one took.
+    """
+    timings = []
+    for name, phase in PHASES:
+        start = time.time()
+        phase()
+        timings.append((name, time.time() - start))
+    return timings
+
+
+def profile(limit, out=sys.stdout):
+    """
+    Writes the limit calls with the highest cumulative time of a startup to out.
+    """
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.runcall(measure)
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+
+
+def warm_up(application=None):
+    """
+    Loads everything a worker would load before its first request, without connecting to
+    the database. Called in the gunicorn master before forking.
+    """
+    load_settings()
+    load_models()
+    load_urlconf()
+    load_middleware(application)
+
+
+def main(argv):
+    import os
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'microblog.settings')
+    if argv[:1] == ['--profile']:
+        profile(int(argv[1]) if len(argv) > 1 else 25)
+    else:
+        sys.stdout.write(json.dumps(measure()) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
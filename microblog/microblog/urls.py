@@ -1,10 +1,6 @@
 from django.conf.urls import *
 from tastypie.api import Api
 from microblog_app.api import *
-from django.contrib import admin
-
-# Init admin
-admin.autodiscover()
 
 # Init tastypie
 v1_api = Api(api_name='v1')
@@ -13,6 +9,7 @@ v1_api.register(PostResource())
 v1_api.register(FollowResource())
 v1_api.register(LikeResource())
 v1_api.register(ShareResource())
+v1_api.register(NotificationResource())
 v1_api.register(LoginResource())
 v1_api.register(LostPasswordResource())
 
@@ -25,7 +22,9 @@ urlpatterns = patterns('',
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
-    url(r'^admin/', include(admin.site.urls)),
+    # Namespaced, so the admin is imported when /admin/ is requested instead of when the
+    # first URL is reversed, see microblog.admin_urls.
+    url(r'^admin/', include('microblog.admin_urls', namespace='admin', app_name='admin')),
     url(r'^api/', include(v1_api.urls)),
     url(r'^resetpassword/', "microblog_app.views.reset_password"),
     url(r'^updatepassword/', "microblog_app.views.update_password"),
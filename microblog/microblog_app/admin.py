@@ -1,8 +1,68 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from microblog_app.models import Post, User, Follow, Like, Share
+from microblog_app.paginator import EstimatedCountPaginator, estimate_count
 
-admin.site.register(User)
-admin.site.register(Post)
-admin.site.register(Follow)
-admin.site.register(Like)
-admin.site.register(Share)
\ No newline at end of file
+
+class EstimatedCountChangeList(ChangeList):
+    """
+    Changelist that estimates the total number of rows shown next to the filtered count,
+    instead of counting the whole table.
+    """
+
+    def get_results(self, request):
+        # Keeps the base class from counting the whole table, the total is estimated below.
+        root_query_set = self.root_query_set
+        self.root_query_set = root_query_set.none()
+        super(EstimatedCountChangeList, self).get_results(request)
+        self.root_query_set = root_query_set
+        if self.query_set.query.where:
+            self.full_result_count = estimate_count(root_query_set)
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    """
+    Admin for tables with millions of rows: counts are estimated, the rows of the list are
+    read with their foreign keys, and foreign keys are edited as ids instead of selects
+    listing every row.
+    """
+    paginator = EstimatedCountPaginator
+    list_select_related = True
+    list_per_page = 50
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+
+class UserAdmin(ScalableModelAdmin):
+    list_display = ('username', 'email', 'first_name', 'last_name', 'is_active', 'deleted_date')
+    search_fields = ('^username', '=email')
+
+
+class PostAdmin(ScalableModelAdmin):
+    list_display = ('id', 'user', 'text', 'created_date', 'deleted_date')
+    raw_id_fields = ('user', 'in_reply_to')
+    date_hierarchy = 'created_date'
+
+
+class FollowAdmin(ScalableModelAdmin):
+    list_display = ('id', 'follower', 'followee', 'created_date')
+    raw_id_fields = ('follower', 'followee')
+    date_hierarchy = 'created_date'
+
+
+class LikeAdmin(ScalableModelAdmin):
+    list_display = ('id', 'user', 'post', 'created_date')
+    raw_id_fields = ('user', 'post')
+    date_hierarchy = 'created_date'
+
+
+class ShareAdmin(LikeAdmin):
+    pass
+
+
+admin.site.register(User, UserAdmin)
+admin.site.register(Post, PostAdmin)
+admin.site.register(Follow, FollowAdmin)
+admin.site.register(Like, LikeAdmin)
+admin.site.register(Share, ShareAdmin)
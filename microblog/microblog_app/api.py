@@ -1,22 +1,41 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
+import json
 import logging
 import operator
+import time
+from django import forms
 from django.conf.urls import url
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, transaction, close_connection
+from django.http import HttpResponse
 from django.db.models import Q, Count, Sum
 from django.conf import settings
 from django.core.validators import email_re
 from django.core.exceptions import ObjectDoesNotExist
-from tastypie.http import HttpUnauthorized, HttpNotFound
+from django.utils.importlib import import_module
+from tastypie.http import HttpUnauthorized, HttpNotFound, HttpNoContent
+from tastypie.exceptions import BadRequest
 from tastypie.resources import ModelResource, Resource
-from tastypie import fields
+from microblog_app import fields
 from tastypie.authentication import ApiKeyAuthentication, Authentication
 from tastypie.authorization import Authorization
 from tastypie.utils import trailing_slash
 from tastypie.paginator import Paginator
 from tastypie.constants import ALL_WITH_RELATIONS
-from haystack.query import SearchQuerySet, EmptySearchQuerySet
 from microblog_app.models import *
+from microblog_app.tokens import issue_token, verify_token, revoke_tokens, get_lifetime
+from microblog_app import availability
+from microblog_app.coalesce import CoalescedObjects
+from microblog_app import feed
+from microblog_app import fragments
+from microblog_app.paginator import HotColdPaginator, CursorPaginator
+from microblog_app.purge import delete_user, delete_post
+from microblog_app.rollups import get_stats
+from microblog_app.serializers import FastJSONSerializer
+from microblog_app.sharding import ShardedResourceMixin, fan_in, for_user
+from microblog_app.shared_cache import SharedCacheMixin
+from microblog_app.stream import bus as stream_bus, backfill, ensure_poller, parse_cursor
+from microblog_app.throttle import SlidingWindowThrottle, ThrottledResourceMixin
+from microblog_app.uris import CachedUriMixin, cached_reverse
 import microblog_app
 
 
@@ -32,17 +51,22 @@ class MicroblogApiKeyAuthentication(ApiKeyAuthentication):
     - Supports HTTP header authentication, implemented in tastypie head, but not in current stable version 0.9.11.
     - Supports overriding the user identifier key for query parameter authentication, 
     which defaults to 'api_user' instead of username to avoid collision with filters.
-    - Support for 'public methods' (HTTP methods which don't require authentication), defaults to [].
+    - Support for 'public methods' (HTTP methods which don't require authentication), defaults to ().
     - Automatic support for email and username as 'user_identifier', it first checks if the provided 
     'user_identifier' is a valid email address, if it's not it assumes it's an username. 
+    - Support for signed access tokens issued by LoginResource, in the 'Authorization: Token <token>' header
+    or the 'access_token' parameter. API keys are still supported as a fallback.
     """
 
-    public_methods = []
+    public_methods = ()
     user_identifier = 'api_user'
     
-    def __init__(self, user_identifier='api_user', public_methods=[]):
+    def __init__(self, user_identifier='api_user', public_methods=()):
+        # Instances are shared by every request the process serves (concurrently with
+        # threaded or green workers), so only immutable configuration is kept here and
+        # anything request specific goes into the request.
         super(MicroblogApiKeyAuthentication, self).__init__()
-        self.public_methods = public_methods
+        self.public_methods = tuple(public_methods)
         self.user_identifier = user_identifier
 
     def _unauthorized(self):
@@ -51,6 +75,16 @@ class MicroblogApiKeyAuthentication(ApiKeyAuthentication):
     def is_valid_email(self, email):
         return True if email and email_re.match(email) else False
 
+    def extract_token(self, request):
+        """
+        Returns the access token from the 'Authorization: Token <token>' header or the
+        'access_token' parameter, if any.
+        """
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if authorization.lower().startswith('token '):
+            return authorization.split(None, 1)[1].strip()
+        return request.GET.get('access_token') or request.POST.get('access_token')
+
     def extract_credentials(self, request):
         if request.META.get('HTTP_AUTHORIZATION') and request.META['HTTP_AUTHORIZATION'].lower().startswith('apikey '):
             (auth_type, data) = request.META['HTTP_AUTHORIZATION'].split()
@@ -67,6 +101,16 @@ class MicroblogApiKeyAuthentication(ApiKeyAuthentication):
 
         return user_identifier, api_key, user_identifier_type
 
+    def get_identifier(self, request):
+        """
+        Identifies authenticated requestors by their user (each user has a single API key),
+        and anonymous ones by their IP address.
+        """
+        user_id = getattr(getattr(request, 'user', None), 'pk', None)
+        if user_id is not None:
+            return 'user-%s' % user_id
+        return request.META.get('REMOTE_ADDR', 'noaddr')
+
     def get_key(self, user, api_key):
         """
         Attempts to find the API key for the user. Uses ``ApiKey`` by default
@@ -93,6 +137,16 @@ class MicroblogApiKeyAuthentication(ApiKeyAuthentication):
         if request.method in self.public_methods:
             return True
 
+        # check signed access tokens first, they don't need any DB access
+        token = self.extract_token(request)
+        if token:
+            user_id = verify_token(token)
+            if user_id is None:
+                return self._unauthorized()
+            # Only the pk is known, which is all the resources need from the current user.
+            request.user = User(id=user_id, user_ptr_id=user_id)
+            return True
+
         # check authorization parameters
         try:
             user_identifier, api_key, user_identifier_type = self.extract_credentials(request)
@@ -117,8 +171,95 @@ class MicroblogApiKeyAuthentication(ApiKeyAuthentication):
         return self.get_key(user, api_key)
 
 
+class RelatedFieldsMixin(object):
+    """
+    Joins the related objects of ``full`` to one fields into the object list, and prefetches
+    those of ``full`` to many fields, so dehydrating them doesn't cost a query per object.
+    Fields that aren't ``full`` don't need them, their URIs are built from the foreign keys.
+
+    On writes, related objects given by URI are only checked to exist, with one query per
+    related resource, and their foreign keys assigned (see fields.ToOneField.hydrate). They
+    aren't saved with the object, unlike the related objects given as data.
+    """
+
+    def full_hydrate(self, bundle):
+        bundle = super(RelatedFieldsMixin, self).full_hydrate(bundle)
+        model = self._meta.object_class
+        field_names = model._meta.get_all_field_names()
+        hydrated = {}
+        for field in self.fields.values():
+            if not getattr(field, 'is_related', False) or getattr(field, 'is_m2m', False):
+                continue
+            if not isinstance(field.attribute, basestring) or field.attribute not in field_names:
+                continue
+            cache_name = model._meta.get_field(field.attribute).get_cache_name()
+            related_obj = bundle.obj.__dict__.get(cache_name)
+            if getattr(related_obj, '_hydrated_uri', None) is None:
+                continue
+            # Only the foreign key is kept, the related object is loaded if it's ever read.
+            delattr(bundle.obj, cache_name)
+            bundle.uri_fields = getattr(bundle, 'uri_fields', set()) | set([field.attribute])
+            user = getattr(bundle.request, 'user', None)
+            if isinstance(user, type(related_obj)) and user.pk == related_obj.pk:
+                # The authenticated user exists.
+                continue
+            hydrated.setdefault(field.to_class, []).append(related_obj)
+
+        for resource_class, related_objs in hydrated.items():
+            pks = [related_obj.pk for related_obj in related_objs]
+            found = set(row['pk'] for row in resource_class().get_object_list(bundle.request).filter(pk__in=pks).values('pk'))
+            for related_obj in related_objs:
+                if related_obj.pk not in found:
+                    raise fields.ApiFieldError("Could not find the provided object via resource URI '%s'." % related_obj._hydrated_uri)
+        return bundle
+
+    def save_related(self, bundle):
+        """
+        Saves the related objects of the bundle as ModelResource.save_related does, except
+        the ones given by URI: loading and saving them again would overwrite the concurrent
+        changes to them (a deleted post) and reindex them.
+        """
+        uri_fields = getattr(bundle, 'uri_fields', set())
+        for field in self.fields.values():
+            if not getattr(field, 'is_related', False) or getattr(field, 'is_m2m', False):
+                continue
+            if not field.attribute or field.blank or field.attribute in uri_fields:
+                continue
+            try:
+                related_obj = getattr(bundle.obj, field.attribute)
+            except ObjectDoesNotExist:
+                related_obj = None
+            if related_obj:
+                related_obj.save()
+                setattr(bundle.obj, field.attribute, related_obj)
+
+    def get_related_lookups(self):
+        model = self._meta.object_class
+        field_names = model._meta.get_all_field_names()
+        to_one, to_many = [], []
+        for field in self.fields.values():
+            if not getattr(field, 'is_related', False) or not field.full:
+                continue
+            if not isinstance(field.attribute, basestring) or field.attribute not in field_names:
+                continue
+            if isinstance(field, fields.ToManyField):
+                to_many.append(field.attribute)
+            else:
+                to_one.append(field.attribute)
+        return to_one, to_many
+
+    def get_object_list(self, request):
+        object_list = super(RelatedFieldsMixin, self).get_object_list(request)
+        to_one, to_many = self.get_related_lookups()
+        if to_one:
+            object_list = object_list.select_related(*to_one)
+        if to_many:
+            object_list = object_list.prefetch_related(*to_many)
+        return object_list
+
+
 # TODO: Get haystack search working properly and compare with custom search.
-class HaystackSearchableModelResource(ModelResource):
+class HaystackSearchableModelResource(ThrottledResourceMixin, ModelResource):
     """
     Base class for all searchable resources. It creates a custom endpoit at /<resource_name>/search/ 
     and expects the query string to contain a 'q' parameter with the search query.
@@ -138,6 +279,10 @@ class HaystackSearchableModelResource(ModelResource):
         self.is_authenticated(request)
         self.throttle_check(request)
 
+        # Haystack and the search indexes are only loaded when searched, see microblog.startup.
+        from haystack.query import SearchQuerySet
+        import_module(settings.HAYSTACK_SITECONF)
+
         # Do the query.
         sqs = SearchQuerySet().models(self.get_model()).load_all().auto_query(request.GET.get('q', ''))
 
@@ -164,10 +309,12 @@ class HaystackSearchableModelResource(ModelResource):
 
 
 # TODO: refine this class
-class SearchableModelResource(ModelResource):
+class SearchableModelResource(CachedUriMixin, ShardedResourceMixin, RelatedFieldsMixin, ThrottledResourceMixin, ModelResource):
 
     class Meta:
         authentication = MicroblogApiKeyAuthentication()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
 
     def override_urls(self):
         return [
@@ -192,13 +339,22 @@ class SearchableModelResource(ModelResource):
         """
         return self.get_object_list(request)
 
-    def search(self, request):
-        qs = self.base_query_set(request)
+    def filter_terms(self, query_set, request):
         terms = self.get_terms(request)
         if len(terms):
             q_objects = self.get_q_objects(terms)
-            qs = qs.filter(reduce(operator.or_, q_objects))
-        return qs
+            query_set = query_set.filter(reduce(operator.or_, q_objects))
+        return query_set
+
+    def search(self, request):
+        return self.filter_terms(self.base_query_set(request), request)
+
+    def search_archive(self, request):
+        """
+        Subclasses with archived objects can override this method to return the archived objects
+        matching the search, which are paginated after the results of search.
+        """
+        return None
 
     def customize_query_set(self, query_set, request):
         """
@@ -216,11 +372,17 @@ class SearchableModelResource(ModelResource):
 
         # Customize query set.
         results = self.customize_query_set(results, request)
+        # Identical searches running at once share their count and page, see microblog_app.coalesce.
+        results = CoalescedObjects(results)
 
         # Paginate the results.
         # TODO: Check if possible to reuse URI form override_urls
         search_uri = '%ssearch%s' % (self.get_resource_list_uri(), trailing_slash())
-        paginator = self._meta.paginator_class(request.GET, results, resource_uri=search_uri, limit=self._meta.limit)
+        archived = self.search_archive(request)
+        if archived is None:
+            paginator = self._meta.paginator_class(request.GET, results, resource_uri=search_uri, limit=self._meta.limit)
+        else:
+            paginator = HotColdPaginator(request.GET, results, archived, resource_uri=search_uri, limit=self._meta.limit)
 
         # Create response
         bundles = []
@@ -238,7 +400,7 @@ class SearchableModelResource(ModelResource):
         return self.create_response(request, object_list)
 
 
-class UserResource(SearchableModelResource):
+class UserResource(SharedCacheMixin, SearchableModelResource):
     followers_count = fields.IntegerField(attribute='followers_count', readonly=True)
     following_count = fields.IntegerField(attribute='following_count', readonly=True)
     posts_count = fields.IntegerField(attribute='posts_count', readonly=True)
@@ -246,11 +408,13 @@ class UserResource(SearchableModelResource):
     followed_by_current_user = fields.BooleanField(readonly=True)
 
     class Meta:
-        queryset = User.objects.all()
+        queryset = User.objects.filter(deleted_date__isnull=True)
         resource_name = 'user'
         fields = ['username', 'first_name', 'last_name', 'email', 'id', 'avatar_url']
         authentication = MicroblogApiKeyAuthentication(public_methods=['POST'])
         authorization = Authorization()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
         filtering = {
             "username": ('exact',),
             "email": ('exact',),
@@ -288,14 +452,47 @@ class UserResource(SearchableModelResource):
             else:                
                 user.set_password(new_pass)
                 user.save()
+                revoke_tokens(user)
         return updated_bundle        
 
+    def obj_delete(self, request=None, **kwargs):
+        """
+        Hides the user and their content at once, their rows are purged in the background by
+        microblog_app.purge.
+        """
+        user = kwargs.pop('_obj', None) or self.obj_get(request, **kwargs)
+        delete_user(user)
+
+    def is_listed(self, user):
+        return user.deleted_date is None
+
+    # Fields that depend on the request's user, dehydrated on top of the cached fragment.
+    viewer_fields = ('followed_by_current_user',)
+
+    def full_dehydrate(self, bundle):
+        """
+        Reads the public fields of the user from the fragment cache of
+        microblog_app.fragments, filling it on a miss.
+        """
+        if bundle.obj.pk is None:
+            return super(UserResource, self).full_dehydrate(bundle)
+        fragment, version = fragments.get_fragment(bundle.obj.pk, bundle.request)
+        if fragment is None:
+            bundle = super(UserResource, self).full_dehydrate(bundle)
+            fragment = dict((name, value) for name, value in bundle.data.items() if name not in self.viewer_fields)
+            fragments.set_fragment(bundle.obj.pk, version, fragment, bundle.request)
+            return bundle
+        bundle.data.update(fragment)
+        for name in self.viewer_fields:
+            bundle.data[name] = getattr(self, 'dehydrate_%s' % name)(bundle)
+        return bundle
+
     def dehydrate_followed_by_current_user(self, bundle):
         user = bundle.request.user
         if user is None or not isinstance(user, User) or not isinstance(bundle.obj, User):
             return False
         else:
-            return Follow.objects.filter(follower=user, followee=bundle.obj).exists()
+            return Follow.objects.filter(follower=user.pk, followee=bundle.obj.pk).exists()
 
     def get_q_objects(self, terms):
         q_objects = []
@@ -310,10 +507,27 @@ class UserResource(SearchableModelResource):
 
     def override_urls(self):
         return super(UserResource, self).override_urls() + [
+            url(r"^(?P<resource_name>%s)/available%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_available'), name="api_get_available"),
             url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/followers%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_followers'), name="api_get_followers"),
             url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/following%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_following'), name="api_get_following"),
+            url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/stats%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_stats'), name="api_get_stats"),
+            url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/mentions%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_mentions'), name="api_get_mentions"),
         ]
 
+    def get_available(self, request, **kwargs):
+        """
+        Whether the username and email in the query string are free to sign up with, checked
+        against the filter of microblog_app.availability. Public, like signing up.
+        """
+        self.method_check(request, allowed=['get'])
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        fields = [field for field in availability.FIELDS if request.GET.get(field)]
+        if not fields:
+            raise BadRequest('You must provide an "username" parameter or an "email" parameter.')
+        return self.create_response(request, dict((field, availability.is_available(field, request.GET[field])) for field in fields))
+
     def get_followers(self, request, **kwargs):
         # Do proper checks
         self.method_check(request, allowed=['get'])
@@ -327,10 +541,11 @@ class UserResource(SearchableModelResource):
         except ObjectDoesNotExist:
             return HttpNotFound()
         # Get followers
-        followers = user.followers.all()
+        followers = user.followers.filter(deleted_date__isnull=True)
 
         # Apply pagination
-        followers_uri = '%sfollowers%s' % (self.get_resource_uri(user), trailing_slash()) # TODO: check if there's a better way of getting the URL
+        followers = CoalescedObjects(followers)
+        followers_uri = cached_reverse(self, 'api_get_followers', resource_name=self._meta.resource_name, pk=user.pk)
         paginator = self._meta.paginator_class(request.GET, followers, resource_uri=followers_uri, limit=self._meta.limit)
 
         # Create response, tastypie style
@@ -354,10 +569,11 @@ class UserResource(SearchableModelResource):
         except ObjectDoesNotExist:
             return HttpNotFound()
         # Get followers
-        following = user.follows.all()
+        following = user.follows.filter(deleted_date__isnull=True)
 
         # Apply pagination
-        following_uri = '%sfollowing%s' % (self.get_resource_uri(user), trailing_slash()) # TODO: check if there's a better way of getting the URL
+        following = CoalescedObjects(following)
+        following_uri = cached_reverse(self, 'api_get_following', resource_name=self._meta.resource_name, pk=user.pk)
         paginator = self._meta.paginator_class(request.GET, following, resource_uri=following_uri, limit=self._meta.limit)
 
         # Create response, tastypie style
@@ -367,8 +583,63 @@ class UserResource(SearchableModelResource):
         to_be_serialized['objects'] = [self.full_dehydrate(bundle) for bundle in bundles]
         return self.create_response(request, to_be_serialized)
 
+    def get_stats_range(self, request):
+        """
+        Returns the since and until dates of the request, the last STATS_DEFAULT_DAYS days
+        by default.
+        """
+        try:
+            dates = [datetime.strptime(request.GET[name], '%Y-%m-%d').date() if name in request.GET else None
+                     for name in ('since', 'until')]
+        except ValueError:
+            raise BadRequest('Dates must be formatted as YYYY-MM-DD')
+        since, until = dates
+        until = until or now().date()
+        since = since or until - timedelta(days=getattr(settings, 'STATS_DEFAULT_DAYS', 30) - 1)
+        return since, until
+
+    def get_stats(self, request, **kwargs):
+        """
+        Daily activity counts of the user from since to until, and their totals, read from
+        the rollups of microblog_app.rollups.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        try:
+            user = self.cached_obj_get(request=request, **self.remove_api_resource_names(kwargs))
+        except ObjectDoesNotExist:
+            return HttpNotFound()
+        since, until = self.get_stats_range(request)
+        days, totals = get_stats(user.pk, since, until)
+        return self.create_response(request, {
+            'meta': {'since': since.isoformat(), 'until': until.isoformat()},
+            'totals': totals,
+            'objects': days,
+        })
+
+
+    def get_mentions(self, request, **kwargs):
+        """
+        The posts mentioning the user, newest first.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        try:
+            user = self.cached_obj_get(request=request, **self.remove_api_resource_names(kwargs))
+        except ObjectDoesNotExist:
+            return HttpNotFound()
+        mentions_uri = cached_reverse(self, 'api_get_mentions', resource_name=self._meta.resource_name, pk=user.pk)
+        return PostResource(api_name=self._meta.api_name).get_indexed_posts(
+            request, Mention.objects.filter(user=user), ArchivedMention.objects.filter(user=user), mentions_uri)
+
 
-class PostResource(SearchableModelResource):
+class PostResource(SharedCacheMixin, SearchableModelResource):
     user = fields.ForeignKey(UserResource, 'user', full=True)
     in_reply_to = fields.ForeignKey('microblog_app.api.PostResource', 'in_reply_to', null=True, blank=True)
 
@@ -380,10 +651,12 @@ class PostResource(SearchableModelResource):
     shared_by_current_user = fields.BooleanField(readonly=True)
 
     class Meta:
-        queryset = Post.objects.select_related('user').all()
+        queryset = Post.objects.filter(deleted_date__isnull=True, user__deleted_date__isnull=True)
         resource_name = 'post'
         authentication = MicroblogApiKeyAuthentication()
         authorization = Authorization()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
         filtering = {
             "user": ('exact',),
             "in_reply_to": ('exact',),
@@ -392,18 +665,62 @@ class PostResource(SearchableModelResource):
     def override_urls(self):
         return super(PostResource, self).override_urls() + [
             url(r"^feed%s$" % (trailing_slash(),), self.wrap_view('dispatch_feed'), name="api_dispatch_feed"),
+            url(r"^feed/stream%s$" % (trailing_slash(),), self.wrap_view('dispatch_feed_stream'), name="api_dispatch_feed_stream"),
+            url(r"^tag/(?P<name>\w+)/posts%s$" % (trailing_slash(),), self.wrap_view('get_tag_posts'), name="api_get_tag_posts"),
         ]
 
+    def get_indexed_posts(self, request, rows, archived_rows, resource_uri):
+        """
+        Responds with the posts of rows, PostTag or Mention rows, newest first, followed by
+        the archived posts of archived_rows, their ArchivedPostTag or ArchivedMention rows.
+        Each page is a range of their (..., created_date, id) index, read with a cursor.
+        """
+        rows = rows.filter(post__deleted_date__isnull=True, post__user__deleted_date__isnull=True).select_related('post__user')
+        rows = fan_in(rows)
+        archived_rows = archived_rows.filter(post__user__deleted_date__isnull=True).select_related('post__user')
+        paginator = CursorPaginator(request.GET, rows, archived_rows, resource_uri=resource_uri, limit=self._meta.limit)
+        to_be_serialized = paginator.page()
+        bundles = [self.build_bundle(obj=row.post, request=request) for row in to_be_serialized['objects']]
+        to_be_serialized['objects'] = [self.full_dehydrate(bundle) for bundle in bundles]
+        return self.create_response(request, to_be_serialized)
+
+    def get_tag_posts(self, request, **kwargs):
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        name = kwargs['name'].lower()
+        uri_kwargs = {'name': name}
+        if self._meta.api_name is not None:
+            uri_kwargs['api_name'] = self._meta.api_name
+        tag_posts_uri = self._build_reverse_url('api_get_tag_posts', kwargs=uri_kwargs)
+        # Hashtags aren't sharded, they can't be joined with the rows in the shards.
+        hashtag_ids = list(Hashtag.objects.filter(name=name).values_list('pk', flat=True))
+        return self.get_indexed_posts(request, PostTag.objects.filter(hashtag__in=hashtag_ids),
+                                      ArchivedPostTag.objects.filter(hashtag__in=hashtag_ids), tag_posts_uri)
+
+    def get_feed_q(self, request):
+        """
+        Returns the filter for the posts in the feed, valid for both Post and ArchivedPost.
+        """
+        return feed.get_feed_q(request.user.pk, feed.get_followee_ids(request.user.pk))
+
     def get_feed(self, request, **kwargs):
+        """
+        Returns the feed of the current user, newest first, read by the FEED_ENGINE engine.
+        """
         objects = self.obj_get_list(request=request, **self.remove_api_resource_names(kwargs))
-        user = microblog_app.models.User.objects.get(pk=request.user.pk)
-        follows = user.follows.all()
-        return objects.filter(
-            Q(user=user) # Posts made by the user himself
-            | Q(user__in=follows) # Or posts made by an user that the user is following         
-            | Q(shares__user=user) # Or posts shared by the user himself
-            | Q(shares__user__in=follows) # Or posts shared by an user that the user is following
-        ).order_by('created_date').distinct()
+        if feed.get_engine() == 'merge':
+            return feed.MergedFeed(objects, request.user.pk)
+        return objects.filter(self.get_feed_q(request)).order_by('-created_date', '-id').distinct()
+
+    def get_archived_object_list(self):
+        return ArchivedPost.objects.select_related('user').filter(user__deleted_date__isnull=True)
+
+    def get_archived_feed(self, request, **kwargs):
+        objects = self.get_archived_object_list()
+        return objects.filter(self.get_feed_q(request)).order_by('-created_date', '-id').distinct()
 
     def dispatch_feed(self, request, **kwargs):
         # Do basic checks
@@ -413,15 +730,17 @@ class PostResource(SearchableModelResource):
         self.throttle_check(request)
         self.log_throttled_access(request)
 
-        # Get posts
+        # Get posts, the archive is only read when paginating past the recent posts
         objects = self.get_feed(request, **kwargs)
+        archived = self.get_archived_feed(request, **kwargs)
 
-        paginator = self._meta.paginator_class(request.GET, objects, resource_uri=self.get_resource_list_uri(), limit=self._meta.limit)
+        feed_uri = cached_reverse(self, 'api_dispatch_feed')
+        if isinstance(objects, feed.MergedFeed) and 'offset' not in request.GET:
+            # Every source reads a page before the cursor, see microblog_app.feed.
+            paginator = CursorPaginator(request.GET, objects, archived, resource_uri=feed_uri, limit=self._meta.limit)
+        else:
+            paginator = HotColdPaginator(request.GET, objects, archived, resource_uri=feed_uri, limit=self._meta.limit)
         to_be_serialized = paginator.page()
-        next = to_be_serialized['meta'].get('next', None)
-        logger.debug('next: %s' % next)
-        if not next is None:
-            to_be_serialized['meta']['next'] = next.replace(r'/post/', r'/feed/', 1)
 
         # Dehydrate the bundles in preparation for serialization.
         bundles = [self.build_bundle(obj=obj, request=request) for obj in to_be_serialized['objects']]
@@ -429,11 +748,115 @@ class PostResource(SearchableModelResource):
         to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
         return self.create_response(request, to_be_serialized)
 
+    def dispatch_feed_stream(self, request, **kwargs):
+        """
+        Server-Sent Events stream of the new posts and shares of the user and the users he follows.
+        Clients can resume after the last event received with the Last-Event-ID header (or the
+        last_event_id parameter), the events of the FEED_STREAM_LOOKBACK seconds before it are
+        sent again. Streams are closed after FEED_STREAM_TIMEOUT seconds, clients are expected to
+        reconnect with Last-Event-ID. Holding thousands of streams open requires the gevent
+        workers.
+        """
+        # Do basic checks
+        self.is_authenticated(request)
+        self.is_authorized(request)
+        self.method_check(request, allowed=['get'])
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        user = microblog_app.models.User.objects.get(pk=request.user.pk)
+        user_ids = set(user.follows.values_list('pk', flat=True))
+        user_ids.add(user.pk)
+        cursor = parse_cursor(request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id'))
+        ensure_poller()
+
+        response = HttpResponse(self.feed_stream(user_ids, cursor), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def feed_stream(self, user_ids, cursor):
+        heartbeat = getattr(settings, 'FEED_STREAM_HEARTBEAT', 15)
+        deadline = time.time() + getattr(settings, 'FEED_STREAM_TIMEOUT', 300)
+        after_seq = stream_bus.seq
+        # Backfilled events may be published again by the poller.
+        sent = set()
+
+        yield 'retry: 3000\n\n'
+        if cursor is not None:
+            for event in backfill(user_ids, cursor):
+                yield self.format_stream_event(event)
+                sent.add((event.kind, event.id))
+        # Idle streams must not hold a database connection.
+        close_connection()
+
+        last_sent = time.time()
+        while time.time() < deadline:
+            events = stream_bus.wait(after_seq, heartbeat)
+            if events:
+                after_seq = events[-1].seq
+            for event in events:
+                if event.user_id not in user_ids:
+                    continue
+                if (event.kind, event.id) in sent:
+                    continue
+                yield self.format_stream_event(event)
+                last_sent = time.time()
+            if time.time() - last_sent >= heartbeat:
+                yield ': heartbeat\n\n'
+                last_sent = time.time()
+
+    def format_stream_event(self, event):
+        if event.data is None:
+            user_uri = UserResource().get_resource_uri_for_pk(event.user_id)
+            post_uri = self.get_resource_uri_for_pk(event.post_id)
+            if event.kind == 'post':
+                data = {
+                    'id': event.id,
+                    'resource_uri': post_uri,
+                    'user': user_uri,
+                    'text': event.text,
+                    'in_reply_to': self.get_resource_uri_for_pk(event.in_reply_to_id) if event.in_reply_to_id else None,
+                    'created_date': event.created_date.isoformat(),
+                }
+            else:
+                data = {
+                    'id': event.id,
+                    'resource_uri': ShareResource().get_resource_uri_for_pk(event.id),
+                    'user': user_uri,
+                    'post': post_uri,
+                    'created_date': event.created_date.isoformat(),
+                }
+            event.data = json.dumps(data)
+        return 'id: %s\nevent: %s\ndata: %s\n\n' % (event.cursor, event.kind, event.data)
+
+    def obj_get(self, request=None, **kwargs):
+        """
+        Falls back to the archived posts on reads, so details of archived posts are still available.
+        Writes only see the posts in the hot table, archived posts can't be liked, shared or replied.
+        """
+        try:
+            return super(PostResource, self).obj_get(request, **kwargs)
+        except ObjectDoesNotExist:
+            if request is None or request.method != 'GET' or 'pk' not in kwargs:
+                raise
+            return self.get_archived_object_list().get(pk=kwargs['pk'])
+
+    def is_listed(self, post):
+        return post.deleted_date is None and post.user.deleted_date is None
+
+    def obj_delete(self, request=None, **kwargs):
+        """
+        Hides the post at once, its rows are purged in the background by microblog_app.purge.
+        """
+        post = kwargs.pop('_obj', None) or super(PostResource, self).obj_get(request, **kwargs)
+        delete_post(post)
+
     def dehydrate_liked_by_current_user(self, bundle):
-        return Like.objects.filter(user=bundle.request.user, post=bundle.obj).exists()
+        # The likes of the post, read from its shard (or from the archive).
+        return bundle.obj.likes.filter(user=bundle.request.user.pk).exists()
 
     def dehydrate_shared_by_current_user(self, bundle):
-        return Share.objects.filter(user=bundle.request.user, post=bundle.obj).exists()
+        return bundle.obj.shares.filter(user=bundle.request.user.pk).exists()
 
     def get_q_objects(self, terms):
         q_objects = []
@@ -445,58 +868,136 @@ class PostResource(SearchableModelResource):
     def customize_query_set(self, query_set, request):
         return query_set.annotate(Count('likes', distinct=True)).order_by('-likes__count')
 
+    def search_archive(self, request):
+        archived = self.filter_terms(self.get_archived_object_list(), request)
+        return self.customize_query_set(archived, request)
+
 
-class FollowResource(ModelResource):
+class FollowResource(CachedUriMixin, RelatedFieldsMixin, ThrottledResourceMixin, ModelResource):
     follower = fields.ForeignKey(UserResource, 'follower')
     followee = fields.ForeignKey(UserResource, 'followee')
 
     class Meta:
-        queryset = Follow.objects.all()
+        queryset = Follow.objects.filter(follower__deleted_date__isnull=True, followee__deleted_date__isnull=True)
         resource_name = 'follow'
         authentication = MicroblogApiKeyAuthentication()
         authorization = Authorization()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
         filtering = {
             "follower": ('exact',),
             "followee": ('exact',),
         }
 
-class LikeResource(ModelResource):
+class LikeResource(CachedUriMixin, ShardedResourceMixin, RelatedFieldsMixin, ThrottledResourceMixin, ModelResource):
     user = fields.ForeignKey(UserResource, 'user')
     post = fields.ForeignKey(PostResource, 'post')
 
     class Meta:
-        queryset = Like.objects.all()
+        queryset = Like.objects.filter(user__deleted_date__isnull=True, post__deleted_date__isnull=True)
         resource_name = 'like'
         authentication = MicroblogApiKeyAuthentication()
         authorization = Authorization()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
         filtering = {
             "user": ('exact',),
             "post": ('exact',),
         }
 
-class ShareResource(ModelResource):
+class ShareResource(CachedUriMixin, ShardedResourceMixin, RelatedFieldsMixin, ThrottledResourceMixin, ModelResource):
     user = fields.ForeignKey(UserResource, 'user')
     post = fields.ForeignKey(PostResource, 'post')
 
     class Meta:
-        queryset = Share.objects.all()
+        queryset = Share.objects.filter(user__deleted_date__isnull=True, post__deleted_date__isnull=True)
         resource_name = 'share'
         authentication = MicroblogApiKeyAuthentication()
         authorization = Authorization()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
         filtering = {
             "user": ('exact',),
             "post": ('exact',),
         }
 
-class LoginResource(Resource):
+class NotificationResource(CachedUriMixin, ShardedResourceMixin, RelatedFieldsMixin, ThrottledResourceMixin, ModelResource):
+    """
+    The notifications inbox of the current user, newest first. It's paginated with a cursor
+    instead of an offset, and the unread notifications count is returned in the meta.
+    Notifications are marked as read one by one with PATCH, or all of them with a POST to
+    /notification/read/.
+    """
+    actor = fields.ForeignKey(UserResource, 'actor')
+    post = fields.ForeignKey(PostResource, 'post', null=True)
+
+    class Meta:
+        queryset = Notification.objects.filter(actor__deleted_date__isnull=True, post__deleted_date__isnull=True)
+        resource_name = 'notification'
+        fields = ['id', 'kind', 'actors_count', 'read', 'created_date', 'modified_date']
+        list_allowed_methods = ['get']
+        detail_allowed_methods = ['get', 'patch']
+        authentication = MicroblogApiKeyAuthentication()
+        authorization = Authorization()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
+
+    def override_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/read%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('mark_all_read'), name="api_mark_all_read"),
+        ]
+
+    def apply_authorization_limits(self, request, object_list):
+        return for_user(object_list.filter(user=request.user), request.user.pk)
+
+    def get_list(self, request, **kwargs):
+        objects = self.obj_get_list(request=request, **self.remove_api_resource_names(kwargs))
+
+        # The page and the unread count are both read from the (user, modified_date) index
+        paginator = CursorPaginator(request.GET, objects, resource_uri=self.get_resource_list_uri(), limit=self._meta.limit, order_field='modified_date')
+        to_be_serialized = paginator.page()
+        unread = for_user(Notification.objects.filter(user=request.user, read=False), request.user.pk)
+        to_be_serialized['meta']['unread_count'] = unread.count()
+
+        # Dehydrate the bundles in preparation for serialization.
+        bundles = [self.build_bundle(obj=obj, request=request) for obj in to_be_serialized['objects']]
+        to_be_serialized['objects'] = [self.full_dehydrate(bundle) for bundle in bundles]
+        to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
+        return self.create_response(request, to_be_serialized)
+
+    def obj_update(self, bundle, request=None, **kwargs):
+        """
+        Only the read flag of a notification can be updated.
+        """
+        bundle.obj = self.obj_get(request=request, **kwargs)
+        # "false" and "0" are false, as in form data.
+        bundle.obj.read = forms.BooleanField(required=False).to_python(bundle.data.get('read', True))
+        if not save_unique(bundle.obj, bundle.obj._state.db):
+            # Events since it was read started a new unread notification.
+            raise BadRequest('There is a newer unread notification of the same kind.')
+        return bundle
+
+    def mark_all_read(self, request, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        for_user(Notification.objects.filter(user=request.user, read=False), request.user.pk).update(read=True)
+        return HttpNoContent()
+
+class LoginResource(ThrottledResourceMixin, Resource):
     """
     Used to obtain the API key assigned to a user for a period of time, using
-    his email and password.
+    his email and password. It also returns a short lived signed access token, which
+    can be used instead of the API key and is verified without any DB access.
     """
 
     class Meta:
         resource_name = 'login'
         list_allowed_methods = ['post']
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
 
     def override_urls(self):
         return [
@@ -516,6 +1017,9 @@ class LoginResource(Resource):
         return errors
 
     def login(self, request, **kwargs):
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
         deserialized = self.deserialize(
             request,
             request.raw_post_data,
@@ -551,13 +1055,15 @@ class LoginResource(Resource):
         user_resource = UserResource()
         response_data = {
             'api_key': api_key.key,
+            'access_token': issue_token(user),
+            'access_token_expires_in': get_lifetime(),
             'user': user_resource.get_resource_uri(user)
         }
 
         return self.create_response(request, response_data)
 
 
-class LostPasswordResource(ModelResource):
+class LostPasswordResource(ThrottledResourceMixin, ModelResource):
     """
     Used for password reset.
     """
@@ -567,6 +1073,8 @@ class LostPasswordResource(ModelResource):
         queryset = LostPassword.objects.all()
         authorization = Authorization()
         authentication = Authentication()
+        throttle = SlidingWindowThrottle()
+        serializer = FastJSONSerializer()
         fields = ['uuid', 'email', 'new_password']
         list_allowed_methods = ['post']
         detail_allowed_methods = []
@@ -0,0 +1,130 @@
+"""
+Moves old posts, with their likes and shares, from the hot tables to the archive tables.
+
+Posts are moved in small chunks, each one in its own transaction, so locks on the hot
+tables are held briefly and the job can run in the background while serving requests.
+A post is only archived once none of its replies remain in the Post table, so the
+foreign keys of the hot tables never point to the archive. With sharding the posts of each
+shard are archived in turn to the default database, checking for replies in every shard.
+
+The PostTag and Mention rows of a post are moved to ArchivedPostTag and ArchivedMention,
+so archived posts are still listed by hashtag and mention, after the hot ones. Notifications
+only cover hot posts: they leave the inbox when their post is archived.
+"""
+from datetime import timedelta
+import logging
+import time
+from django.conf import settings
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.utils.timezone import now
+from microblog_app.models import Post, Like, Share, Notification, PostTag, Mention, ArchivedPost, ArchivedLike, \
+    ArchivedShare, ArchivedPostTag, ArchivedMention
+from microblog_app.sharding import get_model_databases
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_archive_age():
+    """
+    Posts older than this timedelta are archived, from the POST_ARCHIVE_AGE_DAYS setting.
+    """
+    return timedelta(days=getattr(settings, 'POST_ARCHIVE_AGE_DAYS', 365))
+
+
+def archivable_posts(cutoff):
+    # Deleted posts are purged instead, see microblog_app.purge.
+    return Post.objects.filter(created_date__lt=cutoff, replies__isnull=True, deleted_date__isnull=True).order_by('id')
+
+
+def get_replied_ids(ids):
+    """
+    Returns the ids of the posts of ids with replies, in any database.
+    """
+    replied = set()
+    for alias in get_model_databases(Post):
+        replied.update(Post.objects.using(alias).filter(in_reply_to__in=ids).values_list('in_reply_to', flat=True))
+    return replied
+
+
+def archive_chunk(cutoff, chunk_size, using=DEFAULT_DB_ALIAS, start_id=0):
+    """
+    Archives up to chunk_size posts of the using database created before cutoff, with an
+    id greater than start_id. Returns the last id looked at, None if there were no posts
+    left, and how many were archived.
+    """
+    # The archive is in the default database.
+    with transaction.commit_on_success():
+        with transaction.commit_on_success(using=using):
+            posts = archivable_posts(cutoff).using(using).filter(id__gt=start_id)
+            ids = list(posts[:chunk_size].values_list('id', flat=True))
+            if not ids:
+                return None, 0
+            last_id = ids[-1]
+            # Locking the posts makes likes, shares and replies of them wait for the commit, the
+            # ones that got a reply before the lock are left in the hot table.
+            list(Post.objects.using(using).select_for_update().filter(id__in=ids).values_list('id', flat=True))
+            replied = get_replied_ids(ids)
+            posts = [post for post in Post.objects.using(using).filter(id__in=ids).order_by('id') if post.id not in replied]
+            if not posts:
+                return last_id, 0
+            ids = [post.id for post in posts]
+            likes = list(Like.objects.using(using).filter(post__in=ids))
+            shares = list(Share.objects.using(using).filter(post__in=ids))
+            post_tags = list(PostTag.objects.using(using).filter(post__in=ids))
+            mentions = list(Mention.objects.using(using).filter(post__in=ids))
+
+            ArchivedPost.objects.bulk_create([
+                ArchivedPost(id=post.id, user_id=post.user_id, in_reply_to_id=post.in_reply_to_id, text=post.text,
+                             created_date=post.created_date, modified_date=post.modified_date)
+                for post in posts])
+            ArchivedLike.objects.bulk_create([
+                ArchivedLike(user_id=like.user_id, post_id=like.post_id, created_date=like.created_date)
+                for like in likes])
+            ArchivedShare.objects.bulk_create([
+                ArchivedShare(user_id=share.user_id, post_id=share.post_id, created_date=share.created_date)
+                for share in shares])
+            ArchivedPostTag.objects.bulk_create([
+                ArchivedPostTag(id=post_tag.id, hashtag_id=post_tag.hashtag_id, post_id=post_tag.post_id,
+                                created_date=post_tag.created_date)
+                for post_tag in post_tags])
+            ArchivedMention.objects.bulk_create([
+                ArchivedMention(id=mention.id, user_id=mention.user_id, post_id=mention.post_id,
+                                created_date=mention.created_date)
+                for mention in mentions])
+
+            # Only the rows copied are deleted.
+            Like.objects.using(using).filter(id__in=[like.id for like in likes]).delete()
+            Share.objects.using(using).filter(id__in=[share.id for share in shares]).delete()
+            PostTag.objects.using(using).filter(id__in=[post_tag.id for post_tag in post_tags]).delete()
+            Mention.objects.using(using).filter(id__in=[mention.id for mention in mentions]).delete()
+            # Not archived, see above.
+            Notification.objects.using(using).filter(post__in=ids).delete()
+            Post.objects.using(using).filter(id__in=ids).delete()
+            return last_id, len(ids)
+
+
+def archive_posts(age=None, chunk_size=None, pause=0):
+    """
+    Archives every archivable post older than age, in chunks of chunk_size posts,
+    sleeping pause seconds between chunks. Returns the total number of archived posts.
+    Archiving replies makes their parents archivable, they are picked up by the next pass.
+    """
+    cutoff = now() - (age or get_archive_age())
+    chunk_size = chunk_size or getattr(settings, 'POST_ARCHIVE_CHUNK_SIZE', 500)
+    total = 0
+    archived_in_pass = True
+    while archived_in_pass:
+        archived_in_pass = False
+        for using in get_model_databases(Post):
+            last_id = 0
+            while True:
+                last_id, archived = archive_chunk(cutoff, chunk_size, using, last_id)
+                if last_id is None:
+                    break
+                archived_in_pass = archived_in_pass or archived > 0
+                total += archived
+                logger.info('archived %i posts of %s (%i so far)' % (archived, using, total))
+                if pause:
+                    time.sleep(pause)
+    return total
@@ -0,0 +1,181 @@
+"""
+Availability of usernames and emails for signup, checked against a Bloom filter of the
+taken ones kept in each process, so most checks of a new name (the common case, clients
+check as the user types) don't touch the database.
+
+A Bloom filter never misses a value added to it but can report one that wasn't, so a
+miss means the value is available and only a hit is confirmed with the indexes of
+auth_user. The filter is built from every user the first time it's used, values saved in
+this process are added by the post_save signals of User, and users created by other
+processes are read every AVAILABILITY_REFRESH_INTERVAL seconds: the ones that joined
+since AVAILABILITY_REFRESH_LOOKBACK seconds before the newest one read, so users committed
+after ones that joined later aren't missed. The users are read without holding the lock
+of the filter, which is only held to add them. An email changed by another process is only
+seen when the filter is rebuilt, which happens every AVAILABILITY_REBUILD_INTERVAL seconds and when
+the filter outgrows its capacity. UserResource.obj_create still fails on a duplicate
+username, the filter only answers the checks.
+"""
+import hashlib
+import math
+import struct
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for capacity values with the given false positive rate. The bit
+    positions of a value are derived from its MD5 digest by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(value).digest())
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(value))
+
+
+# Fields checked, a value is available if no user has it in that field.
+FIELDS = ('username', 'email')
+
+_lock = threading.Lock()
+_build_lock = threading.Lock()
+_state = {}
+
+
+def get_key(field, value):
+    return '%s:%s' % (field, value)
+
+
+def get_lookback():
+    """
+    Users that joined this timedelta before the newest one read are read again by every
+    refresh, from the AVAILABILITY_REFRESH_LOOKBACK setting (seconds).
+    """
+    return timedelta(seconds=getattr(settings, 'AVAILABILITY_REFRESH_LOOKBACK', 60))
+
+
+def build():
+    """
+    Returns a new filter of the usernames and emails of every user.
+    """
+    capacity = max(getattr(settings, 'AVAILABILITY_FILTER_CAPACITY', 100000), 2 * len(FIELDS) * User.objects.count())
+    bloom = BloomFilter(capacity, getattr(settings, 'AVAILABILITY_FILTER_ERROR_RATE', 0.01))
+    now = time.time()
+    state = {'filter': bloom, 'since': None, 'built': now, 'refreshed': now}
+    # Not shared yet, the rows are added as they're read.
+    add_rows(state, read_rows(None).iterator())
+    return state
+
+
+def read_rows(since):
+    """
+    Returns the dates joined, usernames and emails of the users that joined since the
+    lookback window before the date, of every user if it's None.
+    """
+    # auth users (admins) take usernames too, so every auth_user row is read.
+    rows = User.objects.order_by('date_joined', 'pk')
+    if since is not None:
+        rows = rows.filter(date_joined__gte=since - get_lookback())
+    return rows.values_list('date_joined', *FIELDS)
+
+
+def add_rows(state, rows):
+    for row in rows:
+        for field, value in zip(FIELDS, row[1:]):
+            key = get_key(field, value)
+            # Users read again are in the filter already, only the new ones are counted.
+            if value and key not in state['filter']:
+                state['filter'].add(key)
+        state['since'] = max(state['since'], row[0]) if state['since'] is not None else row[0]
+
+
+def is_due(state, now):
+    return (now - state['built'] > getattr(settings, 'AVAILABILITY_REBUILD_INTERVAL', 3600) or
+            state['filter'].count > state['filter'].capacity)
+
+
+def get_state():
+    """
+    Returns the filter of this process, building, rebuilding or refreshing it when due.
+    """
+    now = time.time()
+    with _lock:
+        state = _state.get('current')
+        usable = state is not None and not is_due(state, now)
+        refresh = usable and now - state['refreshed'] > getattr(settings, 'AVAILABILITY_REFRESH_INTERVAL', 5)
+        if refresh:
+            # Refreshed by a single thread, the others keep using the filter meanwhile.
+            state['refreshed'] = now
+            since = state['since']
+    if usable:
+        if refresh:
+            rows = list(read_rows(since))
+            with _lock:
+                add_rows(state, rows)
+        return state
+    # Filters are built outside _lock by one thread at a time, the others keep using the
+    # current one, or wait for the first one.
+    if not _build_lock.acquire(state is None):
+        return state
+    try:
+        with _lock:
+            current = _state.get('current')
+        if current is not None and current is not state:
+            # Built by another thread meanwhile.
+            return current
+        state = build()
+        # Users saved while building were added to the previous filter.
+        rows = list(read_rows(state['since']))
+        with _lock:
+            add_rows(state, rows)
+            _state['current'] = state
+        return state
+    finally:
+        _build_lock.release()
+
+
+def add(user):
+    """
+    Adds the username and email of user to the filter, if it's been built.
+    """
+    with _lock:
+        state = _state.get('current')
+        if state is not None:
+            for field in FIELDS:
+                value = getattr(user, field)
+                if value:
+                    state['filter'].add(get_key(field, value))
+
+
+def reset():
+    with _lock:
+        _state.clear()
+
+
+def is_available(field, value):
+    """
+    Returns whether no user has value in field, only querying the database when the
+    filter reports it may be taken.
+    """
+    if get_key(field, value) not in get_state()['filter']:
+        return True
+    return not User.objects.filter(**{field: value}).exists()
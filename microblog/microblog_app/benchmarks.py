@@ -0,0 +1,283 @@
+"""
+ORM level microbenchmarks of the hot paths of the API, called directly instead of through
+HTTP: reading a page of the feed, searching posts, dehydrating a page of posts and
+authenticating with an API key. Used by the benchmark command.
+
+Every scale is measured on a new test database seeded with that many users (see
+microblog_app.explain.seed) from a fixed random seed, so runs are comparable. Each benchmark
+records its wall time (the median of the repeats), the queries it runs and the memory it
+takes, the growth of the peak resident set size (read from /proc, None where there's no
+/proc). Results are saved as a JSON baseline, later runs are compared with it and every
+metric worse than the baseline by more than a threshold is flagged as a regression.
+
+stress_shared_cache measures the shared cache of microblog_app.shared_cache instead, from
+forked processes reading the same hot posts as gunicorn workers would.
+"""
+import json
+import os
+import random
+import re
+import time
+from django.core.cache import cache
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Count
+from microblog_app.explain import build_request, seed
+from microblog_app.models import User, Post
+from microblog_app import shared_cache
+from tastypie.models import ApiKey
+
+
+# Users seeded by scale name.
+SCALES = {
+    'small': 100,
+    'medium': 1000,
+    'large': 5000,
+}
+
+# Objects per page, the API default.
+LIMIT = 20
+
+METRICS = ('time', 'queries', 'memory')
+
+# Memory growths smaller than this (in KB) are noise, they are never flagged.
+MEMORY_NOISE = 256
+
+
+def get_context(using=DEFAULT_DB_ALIAS):
+    """
+    Returns what the benchmarks need, as seen by the user following the most users.
+    """
+    from microblog_app.api import PostResource
+    user = User.objects.using(using).annotate(follows_count=Count('follows')).order_by('-follows_count', 'pk')[0]
+    post_resource = PostResource()
+    request = build_request(user)
+    return {
+        'user': user,
+        'post_resource': post_resource,
+        'request': request,
+        'search_request': build_request(user, q='post 1'),
+        'auth_request': build_request(None, api_user=user.username, api_key=ApiKey.objects.using(using).get(user=user).key),
+        'page': list(post_resource.get_feed(request)[:LIMIT]),
+    }
+
+
+def bench_feed(context):
+    list(context['post_resource'].get_feed(context['request'])[:LIMIT])
+
+
+def bench_search(context):
+    resource = context['post_resource']
+    request = context['search_request']
+    list(resource.customize_query_set(resource.search(request), request)[:LIMIT])
+
+
+def bench_dehydrate(context):
+    resource = context['post_resource']
+    for post in context['page']:
+        resource.full_dehydrate(resource.build_bundle(obj=post, request=context['request']))
+
+
+def bench_authenticate(context):
+    from microblog_app.api import MicroblogApiKeyAuthentication
+    MicroblogApiKeyAuthentication().is_authenticated(context['auth_request'])
+
+
+BENCHMARKS = (
+    ('feed', bench_feed),
+    ('search', bench_search),
+    ('full_dehydrate', bench_dehydrate),
+    ('is_authenticated', bench_authenticate),
+)
+
+
+def read_memory(field):
+    try:
+        with open('/proc/self/status') as status:
+            return int(re.search(r'%s:\s+(\d+)' % field, status.read()).group(1))
+    except (IOError, AttributeError):
+        return None
+
+
+def reset_peak_memory():
+    # Writing 5 to clear_refs resets the peak resident set size (Linux 4.0+).
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def measure(function, context, repeat=5, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the metrics of function: the median of repeat timed runs, and the queries and
+    memory of one more run. The cache is cleared before every run, so cached fragments
+    and throttles don't make later runs faster.
+    """
+    timings = []
+    for i in range(repeat):
+        cache.clear()
+        start = time.time()
+        function(context)
+        timings.append(time.time() - start)
+    timings.sort()
+
+    # Counting the queries slows them down, so it's done in a run that isn't timed.
+    connection = connections[using]
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    cache.clear()
+    reset_peak_memory()
+    start_memory = read_memory('VmRSS')
+    queries = len(connection.queries)
+    try:
+        function(context)
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+    peak_memory = read_memory('VmHWM')
+    return {
+        'time': timings[len(timings) // 2],
+        'queries': len(connection.queries) - queries,
+        'memory': peak_memory - start_memory if None not in (start_memory, peak_memory) else None,
+    }
+
+
+def measure_all(repeat=5, using=DEFAULT_DB_ALIAS):
+    """
+    Runs every benchmark on the data already in the database.
+    """
+    context = get_context(using)
+    return dict((name, measure(function, context, repeat, using)) for name, function in BENCHMARKS)
+
+
+def run(scales, repeat=5, using=DEFAULT_DB_ALIAS):
+    """
+    Seeds a new test database for every scale and runs the benchmarks on it. Returns the
+    results by scale, the baseline saved by the benchmark command.
+    """
+    connection = connections[using]
+    results = {}
+    for scale in scales:
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            random.seed(scale)
+            seed(SCALES[scale], using=using)
+            results[scale] = {'users': SCALES[scale], 'benchmarks': measure_all(repeat, using)}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def compare(baseline, results, threshold=0.2):
+    """
+    Returns (scale, benchmark, metric, baseline value, value) for every metric in results
+    worse than in the baseline by more than threshold (a fraction), and every query added.
+    """
+    regressions = []
+    for scale, scale_results in sorted(results.items()):
+        if scale not in baseline:
+            continue
+        for name, metrics in sorted(scale_results['benchmarks'].items()):
+            old_metrics = baseline[scale]['benchmarks'].get(name)
+            if old_metrics is None:
+                continue
+            for metric in METRICS:
+                old, new = old_metrics.get(metric), metrics.get(metric)
+                if old is None or new is None:
+                    continue
+                if metric == 'queries':
+                    regressed = new > old
+                elif metric == 'memory':
+                    regressed = new > old * (1 + threshold) and new - old > MEMORY_NOISE
+                else:
+                    regressed = new > old * (1 + threshold)
+                if regressed:
+                    regressions.append((scale, name, metric, old, new))
+    return regressions
+
+
+def read_mapping_memory(path):
+    """
+    Returns the proportional set size in KB of the mapping of path in this process, its
+    resident pages divided by the processes sharing each one. Summed over the processes
+    mapping it, it's the memory the mapping takes.
+    """
+    try:
+        with open('/proc/self/smaps') as smaps:
+            lines = smaps.read().splitlines()
+    except IOError:
+        return None
+    pss, in_mapping = 0, False
+    for line in lines:
+        if re.match(r'[0-9a-f]+-[0-9a-f]+ ', line):
+            in_mapping = line.endswith(path)
+        elif in_mapping and line.startswith('Pss:'):
+            pss += int(line.split()[1])
+    return pss
+
+
+def read_hot_posts(pks, reads, seed):
+    """
+    Gets reads posts of pks, the first ones most often, as a worker serving their details.
+    Returns the hits and misses of the shared cache and the memory of its mapping.
+    """
+    from microblog_app.api import PostResource
+    random.seed(seed)
+    resource = PostResource()
+    request = build_request(None)
+    shared_cache.stats.update(hits=0, misses=0)
+    for i in range(reads):
+        # Cubing skews the reads towards the head of the list, a few posts are most of them.
+        resource.obj_get(request, pk=pks[int(len(pks) * random.random() ** 3)])
+    return dict(shared_cache.stats, memory=read_mapping_memory(os.path.realpath(shared_cache.get_cache().path)))
+
+
+def stress_shared_cache(worker_counts, reads=1000, hot=100):
+    """
+    Reads the hot posts from each number of forked workers sharing a cleared cache. Returns
+    (workers, hit rate, memory in KB of the mapping summed over this process and the
+    workers) tuples.
+    """
+    pks = list(Post.objects.filter(deleted_date__isnull=True).order_by('-created_date').values_list('pk', flat=True)[:hot])
+    path = os.path.realpath(shared_cache.get_cache().path)
+    results = []
+    for workers in worker_counts:
+        shared_cache.clear()
+        # Every worker opens its own connections.
+        for connection in connections.all():
+            connection.close()
+        # Workers wait until this end is closed to exit, so their pages are still shared when measured.
+        release_fd, hold_fd = os.pipe()
+        children = []
+        for worker in range(workers):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                os.close(hold_fd)
+                try:
+                    os.write(write_fd, json.dumps(read_hot_posts(pks, reads, worker)))
+                    os.close(write_fd)
+                    os.read(release_fd, 1)
+                finally:
+                    os._exit(0)
+            os.close(write_fd)
+            children.append((pid, read_fd))
+        os.close(release_fd)
+        stats = []
+        for pid, read_fd in children:
+            with os.fdopen(read_fd) as pipe:
+                output = pipe.read()
+            if output:
+                stats.append(json.loads(output))
+        memory = read_mapping_memory(path) or 0
+        os.close(hold_fd)
+        for pid, read_fd in children:
+            os.waitpid(pid, 0)
+        if len(stats) != workers:
+            raise RuntimeError('A worker failed.')
+        hits = sum(worker_stats['hits'] for worker_stats in stats)
+        misses = sum(worker_stats['misses'] for worker_stats in stats)
+        memory += sum(worker_stats['memory'] or 0 for worker_stats in stats)
+        results.append((workers, float(hits) / ((hits + misses) or 1), memory))
+    return results
@@ -0,0 +1,15 @@
+"""
+What the default cache can be relied on for.
+"""
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def is_shared():
+    """
+    Returns whether the default cache is shared by the workers (memcached, see CACHES in
+    settings), rather than kept by each process. Invalidating a per-process cache only
+    reaches the worker doing it.
+    """
+    return not isinstance(cache, (LocMemCache, DummyCache))
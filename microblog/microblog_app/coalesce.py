@@ -0,0 +1,155 @@
+"""
+Single-flight coalescing of identical expensive reads, such as a trending search or the
+followers of a popular user: while a read runs, the threads requesting the same read wait
+for it and get its result instead of running it again.
+
+Reads are identified by their SQL, so the requests of every client coalesce whatever their
+credentials, and the fields that depend on the current user are dehydrated by each
+request afterwards. The objects read are shared by the requests waiting for them, which
+must not modify them.
+
+Within a process the first thread requesting a read (the leader) runs it and the others
+wait on an event. With COALESCE_SHARED the leader also takes a lock in the default cache,
+which must be shared by the workers (see CACHES in settings), and stores the result there
+for COALESCE_RESULT_TIMEOUT seconds. The leaders of other processes wait for that result
+instead of running the read. Waiting is bounded by COALESCE_TIMEOUT seconds. After that,
+or as soon as the leader fails, the waiting requests run the read themselves.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+class Flight(object):
+    """
+    A read running in this process.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+_lock = threading.Lock()
+_flights = {}
+
+
+def is_enabled():
+    return getattr(settings, 'COALESCE_ENABLED', True)
+
+
+def get_timeout():
+    """
+    Seconds a request waits for the read of another one, from the COALESCE_TIMEOUT setting.
+    """
+    return getattr(settings, 'COALESCE_TIMEOUT', 5)
+
+
+def get_query_key(objects):
+    """
+    Returns the key of the read of objects, a queryset or a FanIn, made from its SQL, or
+    None if it can't be coalesced.
+    """
+    querysets = objects.get_querysets() if hasattr(objects, 'get_querysets') else [objects]
+    parts = []
+    for queryset in querysets:
+        if not hasattr(queryset, 'query'):
+            return None
+        try:
+            sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        except EmptyResultSet:
+            return None
+        parts.append(u'%s\n%s\n%r' % (queryset.db, sql, params))
+    return hashlib.md5(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def run(key, compute):
+    """
+    Returns the result of compute, or of the call running for the same key.
+    """
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+    if not leader:
+        if flight.done.wait(get_timeout()) and not flight.failed:
+            return flight.result
+        # The leader failed or is too slow.
+        return compute()
+    try:
+        flight.result = run_shared(key, compute) if getattr(settings, 'COALESCE_SHARED', False) else compute()
+    except Exception:
+        flight.failed = True
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.result
+
+
+def run_shared(key, compute):
+    """
+    Returns the result of compute, or of the process running it for the same key.
+    """
+    lock_key = 'coalesce_lock:%s' % key
+    result_key = 'coalesce_result:%s' % key
+    timeout = get_timeout()
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, timeout):
+        try:
+            result = compute()
+        except Exception:
+            cache.delete(lock_key)
+            raise
+        # The token tells the waiting processes the result is the one they're waiting for.
+        cache.set(result_key, (token, result), getattr(settings, 'COALESCE_RESULT_TIMEOUT', 2))
+        cache.delete(lock_key)
+        return result
+
+    leader_token = cache.get(lock_key)
+    deadline = time.time() + timeout
+    poll_interval = getattr(settings, 'COALESCE_POLL_INTERVAL', 0.05)
+    while leader_token is not None and time.time() < deadline:
+        time.sleep(poll_interval)
+        running = cache.get(lock_key) == leader_token
+        stored = cache.get(result_key)
+        if stored is not None and stored[0] == leader_token:
+            return stored[1]
+        if not running:
+            # The leader failed, or the lock expired.
+            break
+    return compute()
+
+
+class CoalescedObjects(object):
+    """
+    Wraps the objects given to a paginator, so their count and the slices read are
+    coalesced.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.key = get_query_key(objects) if is_enabled() else None
+
+    def count(self):
+        if self.key is None:
+            return self.objects.count()
+        return run('%s:count' % self.key, self.objects.count)
+
+    def __getitem__(self, k):
+        if self.key is None or not isinstance(k, slice):
+            return self.objects[k]
+        return run('%s:%s:%s' % (self.key, k.start, k.stop), lambda: list(self.objects[k]))
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
@@ -0,0 +1,197 @@
+"""
+Index advisor: runs the querysets behind each API endpoint, captures their EXPLAIN output
+and flags the sequential scans and sorts, proposing the composite indexes that avoid them.
+
+Used by the explainqueries management command. Plans depend on the amount of data (a
+sequential scan is the best plan for a small table), so run it against a seeded database.
+"""
+import random
+import re
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Count
+from django.http import HttpRequest, QueryDict
+from microblog_app.feed import MergedFeed
+from microblog_app.models import User, Post, Follow, Like, Share
+
+
+# Composite indexes worth having for the queries below, by table. They are created by
+# the sql/<model>.sql files and migration 0003.
+INDEX_CANDIDATES = {
+    'microblog_app_post': [
+        ('microblog_app_post_user_created', ('user_id', 'created_date')),
+    ],
+    'microblog_app_follow': [
+        ('microblog_app_follow_followee_follower', ('followee_id', 'follower_id')),
+    ],
+    'microblog_app_notification': [
+        ('microblog_app_notification_inbox', ('user_id', 'modified_date', 'id')),
+    ],
+}
+
+PROBLEM_PATTERNS = {
+    'postgresql': [
+        (re.compile(r'Seq Scan on (?P<table>\w+)'), 'sequential scan'),
+        (re.compile(r'^(->\s*)?Sort\b'), 'sort'),
+    ],
+    'sqlite': [
+        # Newer SQLite versions leave TABLE out, a scan of a covering index is fine.
+        (re.compile(r'^SCAN (TABLE )?(?P<table>\w+)(?!.*USING)'), 'sequential scan'),
+        (re.compile(r'USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT)'), 'sort'),
+    ],
+}
+
+
+def get_vendor(using=DEFAULT_DB_ALIAS):
+    vendor = connections[using].vendor
+    if vendor not in PROBLEM_PATTERNS:
+        raise ValueError("EXPLAIN isn't supported for %s databases." % vendor)
+    return vendor
+
+
+def seed(users=1000, posts_per_user=20, follows_per_user=20, using=DEFAULT_DB_ALIAS):
+    """
+    Adds random users, posts, follows, likes and shares, so the plans are the ones the
+    database picks for realistic table sizes.
+    """
+    # Multi table inheritance models can't be bulk created.
+    offset = User.objects.using(using).count()
+    new_users = []
+    for i in range(offset, offset + users):
+        user = User(username='seed%i' % i, email='seed%i@example.com' % i)
+        user.save(using=using)
+        new_users.append(user.pk)
+    user_ids = list(User.objects.using(using).values_list('pk', flat=True))
+
+    Post.objects.using(using).bulk_create([
+        Post(user_id=user_id, text='seed post %i by %i' % (i, user_id))
+        for user_id in new_users for i in range(posts_per_user)])
+    post_ids = list(Post.objects.using(using).filter(user__in=new_users).values_list('pk', flat=True))
+
+    follows, likes, shares = [], [], []
+    for user_id in new_users:
+        for followee_id in set(random.sample(user_ids, min(follows_per_user, len(user_ids)))) - set([user_id]):
+            follows.append(Follow(follower_id=user_id, followee_id=followee_id))
+        for post_id in set(random.sample(post_ids, min(posts_per_user, len(post_ids)))):
+            likes.append(Like(user_id=user_id, post_id=post_id))
+        for post_id in set(random.sample(post_ids, min(posts_per_user / 4, len(post_ids)))):
+            shares.append(Share(user_id=user_id, post_id=post_id))
+    Follow.objects.using(using).bulk_create(follows)
+    Like.objects.using(using).bulk_create(likes)
+    Share.objects.using(using).bulk_create(shares)
+    return len(new_users)
+
+
+def build_request(current_user, **params):
+    request = HttpRequest()
+    request.user = current_user
+    request.method = 'GET'
+    request.GET = QueryDict('', mutable=True)
+    request.GET.update(params)
+    return request
+
+
+def representative_querysets(user, post):
+    """
+    Returns (name, queryset) pairs for the queries the API endpoints run, as seen by user,
+    one page of each.
+    """
+    from microblog_app.api import UserResource, PostResource, NotificationResource
+    user_resource = UserResource()
+    post_resource = PostResource()
+    request = build_request(user)
+    search_request = build_request(user, q='seed')
+    limit = 20
+    feed = post_resource.get_feed(request)
+    if isinstance(feed, MergedFeed):
+        # One query per source, see microblog_app.feed
+        feed_querysets = [('feed stream %i' % i, stream[:limit]) for i, stream in enumerate(feed.get_streams())]
+    else:
+        feed_querysets = [('feed', feed[:limit])]
+    return feed_querysets + [
+        ('archived feed', post_resource.get_archived_feed(request)[:limit]),
+        ('user posts', post_resource.obj_get_list(build_request(user, user=str(user.pk)))[:limit]),
+        ('replies', post_resource.obj_get_list(build_request(user, in_reply_to=str(post.pk)))[:limit]),
+        ('post search', post_resource.customize_query_set(post_resource.search(search_request), search_request)[:limit]),
+        ('user search', user_resource.customize_query_set(user_resource.search(search_request), search_request)[:limit]),
+        ('followers', user.followers.all()[:limit]),
+        ('following', user.follows.all()[:limit]),
+        ('followed by current user', Follow.objects.filter(follower=user, followee=post.user_id)),
+        ('post likes', Like.objects.filter(post=post)),
+        ('liked by current user', Like.objects.filter(user=user, post=post)),
+        ('notifications', NotificationResource().obj_get_list(request).order_by('-modified_date', '-id')[:limit]),
+    ]
+
+
+def explain(queryset):
+    """
+    Returns the lines of the plan the database picks for queryset.
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    # SQLite returns (id, parent, notused, detail) rows, PostgreSQL a single column.
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def find_problems(plan, vendor):
+    """
+    Returns (problem, table) pairs for the sequential scans and sorts in plan, table is
+    None for sorts.
+    """
+    problems = []
+    for line in plan:
+        line = line.strip()
+        for pattern, problem in PROBLEM_PATTERNS[vendor]:
+            match = pattern.search(line)
+            if match:
+                problems.append((problem, match.groupdict().get('table')))
+    return problems
+
+
+def existing_indexes(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index'"
+    else:
+        sql = "SELECT indexname FROM pg_indexes"
+    cursor = connection.cursor()
+    cursor.execute(sql)
+    return set(row[0] for row in cursor.fetchall())
+
+
+def propose_indexes(problems, existing=()):
+    """
+    Returns the CREATE INDEX statements of the missing candidate indexes for the scanned tables.
+    """
+    statements = []
+    for problem, table in problems:
+        for name, columns in INDEX_CANDIDATES.get(table, []):
+            if name in existing:
+                continue
+            statement = 'CREATE INDEX "%s" ON "%s" (%s);' % (name, table, ', '.join('"%s"' % c for c in columns))
+            if statement not in statements:
+                statements.append(statement)
+    return statements
+
+
+def advise(user=None, using=DEFAULT_DB_ALIAS):
+    """
+    Explains every representative queryset, returns a list of (name, plan, problems) tuples
+    and the proposed indexes.
+    """
+    vendor = get_vendor(using)
+    if user is None:
+        # The user following the most users has the most expensive feed.
+        user = User.objects.using(using).annotate(Count('follows')).order_by('-follows__count')[0]
+    posts = Post.objects.using(using).order_by('-id')
+    post = posts.filter(replies__isnull=False)[:1] or posts[:1]
+    report = []
+    all_problems = []
+    for name, queryset in representative_querysets(user, post[0]):
+        plan = explain(queryset.using(using))
+        problems = find_problems(plan, vendor)
+        all_problems.extend(problems)
+        report.append((name, plan, problems))
+    return report, propose_indexes(all_problems, existing_indexes(using))
@@ -0,0 +1,140 @@
+"""
+Feed engines, chosen by the FEED_ENGINE setting.
+
+'query' reads the feed with a single query, ORing the user's posts, the posts of the
+users he follows and the posts they shared, which the database can't answer from the
+per user indexes once the feed has to be distinct and sorted.
+
+'merge' reads the newest posts of each source separately (the user's own posts, the posts
+of each followed user and the posts shared by any of them), each one a range read of an
+index on (user, created_date), and merges them with a heap in Python, removing
+duplicates, down to exactly the requested page. The merged feed isn't counted. Its pages
+are read with a (created_date, id) cursor (see microblog_app.paginator.CursorPaginator),
+the filter of the cursor applies to every source, so each one reads a page of posts
+however deep the page is. A page at an offset reads offset + limit posts of every source.
+
+Both return the feed newest first.
+"""
+import heapq
+from datetime import datetime
+from django.conf import settings
+from django.db.models import Q
+from django.utils.timezone import utc
+from microblog_app.models import Follow
+from microblog_app.sharding import for_user
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = EPOCH.replace(tzinfo=utc)
+
+
+def get_engine():
+    return getattr(settings, 'FEED_ENGINE', 'merge')
+
+
+def get_followee_ids(user_id):
+    followed = Follow.objects.filter(follower=user_id, followee__deleted_date__isnull=True)
+    return list(followed.values_list('followee_id', flat=True))
+
+
+def get_feed_q(user_id, followee_ids):
+    """
+    Returns the filter for the posts in the feed, valid for both Post and ArchivedPost.
+    """
+    user_ids = [user_id] + list(followee_ids)
+    return (
+        Q(user__in=user_ids) # Posts made by the user himself or an user he follows
+        | Q(shares__user__in=user_ids) # Or posts shared by any of them
+    )
+
+
+def sort_key(post):
+    """
+    Returns a key that sorts posts newest first.
+    """
+    delta = post.created_date - (EPOCH_UTC if post.created_date.tzinfo else EPOCH)
+    return (-(delta.days * 86400000000 + delta.seconds * 1000000 + delta.microseconds), -post.pk)
+
+
+def merge(streams, start, stop):
+    """
+    Merges streams of posts sorted newest first, skipping the posts already seen, and
+    returns the posts from position start to stop of the merge.
+    """
+    # The stream index breaks ties, so posts and iterators are never compared.
+    heap = []
+    for i, stream in enumerate(streams):
+        iterator = iter(stream)
+        for post in iterator:
+            heap.append((sort_key(post), i, post, iterator))
+            break
+    heapq.heapify(heap)
+
+    seen = set()
+    merged = []
+    while heap and (stop is None or len(merged) < stop):
+        key, i, post, iterator = heap[0]
+        if post.pk not in seen:
+            seen.add(post.pk)
+            merged.append(post)
+        for post in iterator:
+            heapq.heapreplace(heap, (sort_key(post), i, post, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+    return merged[start:]
+
+
+class MergedFeed(object):
+    """
+    Lazy feed of the 'merge' engine, sliced by the paginators like a queryset.
+
+    objects is the queryset the sources are filtered from. At most FEED_MERGE_MAX_STREAMS
+    followed users get a stream of their own, the rest share a single stream. With sharding
+    objects is a FanIn, the stream of each user is read from their shard only.
+    """
+
+    def __init__(self, objects, user_id, followee_ids=None):
+        self.objects = objects.order_by('-created_date', '-id')
+        self.user_id = user_id
+        self.followee_ids = get_followee_ids(user_id) if followee_ids is None else list(followee_ids)
+
+    def filter(self, *args, **kwargs):
+        """
+        Returns the feed of the posts of objects matching the filter, applied to every
+        stream, as the filter of a cursor.
+        """
+        return MergedFeed(self.objects.filter(*args, **kwargs), self.user_id, self.followee_ids)
+
+    def order_by(self, *fields):
+        if fields != ('-created_date', '-id'):
+            raise ValueError('The merged feed is sorted newest first.')
+        return self
+
+    def get_streams(self):
+        max_streams = getattr(settings, 'FEED_MERGE_MAX_STREAMS', 50)
+        user_ids = [self.user_id] + self.followee_ids
+        streams = [for_user(self.objects, user_id).filter(user=user_id) for user_id in user_ids[:max_streams]]
+        if user_ids[max_streams:]:
+            streams.append(self.objects.filter(user__in=user_ids[max_streams:]))
+        streams.append(self.objects.filter(shares__user__in=user_ids).distinct())
+        return streams
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = index.stop
+        if stop is not None:
+            # Every stream needs at most stop posts to fill the page.
+            streams = [stream[:stop] for stream in self.get_streams()]
+        else:
+            streams = self.get_streams()
+        return merge(streams, start, stop)
+
+    def count(self):
+        # Counting would read every post of the feed on every page, see HotColdPaginator.
+        return None
+
+    def exact_count(self):
+        # Counting needs every post of the feed anyway, but no sort.
+        return self.objects.filter(get_feed_q(self.user_id, self.followee_ids)).order_by().values('id').distinct().count()
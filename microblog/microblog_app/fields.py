@@ -0,0 +1,128 @@
+"""
+Drop-in replacements for tastypie fields used by the microblog resources.
+
+Resources (and so their fields) are instantiated once per process and shared by every
+request. Tastypie's related fields keep the related resource of the request being
+processed in ``self.fk_resource``, which is not safe when several requests are served
+concurrently by threads or green threads. The fields defined here keep that state in
+local variables instead.
+
+Related fields that aren't ``full`` build the URI of the related object from the foreign
+key column when they can, so dehydrating them doesn't load the related row. On writes,
+related URIs are hydrated to the pk they contain instead of the related object, see
+ToOneField.hydrate.
+"""
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from tastypie.bundle import Bundle
+from tastypie.exceptions import ApiFieldError
+from tastypie.fields import *
+from tastypie import fields
+from microblog_app.uris import parse_pk
+
+
+class ToOneField(fields.ToOneField):
+
+    def get_related_pk(self, obj):
+        """
+        Returns the related model and the pk of the related object, read from the foreign key
+        column, or raises LookupError if the attribute isn't a foreign key to a pk.
+        """
+        try:
+            field = obj._meta.get_field(self.attribute)
+        except FieldDoesNotExist:
+            raise LookupError(self.attribute)
+        if not isinstance(field, models.ForeignKey) or not field.rel.get_related_field().primary_key:
+            raise LookupError(self.attribute)
+        return field.rel.to, getattr(obj, field.attname)
+
+    def get_uri_resource(self):
+        """
+        Returns an instance of the related resource only used to build URIs, which keeps no
+        request state so it's created once and shared.
+        """
+        if getattr(self, '_uri_resource', None) is None:
+            self._uri_resource = self.get_related_resource(None)
+        return self._uri_resource
+
+    def dehydrate(self, bundle):
+        if not self.full and isinstance(self.attribute, basestring):
+            try:
+                related_model, related_pk = self.get_related_pk(bundle.obj)
+            except LookupError:
+                pass
+            else:
+                if related_pk is None:
+                    if not self.null:
+                        raise ApiFieldError("The model '%r' has an empty attribute '%s' and doesn't allow a null value." % (bundle.obj, self.attribute))
+                    return None
+                fk_resource = self.get_uri_resource()
+                if hasattr(fk_resource, 'get_resource_uri_for_pk'):
+                    return fk_resource.get_resource_uri_for_pk(related_pk)
+                return fk_resource.get_resource_uri(Bundle(obj=related_model(pk=related_pk), request=bundle.request))
+
+        try:
+            foreign_obj = getattr(bundle.obj, self.attribute)
+        except ObjectDoesNotExist:
+            foreign_obj = None
+
+        if not foreign_obj:
+            if not self.null:
+                raise ApiFieldError("The model '%r' has an empty attribute '%s' and doesn't allow a null value." % (bundle.obj, self.attribute))
+            return None
+
+        fk_resource = self.get_related_resource(foreign_obj)
+        fk_bundle = Bundle(obj=foreign_obj, request=bundle.request)
+        return self.dehydrate_related(fk_bundle, fk_resource)
+
+    def hydrate(self, bundle):
+        """
+        Hydrates a URI to an instance of the related model with only the pk parsed from it,
+        instead of getting and dehydrating the related object. The instance keeps the URI
+        in ``_hydrated_uri``, RelatedFieldsMixin.full_hydrate checks it exists and assigns
+        just the foreign key, and RelatedFieldsMixin.save_related doesn't save it.
+        """
+        value = super(fields.ToOneField, self).hydrate(bundle)
+        if value is None:
+            return value
+        if isinstance(value, basestring):
+            fk_resource = self.get_uri_resource()
+            pk = parse_pk(fk_resource, value)
+            if pk is not None:
+                model = fk_resource._meta.object_class
+                # The pk of a child model is a key to its parent's, converted by the parent's pk.
+                pk_field = model._meta.pk
+                while pk_field.rel is not None:
+                    pk_field = pk_field.rel.get_related_field()
+                try:
+                    obj = model(pk=pk_field.to_python(pk))
+                except ValidationError:
+                    raise ApiFieldError("Could not find the provided object via resource URI '%s'." % value)
+                obj._hydrated_uri = value
+                return Bundle(obj=obj, request=bundle.request)
+        return self.build_related_resource(value, request=bundle.request)
+
+    def build_related_resource(self, value, request=None, related_obj=None, related_name=None):
+        fk_resource = self.to_class()
+        kwargs = {
+            'request': request,
+            'related_obj': related_obj,
+            'related_name': related_name,
+        }
+
+        if isinstance(value, basestring):
+            return self.resource_from_uri(fk_resource, value, **kwargs)
+        elif hasattr(value, 'items'):
+            return self.resource_from_data(fk_resource, value, **kwargs)
+        elif hasattr(value, 'pk'):
+            return self.resource_from_pk(fk_resource, value, **kwargs)
+        else:
+            raise ApiFieldError("The '%s' field has was given data that was not a URI, not a dictionary-alike and does not have a 'pk' attribute: %s." % (self.instance_name, value))
+
+
+class ForeignKey(ToOneField):
+    """
+    A convenience subclass for those who prefer to mirror ``django.db.models``.
+    """
+    pass
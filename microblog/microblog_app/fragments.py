@@ -0,0 +1,86 @@
+"""
+Cache of the dehydrated public fields of users, the fragment embedded as the author of
+every post, so a feed page dehydrates (and counts the followers, following and posts of)
+each author once instead of once per post.
+
+Fragments are keyed by user id and version. Saving a user, and any change to their
+counters (a follow, unfollow, post or purged post), increments the version instead of
+deleting the fragment, so a fragment cached by a request racing with the change is never
+read again. Versions start from the current time in milliseconds, which keeps them
+increasing when a version is evicted from the cache.
+
+Within a request fragments are also kept on the request, so the repeated authors of a
+page only read the cache once. Fields that depend on the request's user (see
+UserResource.viewer_fields) are never cached, they are dehydrated on top of the fragment.
+
+Versions are only shared by the workers when the cache is (memcached). With a per process
+cache a change made by another worker isn't seen until the fragment expires, so fragments
+are then kept USER_FRAGMENT_LOCAL_TIMEOUT seconds only.
+"""
+import time
+from django.conf import settings
+from django.core.cache import cache
+from microblog_app import cache_backends
+
+
+def get_timeout():
+    """
+    Seconds a fragment stays cached, from the USER_FRAGMENT_TIMEOUT setting, or the
+    USER_FRAGMENT_LOCAL_TIMEOUT one when the cache is per process.
+    """
+    if cache_backends.is_shared():
+        return getattr(settings, 'USER_FRAGMENT_TIMEOUT', 3600)
+    return getattr(settings, 'USER_FRAGMENT_LOCAL_TIMEOUT', 5)
+
+
+def get_version_key(user_id):
+    return 'user_fragment_version:%s' % user_id
+
+
+def get_version(user_id):
+    key = get_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate(user_id):
+    """
+    Makes the cached fragment of the user stale.
+    """
+    try:
+        cache.incr(get_version_key(user_id))
+    except ValueError:
+        # Not cached, the next read starts a new version.
+        pass
+
+
+def get_request_fragments(request):
+    if request is None:
+        return {}
+    if not hasattr(request, '_user_fragments'):
+        request._user_fragments = {}
+    return request._user_fragments
+
+
+def get_fragment(user_id, request=None):
+    """
+    Returns the fragment of the user and its version, the fragment is None if it isn't
+    cached and has to be stored with set_fragment and that version.
+    """
+    fragments = get_request_fragments(request)
+    if user_id in fragments:
+        return fragments[user_id], None
+    version = get_version(user_id)
+    fragment = cache.get('user_fragment:%s:%s' % (user_id, version))
+    if fragment is not None:
+        fragments[user_id] = fragment
+    return fragment, version
+
+
+def set_fragment(user_id, version, fragment, request=None):
+    # The version is read before dehydrating, so a change made meanwhile makes it stale.
+    get_request_fragments(request)[user_id] = fragment
+    cache.set('user_fragment:%s:%s' % (user_id, version), fragment, get_timeout())
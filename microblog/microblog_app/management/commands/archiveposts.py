@@ -0,0 +1,22 @@
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from microblog_app.archive import archive_posts
+
+
+class Command(BaseCommand):
+    help = 'Moves old posts, with their likes and shares, to the archive tables in small chunks.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+            help='Archive posts older than this many days, defaults to the POST_ARCHIVE_AGE_DAYS setting.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            help='Posts moved per transaction, defaults to the POST_ARCHIVE_CHUNK_SIZE setting.'),
+        make_option('--pause', type='float', dest='pause', default=0,
+            help='Seconds to sleep between chunks, to throttle the load on the database.'),
+    )
+
+    def handle(self, *args, **options):
+        age = timedelta(days=options['days']) if options['days'] else None
+        total = archive_posts(age=age, chunk_size=options['chunk_size'], pause=options['pause'])
+        self.stdout.write('Archived %i posts\n' % total)
@@ -0,0 +1,20 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from microblog_app.tags import backfill_tags
+
+
+class Command(BaseCommand):
+    help = 'Extracts the hashtags and mentions of existing posts in small chunks.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start-id', type='int', dest='start_id', default=0,
+            help='Only index posts with a greater id, to resume an interrupted backfill.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            help='Posts indexed per transaction, defaults to the TAGS_BACKFILL_CHUNK_SIZE setting.'),
+        make_option('--pause', type='float', dest='pause', default=0,
+            help='Seconds to sleep between chunks, to throttle the load on the database.'),
+    )
+
+    def handle(self, *args, **options):
+        chunks = backfill_tags(start_id=options['start_id'], chunk_size=options['chunk_size'], pause=options['pause'])
+        self.stdout.write('Indexed %i chunks of posts\n' % chunks)
@@ -0,0 +1,67 @@
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from microblog_app.benchmarks import SCALES, run, compare
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the feed, post search, dehydrating posts and API key authentication on '
+            'new test databases seeded at several scales, and compares them with a baseline.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scales', dest='scales', default='small,medium',
+            help='Comma separated scales to run, of %s.' % ', '.join(sorted(SCALES, key=SCALES.get))),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+            help='Timed runs of each benchmark, the median is recorded.'),
+        make_option('--output', dest='output',
+            help='File to save the results to, as a JSON baseline.'),
+        make_option('--compare', dest='compare',
+            help='Baseline file to compare the results with, fails if any regressed.'),
+        make_option('--threshold', type='float', dest='threshold', default=0.2,
+            help='Fraction a time or memory has to grow by to be a regression, defaults to 0.2.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database whose test database is created for each scale, defaults to the default database.'),
+    )
+
+    def format_metric(self, metric, value):
+        if value is None:
+            return '-'
+        if metric == 'time':
+            return '%.2f ms' % (value * 1000)
+        if metric == 'memory':
+            return '%i KB' % value
+        return '%i' % value
+
+    def handle(self, *args, **options):
+        scales = [scale.strip() for scale in options['scales'].split(',') if scale.strip()]
+        for scale in scales:
+            if scale not in SCALES:
+                raise CommandError("Unknown scale '%s'." % scale)
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (IOError, ValueError), e:
+                raise CommandError("Can't read the baseline: %s" % e)
+
+        results = run(scales, options['repeat'], options['database'])
+        for scale in scales:
+            for name, metrics in sorted(results[scale]['benchmarks'].items()):
+                self.stdout.write('%-8s %-18s %12s %4s queries %10s\n' % (
+                    scale, name, self.format_metric('time', metrics['time']), metrics['queries'],
+                    self.format_metric('memory', metrics['memory'])))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+        if baseline is not None:
+            regressions = compare(baseline, results, options['threshold'])
+            for scale, name, metric, old, new in regressions:
+                self.stdout.write('REGRESSION %s %s %s: %s -> %s\n' % (
+                    scale, name, metric, self.format_metric(metric, old), self.format_metric(metric, new)))
+            if regressions:
+                raise CommandError('%i metrics regressed.' % len(regressions))
+            self.stdout.write('No regressions\n')
@@ -0,0 +1,41 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from microblog_app.explain import advise, seed
+
+
+class Command(BaseCommand):
+    help = ('Explains the queries behind each API endpoint, flags sequential scans and sorts '
+            'and proposes the indexes that avoid them.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Add this many random users, with their posts, follows, likes and shares, before explaining.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to explain the queries on, defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        verbosity = int(options['verbosity'])
+        if options['seed']:
+            seeded = seed(options['seed'], using=using)
+            self.stdout.write('Seeded %i users\n' % seeded)
+        try:
+            report, indexes = advise(using=using)
+        except ValueError, e:
+            raise CommandError(str(e))
+        except IndexError:
+            raise CommandError('The database has no users or posts, use --seed to add some.')
+
+        for name, plan, problems in report:
+            summary = ', '.join('%s%s' % (problem, ' on %s' % table if table else '') for problem, table in problems)
+            self.stdout.write('%s: %s\n' % (name, summary or 'ok'))
+            if verbosity > 1 or (problems and verbosity > 0):
+                for line in plan:
+                    self.stdout.write('    %s\n' % line)
+
+        if indexes:
+            self.stdout.write('\nProposed indexes:\n')
+            for statement in indexes:
+                self.stdout.write('%s\n' % statement)
@@ -0,0 +1,64 @@
+import sys
+from optparse import make_option
+from dateutil import parser
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.timezone import is_naive, make_aware, get_current_timezone
+from microblog_app.models import User
+from microblog_app.ndjson import export_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Exports users, posts, follows, likes and shares as NDJSON, one row per line.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--user', action='append', dest='users', default=[],
+            help='Id or username of a user to export, can be repeated. Defaults to every user.'),
+        make_option('--since', dest='since',
+            help='Only export rows created on or after this date.'),
+        make_option('--until', dest='until',
+            help='Only export rows created before this date.'),
+        make_option('--output', dest='output',
+            help='File to write to, defaults to the standard output.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='Rows fetched from the database at a time.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to export from, defaults to the default database and the shards.'),
+    )
+
+    def get_user_ids(self, users):
+        user_ids = []
+        for user in users:
+            if user.isdigit():
+                user_ids.append(int(user))
+            else:
+                try:
+                    user_ids.append(User.objects.get(username=user).pk)
+                except User.DoesNotExist:
+                    raise CommandError("User '%s' does not exist." % user)
+        return user_ids
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        try:
+            date = parser.parse(value)
+        except ValueError:
+            raise CommandError("Invalid date '%s'." % value)
+        if settings.USE_TZ and is_naive(date):
+            date = make_aware(date, get_current_timezone())
+        return date
+
+    def handle(self, *args, **options):
+        user_ids = self.get_user_ids(options['users'])
+        out = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            counts = export_ndjson(out, user_ids=user_ids, since=self.parse_date(options['since']),
+                until=self.parse_date(options['until']), chunk_size=options['chunk_size'],
+                using=options['database'])
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        # The counts go to stderr, stdout may be the export itself.
+        sys.stderr.write('Exported %s\n' % ', '.join('%i %ss' % (counts[name], name) for name in sorted(counts)))
@@ -0,0 +1,30 @@
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from microblog_app.ndjson import import_ndjson
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Imports an NDJSON export of exportndjson, reads the standard input if the file is -.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Rows inserted per statement and transaction.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to import to, defaults to the default database and the shards.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: importndjson %s' % self.args)
+        lines = sys.stdin if args[0] == '-' else open(args[0])
+        try:
+            counts = import_ndjson(lines, batch_size=options['batch_size'], using=options['database'])
+        except ValueError, e:
+            raise CommandError(str(e))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        self.stdout.write('Imported %s\n' % ', '.join('%i %ss' % (counts[name], name) for name in sorted(counts)))
@@ -0,0 +1,44 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+import microblog
+from microblog.startup import PHASES
+
+
+class Command(BaseCommand):
+    help = 'Measures the startup of a worker, every run in a new process (see microblog.startup).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--runs', type='int', dest='runs', default=5,
+            help='Startups measured, the median of each phase is reported.'),
+        make_option('--profile', type='int', dest='profile', default=0,
+            help='Print the calls with the highest cumulative time of a startup instead, this many of them.'),
+    )
+
+    def run_startup(self, *args):
+        project_dir = os.path.dirname(os.path.dirname(os.path.abspath(microblog.__file__)))
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'microblog.settings'))
+        return subprocess.check_output([sys.executable, '-m', 'microblog.startup'] + list(args), cwd=project_dir, env=env)
+
+    def handle(self, *args, **options):
+        if options['profile']:
+            self.stdout.write(self.run_startup('--profile', str(options['profile'])))
+            return
+
+        timings = dict((name, []) for name, phase in PHASES)
+        timings['process'] = []
+        for i in range(options['runs']):
+            start = time.time()
+            output = self.run_startup()
+            # The whole process, including the interpreter startup.
+            timings['process'].append(time.time() - start)
+            for name, seconds in json.loads(output):
+                timings[name].append(seconds)
+
+        for name in [name for name, phase in PHASES] + ['process']:
+            values = sorted(timings[name])
+            self.stdout.write('%-12s %8.1f ms\n' % (name, values[len(values) // 2] * 1000))
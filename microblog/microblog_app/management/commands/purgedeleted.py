@@ -0,0 +1,22 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from microblog_app.models import Purge
+from microblog_app.purge import purge_deleted
+
+
+class Command(BaseCommand):
+    help = 'Purges the rows of deleted users and posts in small chunks.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            help='Rows deleted per transaction, defaults to the PURGE_CHUNK_SIZE setting.'),
+        make_option('--pause', type='float', dest='pause', default=0,
+            help='Seconds to sleep between chunks, to throttle the load on the database.'),
+    )
+
+    def handle(self, *args, **options):
+        total = purge_deleted(chunk_size=options['chunk_size'], pause=options['pause'])
+        self.stdout.write('Purged %i rows\n' % total)
+        pending = Purge.objects.filter(finished_date__isnull=True).count()
+        if pending:
+            self.stdout.write('%i purges pending\n' % pending)
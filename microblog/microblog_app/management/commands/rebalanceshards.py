@@ -0,0 +1,18 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from microblog_app.sharding import rebalance
+
+
+class Command(BaseCommand):
+    help = 'Copies the users to every shard and moves the posts and notifications stored out of their shard.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+            help='Rows moved per chunk.'),
+        make_option('--pause', type='float', dest='pause', default=0,
+            help='Seconds to sleep between chunks, to throttle the load on the databases.'),
+    )
+
+    def handle(self, *args, **options):
+        moved = rebalance(chunk_size=options['chunk_size'], pause=options['pause'])
+        self.stdout.write('Moved %i posts and %i notifications\n' % (moved['Post'], moved['Notification']))
@@ -0,0 +1,16 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from microblog_app.rollups import rollup
+
+
+class Command(BaseCommand):
+    help = 'Rolls up the posts, likes, shares and follows created since the last run into the daily stats of each user.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            help='Rows rolled up per transaction, defaults to the ROLLUP_CHUNK_SIZE setting.'),
+    )
+
+    def handle(self, *args, **options):
+        total = rollup(chunk_size=options['chunk_size'])
+        self.stdout.write('Rolled up %i rows\n' % total)
@@ -0,0 +1,25 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from microblog_app import shared_cache
+from microblog_app.benchmarks import stress_shared_cache
+
+
+class Command(BaseCommand):
+    help = ('Reads the most recent posts from forked workers sharing the cache of SHARED_CACHE_PATH, '
+            'and reports its hit rate and memory for each number of workers.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', default='1,2,4,8',
+            help='Comma separated numbers of workers to run.'),
+        make_option('--reads', type='int', dest='reads', default=1000,
+            help='Posts read by each worker.'),
+        make_option('--hot', type='int', dest='hot', default=100,
+            help='Number of recent posts read.'),
+    )
+
+    def handle(self, *args, **options):
+        if shared_cache.get_cache() is None:
+            raise CommandError('The shared cache is disabled, set SHARED_CACHE_PATH.')
+        worker_counts = [int(workers) for workers in options['workers'].split(',') if workers.strip()]
+        for workers, hit_rate, memory in stress_shared_cache(worker_counts, options['reads'], options['hot']):
+            self.stdout.write('%3i workers %6.1f%% hits %8i KB\n' % (workers, hit_rate * 100, memory))
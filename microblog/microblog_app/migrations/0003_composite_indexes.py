@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+# Same names as in sql/post.sql and sql/follow.sql, which create them on syncdb.
+INDEXES = (
+    ('microblog_app_post_user_created', 'microblog_app_post', ('user_id', 'created_date')),
+    ('microblog_app_follow_followee_follower', 'microblog_app_follow', ('followee_id', 'follower_id')),
+)
+
+
+class Migration(SchemaMigration):
+    """
+    Adds the composite indexes proposed by the explainqueries command, for the posts of a
+    user by date (feed, user posts) and the followers of a user, and drops the index on
+    Post.text, which the icontains searches can't use.
+    """
+
+    def forwards(self, orm):
+        for name, table, columns in INDEXES:
+            db.execute('CREATE INDEX "%s" ON "%s" (%s)' % (name, table, ', '.join('"%s"' % c for c in columns)))
+        # Django names its indexes with a hash, and adds a varchar_pattern_ops one on PostgreSQL.
+        if db.backend_name == 'postgres':
+            rows = db.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'microblog_app_post' "
+                              "AND indexdef LIKE %s", ['%(text%'])
+            for (name,) in rows:
+                db.execute('DROP INDEX "%s"' % name)
+
+    def backwards(self, orm):
+        for name, table, columns in INDEXES:
+            db.execute('DROP INDEX "%s"' % name)
+        db.create_index('microblog_app_post', ['text'])
+
+    models = {}
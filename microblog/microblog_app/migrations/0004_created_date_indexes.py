@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+TABLES = ('microblog_app_post', 'microblog_app_follow', 'microblog_app_like', 'microblog_app_share')
+
+
+class Migration(SchemaMigration):
+    """
+    Indexes the created_date of posts, follows, likes and shares, for the date drill-down
+    of the admin changelists.
+    """
+
+    def forwards(self, orm):
+        for table in TABLES:
+            db.create_index(table, ['created_date'])
+
+    def backwards(self, orm):
+        for table in TABLES:
+            db.delete_index(table, ['created_date'])
+
+    models = {}
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+    """
+    Indexes the email of users, the signup availability check confirms the hits of its
+    filter with it (see microblog_app.availability).
+    """
+
+    def forwards(self, orm):
+        db.execute('CREATE INDEX "microblog_app_user_email" ON "auth_user" ("email")')
+
+    def backwards(self, orm):
+        db.execute('DROP INDEX "microblog_app_user_email"')
+
+    models = {}
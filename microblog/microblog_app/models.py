@@ -1,10 +1,16 @@
-from django.db import models
+import re
+from django.db import models, router, transaction, IntegrityError, DEFAULT_DB_ALIAS
 from django.contrib import auth
 from django.core.exceptions import ValidationError
 from django.utils.timezone import now
 from django.core.mail import send_mail
 from tastypie.models import create_api_key
 from uuidfield import UUIDField
+from microblog_app import availability
+from microblog_app import fragments
+from microblog_app import shared_cache
+from microblog_app import sharding
+from microblog_app.tokens import revoke_tokens, forget_generation
 
 
 class User(auth.models.User):
@@ -14,7 +20,11 @@ class User(auth.models.User):
     shares = models.ManyToManyField('Post', through='Share', blank=True, related_name="shared_by")
 
     avatar_url = models.URLField(blank=True)
-    
+    # Incremented to revoke the access tokens issued so far, see microblog_app.tokens.
+    token_generation = models.PositiveIntegerField(default=0)
+    # Set when the user is deleted, their content is hidden at once and purged later, see microblog_app.purge.
+    deleted_date = models.DateTimeField("date deleted", blank=True, null=True)
+
     def following_count(self):
         return self.follows.count()
 
@@ -45,9 +55,12 @@ models.signals.post_save.connect(create_api_key, sender=User)
 class Post(models.Model):
     user = models.ForeignKey(User, related_name='posts')
     in_reply_to = models.ForeignKey('Post', related_name='replies', blank=True, null=True)
-    text = models.CharField(max_length=200, db_index=True)
-    created_date = models.DateTimeField("date created", auto_now_add=True)
+    text = models.CharField(max_length=200)
+    # Indexed for the date drill-down of the admin changelists, as Follow, Like and Share.
+    created_date = models.DateTimeField("date created", auto_now_add=True, db_index=True)
     modified_date = models.DateTimeField("date modified", auto_now=True)    
+    # Set when the post is deleted, it's hidden at once and purged later, see microblog_app.purge.
+    deleted_date = models.DateTimeField("date deleted", blank=True, null=True)
 
     def liked_by_count(self):
         return self.liked_by.count()
@@ -56,7 +69,8 @@ class Post(models.Model):
         return self.shared_by.count()
 
     def replies_count(self):
-        return self.replies.count()
+        # Replies are stored in the shards of their authors.
+        return sharding.fan_in(Post.objects.filter(in_reply_to=self.pk)).count()
 
     def __unicode__(self):
         return self.text
@@ -69,7 +83,7 @@ class Follow(models.Model):
 
     follower = models.ForeignKey(User, related_name='follows_follower')
     followee = models.ForeignKey(User, related_name='follows_followee')
-    created_date = models.DateTimeField(blank=True, auto_now_add=True)
+    created_date = models.DateTimeField(blank=True, auto_now_add=True, db_index=True)
 
     def __unicode__(self):
         return str(self.follower) + ' follows ' + str(self.followee)
@@ -90,7 +104,7 @@ class Like(models.Model):
 
     user = models.ForeignKey(User)
     post = models.ForeignKey(Post, related_name='likes')
-    created_date = models.DateTimeField("date created", auto_now_add=True)
+    created_date = models.DateTimeField("date created", auto_now_add=True, db_index=True)
 
     def __unicode__(self):
         return str(self.user) + ' likes ' + str(self.post)
@@ -103,11 +117,498 @@ class Share(models.Model):
 
     user = models.ForeignKey(User)
     post = models.ForeignKey(Post, related_name='shares')
-    created_date = models.DateTimeField("date created", auto_now_add=True)
+    created_date = models.DateTimeField("date created", auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return str(self.user) + ' shares ' + str(self.post)
+
+class ArchivedPost(models.Model):
+    """
+    Cold storage for old posts, moved out of the Post table by microblog_app.archive so the
+    hot table (and its indexes) only holds recent posts. Archived posts keep their original id.
+    Replies keep the id of the post they reply to, which may still be in the Post table.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(User, related_name='archived_posts')
+    in_reply_to_id = models.IntegerField(blank=True, null=True, db_index=True)
+    text = models.CharField(max_length=200)
+    created_date = models.DateTimeField("date created", db_index=True)
+    modified_date = models.DateTimeField("date modified")
+
+    @property
+    def in_reply_to(self):
+        if self.in_reply_to_id is None:
+            return None
+        try:
+            return sharding.fan_in(Post.objects.all()).get(pk=self.in_reply_to_id)
+        except Post.DoesNotExist:
+            return ArchivedPost.objects.get(pk=self.in_reply_to_id)
+
+    def liked_by_count(self):
+        return self.likes.count()
+
+    def shared_by_count(self):
+        return self.shares.count()
+
+    def replies_count(self):
+        return sharding.fan_in(Post.objects.filter(in_reply_to=self.pk)).count() + ArchivedPost.objects.filter(in_reply_to_id=self.pk).count()
+
+    def __unicode__(self):
+        return self.text
+
+
+class ArchivedLike(models.Model):
+
+    class Meta:
+        unique_together = ("user", "post")
+
+    user = models.ForeignKey(User)
+    post = models.ForeignKey(ArchivedPost, related_name='likes')
+    created_date = models.DateTimeField("date created")
+
+    def __unicode__(self):
+        return str(self.user) + ' likes ' + str(self.post)
+
+
+class ArchivedShare(models.Model):
+
+    class Meta:
+        unique_together = ("user", "post")
+
+    user = models.ForeignKey(User)
+    post = models.ForeignKey(ArchivedPost, related_name='shares')
+    created_date = models.DateTimeField("date created")
 
     def __unicode__(self):
         return str(self.user) + ' shares ' + str(self.post)
 
+
+class Notification(models.Model):
+    """
+    An entry of a user's notifications inbox. Notifications are grouped when they are
+    written: while unread, every like, share or reply of the same post (or every follow)
+    updates the same notification, which counts the actors (see NotificationActor) and
+    keeps the latest one. There's a single unread notification of a kind and post per
+    user (see sql/notification.sql).
+    """
+    LIKE = 'like'
+    SHARE = 'share'
+    REPLY = 'reply'
+    FOLLOW = 'follow'
+    KIND_CHOICES = (
+        (LIKE, 'Like'),
+        (SHARE, 'Share'),
+        (REPLY, 'Reply'),
+        (FOLLOW, 'Follow'),
+    )
+
+    user = models.ForeignKey(User, related_name='notifications')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    post = models.ForeignKey(Post, related_name='notifications', blank=True, null=True)
+    actor = models.ForeignKey(User, related_name='+')
+    actors_count = models.PositiveIntegerField(default=1)
+    read = models.BooleanField(default=False)
+    created_date = models.DateTimeField("date created", auto_now_add=True)
+    # Date of the latest event of the group, the inbox is ordered by it (see sql/notification.sql).
+    modified_date = models.DateTimeField("date modified")
+
+    def __unicode__(self):
+        return '%s %s' % (self.actors_count, self.kind)
+
+
+class NotificationActor(models.Model):
+    """
+    A user counted by a notification, so repeated events of the same user (replying twice,
+    liking a post again) are counted once. Stored with its notification.
+    """
+    notification = models.ForeignKey(Notification, related_name='actors')
+    actor = models.ForeignKey(User, related_name='+')
+
+    class Meta:
+        unique_together = ('notification', 'actor')
+
+    def __unicode__(self):
+        return '%s %s' % (self.notification_id, self.actor_id)
+
+
+def save_unique(obj, using):
+    """
+    Saves the object, returns False instead if it breaks a constraint.
+    """
+    with transaction.commit_on_success(using=using):
+        sid = transaction.savepoint(using=using)
+        try:
+            obj.save(using=using)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            return False
+        transaction.savepoint_commit(sid, using=using)
+    return True
+
+
+def notify(user_id, kind, actor_id, post_id=None):
+    """
+    Adds an event to the user's inbox, grouping it with the unread notification of the same
+    kind and post if there's one. The actors count of the notification is only incremented
+    for actors it didn't count yet.
+    """
+    if user_id == actor_id:
+        return
+    notification = Notification(user_id=user_id, kind=kind, actor_id=actor_id, post_id=post_id, modified_date=now())
+    # The shard of the user.
+    using = router.db_for_write(Notification, instance=notification)
+    groups = Notification.objects.using(using).filter(user=user_id, kind=kind, post=post_id, read=False)
+    for attempt in range(2):
+        group_ids = list(groups.values_list('pk', flat=True)[:1])
+        if group_ids:
+            values = {'actor': actor_id, 'modified_date': now()}
+            if save_unique(NotificationActor(notification_id=group_ids[0], actor_id=actor_id), using):
+                values['actors_count'] = models.F('actors_count') + 1
+            groups.filter(pk=group_ids[0]).update(**values)
+            return
+        # Fails if a concurrent event created the group meanwhile, which is then updated.
+        if save_unique(notification, using):
+            NotificationActor(notification=notification, actor_id=actor_id).save(using=using)
+            return
+
+
+def get_author_id(post_id, fetch):
+    # The author of a post never changes, popular posts are read from the shared cache.
+    return shared_cache.get_or_fetch(Post, post_id, fetch).user_id
+
+
+def notify_like(sender, instance, created, **kwargs):
+    if created:
+        notify(get_author_id(instance.post_id, lambda: instance.post), Notification.LIKE, instance.user_id, instance.post_id)
+
+
+def notify_share(sender, instance, created, **kwargs):
+    if created:
+        notify(get_author_id(instance.post_id, lambda: instance.post), Notification.SHARE, instance.user_id, instance.post_id)
+
+
+def notify_reply(sender, instance, created, **kwargs):
+    if created and instance.in_reply_to_id:
+        notify(get_author_id(instance.in_reply_to_id, lambda: instance.in_reply_to), Notification.REPLY, instance.user_id, instance.in_reply_to_id)
+
+
+def notify_follow(sender, instance, created, **kwargs):
+    if created:
+        notify(instance.followee_id, Notification.FOLLOW, instance.follower_id)
+
+# Write the notifications when the events happen, so reading the inbox is a single query.
+models.signals.post_save.connect(notify_like, sender=Like)
+models.signals.post_save.connect(notify_share, sender=Share)
+models.signals.post_save.connect(notify_reply, sender=Post)
+models.signals.post_save.connect(notify_follow, sender=Follow)
+
+
+class DailyStats(models.Model):
+    """
+    Per user and day (UTC) counts of the user's activity, rolled up from the raw rows by
+    microblog_app.rollups. Unfollows are counted when they happen, the rows are deleted.
+    """
+    user = models.ForeignKey(User, related_name='daily_stats')
+    date = models.DateField()
+    posts = models.PositiveIntegerField(default=0)
+    likes_received = models.PositiveIntegerField(default=0)
+    shares_received = models.PositiveIntegerField(default=0)
+    replies_received = models.PositiveIntegerField(default=0)
+    followers_gained = models.PositiveIntegerField(default=0)
+    followers_lost = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'date')
+
+    def __unicode__(self):
+        return '%s %s' % (self.user_id, self.date)
+
+
+def add_daily_stats(user_id, date, **counts):
+    """
+    Adds the counts to the user's stats of the date.
+    """
+    updated = DailyStats.objects.filter(user=user_id, date=date).update(
+        **dict((name, models.F(name) + count) for name, count in counts.items()))
+    if not updated:
+        DailyStats.objects.create(user_id=user_id, date=date, **counts)
+
+
+def count_unfollow(sender, instance, **kwargs):
+    add_daily_stats(instance.followee_id, now().date(), followers_lost=1)
+
+models.signals.post_delete.connect(count_unfollow, sender=Follow)
+
+
+class Hashtag(models.Model):
+    """
+    A #hashtag found in the text of posts, lowercased.
+    """
+    name = models.CharField(max_length=100, unique=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+class PostTag(models.Model):
+    """
+    A hashtag of a post. The post's created_date is copied so the posts of a hashtag are
+    read newest first from a single index (see sql/posttag.sql).
+    """
+    # Indexed with created_date in sql/posttag.sql, as Mention.user.
+    hashtag = models.ForeignKey(Hashtag, related_name='post_tags', db_index=False)
+    post = models.ForeignKey(Post, related_name='tags')
+    created_date = models.DateTimeField("date created")
+
+    class Meta:
+        unique_together = ('post', 'hashtag')
+
+    def __unicode__(self):
+        return '%s #%s' % (self.post_id, self.hashtag_id)
+
+
+class Mention(models.Model):
+    """
+    An @username of a post that names an existing user.
+    """
+    user = models.ForeignKey(User, related_name='mentions', db_index=False)
+    post = models.ForeignKey(Post, related_name='mentions')
+    created_date = models.DateTimeField("date created")
+
+    class Meta:
+        unique_together = ('post', 'user')
+
+    def __unicode__(self):
+        return '%s @%s' % (self.post_id, self.user_id)
+
+
+class ArchivedPostTag(models.Model):
+    """
+    A hashtag of an archived post, moved out of the PostTag table by microblog_app.archive
+    with its original id.
+    """
+    id = models.IntegerField(primary_key=True)
+    # Indexed with created_date in sql/archivedposttag.sql, as PostTag.hashtag.
+    hashtag = models.ForeignKey(Hashtag, related_name='archived_post_tags', db_index=False)
+    post = models.ForeignKey(ArchivedPost, related_name='tags')
+    created_date = models.DateTimeField("date created")
+
+    class Meta:
+        unique_together = ('post', 'hashtag')
+
+    def __unicode__(self):
+        return '%s #%s' % (self.post_id, self.hashtag_id)
+
+
+class ArchivedMention(models.Model):
+    """
+    A mention of an archived post, moved out of the Mention table by microblog_app.archive
+    with its original id.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(User, related_name='archived_mentions', db_index=False)
+    post = models.ForeignKey(ArchivedPost, related_name='mentions')
+    created_date = models.DateTimeField("date created")
+
+    class Meta:
+        unique_together = ('post', 'user')
+
+    def __unicode__(self):
+        return '%s @%s' % (self.post_id, self.user_id)
+
+
+HASHTAG_RE = re.compile(r'(?<!\w)#(\w+)', re.UNICODE)
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)', re.UNICODE)
+
+
+def index_posts(posts, created=False, using=DEFAULT_DB_ALIAS):
+    """
+    Writes the hashtags and mentions of the posts, replacing the ones they had unless the
+    posts were just created. Posts of a shard are indexed in the shard, with using.
+    """
+    tags = {}
+    mentions = {}
+    for post in posts:
+        tags[post] = set(name.lower() for name in HASHTAG_RE.findall(post.text) if len(name) <= 100)
+        mentions[post] = set(MENTION_RE.findall(post.text))
+    if not created:
+        post_ids = [post.pk for post in posts]
+        PostTag.objects.using(using).filter(post__in=post_ids).delete()
+        Mention.objects.using(using).filter(post__in=post_ids).delete()
+
+    names = set().union(*tags.values())
+    if names:
+        hashtags = dict(Hashtag.objects.filter(name__in=names).values_list('name', 'id'))
+        for name in names.difference(hashtags):
+            hashtags[name] = Hashtag.objects.get_or_create(name=name)[0].pk
+        post_tags = [
+            PostTag(hashtag_id=hashtags[name], post_id=post.pk, created_date=post.created_date)
+            for post, post_names in tags.items() for name in post_names]
+        sharding.assign_ids(post_tags)
+        PostTag.objects.using(using).bulk_create(post_tags)
+
+    usernames = set().union(*mentions.values())
+    if usernames:
+        users = User.objects.filter(username__in=usernames, deleted_date__isnull=True)
+        user_ids = dict(users.values_list('username', 'id'))
+        post_mentions = [
+            Mention(user_id=user_ids[username], post_id=post.pk, created_date=post.created_date)
+            for post, post_usernames in mentions.items() for username in post_usernames if username in user_ids]
+        sharding.assign_ids(post_mentions)
+        Mention.objects.using(using).bulk_create(post_mentions)
+
+
+def index_post(sender, instance, created, using=DEFAULT_DB_ALIAS, **kwargs):
+    index_posts([instance], created, using)
+
+# Write the hashtags and mentions with the post, so the posts of a hashtag or mentioning a
+# user are read from an index instead of searching the text.
+models.signals.post_save.connect(index_post, sender=Post)
+
+
+def invalidate_user_fragment(sender, instance, **kwargs):
+    fragments.invalidate(instance.pk)
+
+
+def invalidate_author_fragment(sender, instance, **kwargs):
+    # Sent on save and delete, only created and deleted posts change the posts count.
+    if kwargs.get('created', True):
+        fragments.invalidate(instance.user_id)
+
+
+def invalidate_follow_fragments(sender, instance, **kwargs):
+    if kwargs.get('created', True):
+        fragments.invalidate(instance.follower_id)
+        fragments.invalidate(instance.followee_id)
+
+# The cached fragments of users include their fields and counters, see microblog_app.fragments.
+models.signals.post_save.connect(invalidate_user_fragment, sender=User)
+models.signals.post_save.connect(invalidate_author_fragment, sender=Post)
+models.signals.post_delete.connect(invalidate_author_fragment, sender=Post)
+models.signals.post_save.connect(invalidate_follow_fragments, sender=Follow)
+models.signals.post_delete.connect(invalidate_follow_fragments, sender=Follow)
+
+
+class RollupWatermark(models.Model):
+    """
+    Last row of a table (in a database, with sharding) already rolled up into DailyStats,
+    by created_date and id.
+    """
+    name = models.CharField(max_length=30, unique=True)
+    last_id = models.PositiveIntegerField(default=0)
+    # Null for the watermarks of ids only, from before rows were rolled up by date.
+    last_date = models.DateTimeField(blank=True, null=True)
+    modified_date = models.DateTimeField("date modified", auto_now=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.name, self.last_id)
+
+
+class Purge(models.Model):
+    """
+    A deleted user or post whose rows are still being purged by microblog_app.purge,
+    with the progress of the purge.
+    """
+    USER = 'user'
+    POST = 'post'
+    KIND_CHOICES = (
+        (USER, 'User'),
+        (POST, 'Post'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Not a foreign key, the purged object is deleted before the purge is finished.
+    object_id = models.PositiveIntegerField()
+    deleted_rows = models.PositiveIntegerField(default=0)
+    # Highest id of the posts of the deleted user added to the thread (see PurgedPost).
+    last_post_id = models.PositiveIntegerField(default=0)
+    created_date = models.DateTimeField("date created", auto_now_add=True)
+    modified_date = models.DateTimeField("date modified", auto_now=True)
+    finished_date = models.DateTimeField("date finished", blank=True, null=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.kind, self.object_id)
+
+
+class PurgedPost(models.Model):
+    """
+    A post of the thread of a Purge: the deleted post, or the posts of the deleted user,
+    and their replies, recursively. Replies are added one level at a time, and the rows
+    are deleted with their posts, so each chunk of the purge reads a bounded number of them.
+    """
+    purge = models.ForeignKey(Purge, related_name='posts')
+    # Not a foreign key, the post can be in any shard.
+    post_id = models.PositiveIntegerField()
+    # Level of the post in the thread, replies are purged before the posts they reply to.
+    depth = models.PositiveIntegerField(default=0)
+    # Set once its replies are added to the thread.
+    expanded = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('purge', 'post_id')
+
+    def __unicode__(self):
+        return '%s %s' % (self.purge_id, self.post_id)
+
+
+class ShardSequence(models.Model):
+    """
+    Next id of a sharded table, ids are reserved in blocks by microblog_app.sharding so they
+    are unique across shards.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    next_id = models.PositiveIntegerField()
+
+    def __unicode__(self):
+        return '%s %s' % (self.name, self.next_id)
+
+
+def assign_shard_id(sender, instance, **kwargs):
+    sharding.assign_ids([instance])
+
+# Rows of sharded tables get their ids before they are inserted, see microblog_app.sharding.
+models.signals.pre_save.connect(assign_shard_id, sender=Post)
+models.signals.pre_save.connect(assign_shard_id, sender=Like)
+models.signals.pre_save.connect(assign_shard_id, sender=Share)
+models.signals.pre_save.connect(assign_shard_id, sender=PostTag)
+models.signals.pre_save.connect(assign_shard_id, sender=Mention)
+models.signals.pre_save.connect(assign_shard_id, sender=Notification)
+models.signals.pre_save.connect(assign_shard_id, sender=NotificationActor)
+
+
+def replicate_user(sender, instance, **kwargs):
+    sharding.replicate_user(instance)
+
+# Users are copied to every shard, so sharded rows can be joined with them.
+models.signals.post_save.connect(replicate_user, sender=User)
+
+
+def forget_token_generation(sender, instance, **kwargs):
+    forget_generation(instance.pk)
+
+# Deactivating or deleting a user invalidates their access tokens, see microblog_app.tokens.
+models.signals.post_save.connect(forget_token_generation, sender=User)
+
+
+def add_to_availability_filter(sender, instance, **kwargs):
+    availability.add(instance)
+
+# The username and email of users saved in this process are taken at once, see microblog_app.availability.
+# Saving a User only sends the signals of User, auth users (admins) send their own.
+models.signals.post_save.connect(add_to_availability_filter, sender=User)
+models.signals.post_save.connect(add_to_availability_filter, sender=auth.models.User)
+
+
+def invalidate_shared_cache(sender, instance, **kwargs):
+    shared_cache.invalidate(sender, instance.pk)
+
+# Users and posts read by pk are cached by the workers of each host, see microblog_app.shared_cache.
+models.signals.post_save.connect(invalidate_shared_cache, sender=User)
+models.signals.post_delete.connect(invalidate_shared_cache, sender=User)
+models.signals.post_save.connect(invalidate_shared_cache, sender=Post)
+models.signals.post_delete.connect(invalidate_shared_cache, sender=Post)
+
+
 class LostPassword(models.Model):
     """
     Encapsulates the unique identifiers generated to reset passwords of users
@@ -137,6 +638,7 @@ class LostPassword(models.Model):
             # Do password reset of the user and delete the LostPassword object
             user.set_password(self.new_password)
             user.save()
+            revoke_tokens(user)
             LostPassword.objects.filter(email=self.email).delete()
 
     def __unicode__(self):
@@ -0,0 +1,378 @@
+"""
+Streaming NDJSON export and import of users, posts, follows, likes and shares, used by
+the exportndjson and importndjson commands.
+
+Every line is a JSON object with a "model" key and the fields of a row, foreign keys as
+ids. Users come first, then posts, follows, likes and shares, so the rows a line refers
+to are always on previous lines.
+
+Both run in constant memory: the export reads the rows with a server side cursor on
+PostgreSQL (fetchmany on other databases), and the import inserts them with multi-row inserts
+in batches, keeping their dates. Imported ids are shifted past the ids already in each table, so a file can
+be imported in a database that already has data, and the sequences are reset afterwards.
+
+With sharding, posts, likes and shares are exported from every database, merged by id.
+Imported users are copied to every shard, and posts, likes and shares are inserted in the
+shard of their user (see microblog_app.sharding) with new ids reserved like the ids of new
+rows. The new ids of the imported posts are kept in memory to import the rows referring
+to them.
+"""
+import heapq
+import json
+from itertools import islice
+from dateutil import parser
+from django.conf import settings
+from django.contrib.auth import models as auth_models
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Q, Max
+from django.utils.timezone import is_naive, make_aware, utc
+from tastypie.models import ApiKey
+from microblog_app.models import User, Post, Follow, Like, Share
+from microblog_app import sharding
+
+
+# (model name, model, [(field, key in the line)])
+MODELS = [
+    ('user', User, [('id', 'id'), ('username', 'username'), ('first_name', 'first_name'), ('last_name', 'last_name'),
+                    ('email', 'email'), ('password', 'password'), ('is_active', 'is_active'),
+                    ('date_joined', 'date_joined'), ('last_login', 'last_login'), ('avatar_url', 'avatar_url')]),
+    ('post', Post, [('id', 'id'), ('user', 'user_id'), ('in_reply_to', 'in_reply_to_id'), ('text', 'text'),
+                    ('created_date', 'created_date'), ('modified_date', 'modified_date')]),
+    ('follow', Follow, [('id', 'id'), ('follower', 'follower_id'), ('followee', 'followee_id'), ('created_date', 'created_date')]),
+    ('like', Like, [('id', 'id'), ('user', 'user_id'), ('post', 'post_id'), ('created_date', 'created_date')]),
+    ('share', Share, [('id', 'id'), ('user', 'user_id'), ('post', 'post_id'), ('created_date', 'created_date')]),
+]
+
+# Keys of the foreign keys, and the model name they refer to.
+FOREIGN_KEYS = {
+    'user_id': 'user',
+    'in_reply_to_id': 'post',
+    'follower_id': 'user',
+    'followee_id': 'user',
+    'post_id': 'post',
+}
+
+DATE_KEYS = set(['date_joined', 'last_login', 'created_date', 'modified_date'])
+
+
+def get_export_databases(model, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the databases the rows of model are exported from. Replicated rows are only
+    exported from the default database.
+    """
+    if using == DEFAULT_DB_ALIAS and sharding.is_sharded(model):
+        return sharding.get_model_databases(model)
+    return [using]
+
+
+def get_querysets(user_ids=None, since=None, until=None, using=DEFAULT_DB_ALIAS):
+    """
+    Returns (model name, queryset) pairs of the rows to export, in order.
+
+    When filtering, only the rows whose foreign keys are exported too are exported, except
+    replies to posts that aren't exported, which are exported as posts.
+    """
+    users = User.objects.filter(deleted_date__isnull=True)
+    if user_ids:
+        users = users.filter(pk__in=user_ids)
+
+    dates = {}
+    if since:
+        dates['created_date__gte'] = since
+    if until:
+        dates['created_date__lt'] = until
+
+    posts = Post.objects.filter(user__in=users, deleted_date__isnull=True, **dates)
+    # Posts are exported in a single pass by id, so replies come after the post they reply
+    # to, which is replaced by null when it isn't exported.
+    exported_ids, params = posts.values('id').query.sql_with_params()
+    in_reply_to = 'CASE WHEN %(table)s.in_reply_to_id IN (%(ids)s) THEN %(table)s.in_reply_to_id END' % {
+        'table': Post._meta.db_table, 'ids': exported_ids}
+    if len(get_export_databases(Post, using)) > 1:
+        # The post replied to may be in another database, see resolve_replies.
+        in_reply_to, params = '%s.in_reply_to_id' % Post._meta.db_table, ()
+    return [
+        ('user', users),
+        ('post', posts.extra(select={'in_reply_to': in_reply_to}, select_params=params)),
+        ('follow', Follow.objects.filter(follower__in=users, followee__in=users, **dates)),
+        ('like', Like.objects.filter(user__in=users, post__in=posts, **dates)),
+        ('share', Share.objects.filter(user__in=users, post__in=posts, **dates)),
+    ]
+
+
+_cursor_count = [0]
+
+
+def fetch_rows(connection, sql, params, chunk_size):
+    if connection.vendor == 'postgresql':
+        # A named cursor is a server side cursor, only itersize rows are sent at a time.
+        connection.cursor()
+        _cursor_count[0] += 1
+        cursor = connection.connection.cursor(name='ndjson_export_%i' % _cursor_count[0])
+        cursor.itersize = chunk_size
+        cursor.execute(sql, params)
+        try:
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+    else:
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+
+def iterate_rows(queryset, fields, chunk_size=1000, using=DEFAULT_DB_ALIAS):
+    """
+    Yields the values of fields for every row of queryset, in pk order, fetching chunk_size
+    rows at a time. Fields can be extra selects of the queryset.
+    """
+    values = queryset.using(using).order_by('pk').values_list(*fields)
+    sql, params = values.query.get_compiler(using=using).as_sql()
+    # Extra selects are selected before the fields.
+    columns = values.query.extra_select.keys() + values.field_names
+    positions = [columns.index(field) for field in fields]
+    for row in fetch_rows(connections[using], sql, params, chunk_size):
+        yield tuple(row[position] for position in positions)
+
+
+def resolve_replies(rows, posts, databases, position, chunk_size=1000):
+    """
+    Yields the rows of posts, replacing the id of the post they reply to (at position) by
+    None when it isn't exported, looking for it in every database, chunk_size rows at a
+    time.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        ids = list(set(row[position] for row in chunk if row[position] is not None))
+        exported = set()
+        for alias in databases:
+            # SQLite binds at most 999 values per query.
+            for i in range(0, len(ids), 500):
+                exported.update(posts.using(alias).filter(pk__in=ids[i:i + 500]).values_list('pk', flat=True))
+        for row in chunk:
+            if row[position] is not None and row[position] not in exported:
+                row = row[:position] + (None,) + row[position + 1:]
+            yield row
+
+
+def format_value(key, value):
+    if value is None:
+        return None
+    if key in DATE_KEYS:
+        if isinstance(value, basestring):
+            value = parser.parse(value)
+        if settings.USE_TZ and is_naive(value):
+            value = make_aware(value, utc)
+        return value.isoformat()
+    if key == 'is_active':
+        return bool(value)
+    return value
+
+
+def export_ndjson(out, user_ids=None, since=None, until=None, chunk_size=1000, using=DEFAULT_DB_ALIAS):
+    """
+    Writes the rows to export to the out file, one JSON object per line. Returns the number
+    of rows exported by model name.
+    """
+    fields_by_model = dict((name, fields) for name, model, fields in MODELS)
+    counts = dict((name, 0) for name, model, fields in MODELS)
+    for name, queryset in get_querysets(user_ids, since, until, using):
+        fields = fields_by_model[name]
+        field_names = [field for field, key in fields]
+        databases = get_export_databases(queryset.model, using)
+        # Every model is exported by id, its first field.
+        rows = heapq.merge(*[iterate_rows(queryset, field_names, chunk_size, alias) for alias in databases])
+        if name == 'post' and len(databases) > 1:
+            rows = resolve_replies(rows, queryset, databases, field_names.index('in_reply_to'), chunk_size)
+        for row in rows:
+            record = {'model': name}
+            for (field, key), value in zip(fields, row):
+                record[key] = format_value(key, value)
+            out.write(json.dumps(record, separators=(',', ':')))
+            out.write('\n')
+            counts[name] += 1
+    return counts
+
+
+def get_id_offsets(using=DEFAULT_DB_ALIAS):
+    """
+    Returns the number every imported id is shifted by, by model name, the highest id in
+    the table (0 for empty tables, which keeps the ids of the file).
+    """
+    offsets = {}
+    for name, model, fields in MODELS:
+        if model is User:
+            model = auth_models.User
+        offsets[name] = model.objects.using(using).aggregate(Max('id'))['id__max'] or 0
+    return offsets
+
+
+def get_tables(model):
+    """
+    Returns the models of the tables inserted to import rows of model.
+    """
+    if model is User:
+        return [auth_models.User, User, ApiKey]
+    return [model]
+
+
+def get_batch_size(model, batch_size, using=DEFAULT_DB_ALIAS):
+    if connections[using].vendor == 'sqlite':
+        # SQLite limits the number of variables of a statement to 999, and every column of
+        # the tables is inserted.
+        columns = max(len(table._meta.local_fields) for table in get_tables(model))
+        return min(batch_size, 999 // columns)
+    return batch_size
+
+
+def build_object(name, model, record, offsets):
+    values = {}
+    for key, value in record.items():
+        if key == 'id':
+            value += offsets[name]
+        elif key in FOREIGN_KEYS and value is not None:
+            value += offsets[FOREIGN_KEYS[key]]
+        elif key in DATE_KEYS and value is not None:
+            value = parser.parse(value)
+        values[key] = value
+    return model(**values)
+
+
+def get_post_id(post_ids, old_id):
+    """
+    Returns the [new id, shard] of the imported post of old_id in post_ids. A reply can come
+    before the post it replies to (ids are reserved in blocks), the new id is reserved the
+    first time either one is seen.
+    """
+    if old_id not in post_ids:
+        post_ids[old_id] = [sharding.allocate_id(Post), None]
+    return post_ids[old_id]
+
+
+def build_sharded_object(model, record, offsets, post_ids):
+    """
+    Builds the object of a post, like or share with sharding enabled, returns it and the
+    shard it's inserted in. Posts are stored in the shard of their user, likes and shares
+    with their post.
+    """
+    old_id = record.pop('id')
+    in_reply_to_id = record.pop('in_reply_to_id', None)
+    post_id = record.pop('post_id', None)
+    obj = build_object(None, model, record, offsets)
+    if model is Post:
+        post = get_post_id(post_ids, old_id)
+        obj.id = post[0]
+        if in_reply_to_id is not None:
+            obj.in_reply_to_id = get_post_id(post_ids, in_reply_to_id)[0]
+        post[1] = sharding.get_shard(obj.user_id)
+    else:
+        post = post_ids.get(post_id)
+        if post is None or post[1] is None:
+            raise ValueError("The post %i of a %s isn't imported." % (post_id, model._meta.object_name.lower()))
+        obj.post_id = post[0]
+        sharding.assign_ids([obj])
+    return obj, post[1]
+
+
+def insert(model, objects, using=DEFAULT_DB_ALIAS):
+    # A raw insert, unlike bulk_create, keeps the dates of auto_now fields.
+    model._base_manager._insert(objects, fields=model._meta.local_fields, using=using, raw=True)
+
+
+def insert_users(users, using=DEFAULT_DB_ALIAS):
+    # Inherited models can't be bulk created, the ids are known so the parent and child
+    # tables are inserted separately.
+    parent_fields = [field.attname for field in auth_models.User._meta.local_fields]
+    insert(auth_models.User, [
+        auth_models.User(**dict((field, getattr(user, field)) for field in parent_fields))
+        for user in users], using)
+    for user in users:
+        user.user_ptr_id = user.id
+    insert(User, users, using)
+
+
+def insert_batch(model, objects, using=DEFAULT_DB_ALIAS):
+    with transaction.commit_on_success(using=using):
+        if model is User:
+            insert_users(objects, using)
+            ApiKey.objects.using(using).bulk_create([
+                ApiKey(user_id=user.id, key=ApiKey().generate_key()) for user in objects])
+        else:
+            insert(model, objects, using)
+    if model is User and using == DEFAULT_DB_ALIAS:
+        # Users are replicated to every shard, see microblog_app.sharding.
+        for alias in sharding.get_shards():
+            if alias != DEFAULT_DB_ALIAS:
+                with transaction.commit_on_success(using=alias):
+                    insert_users(objects, alias)
+
+
+def insert_pending(model, pending, using=DEFAULT_DB_ALIAS):
+    """
+    Inserts the pending (object, database) pairs, in a batch per database.
+    """
+    batches = {}
+    for obj, alias in pending:
+        batches.setdefault(alias or using, []).append(obj)
+    for alias, objects in batches.items():
+        insert_batch(model, objects, alias)
+
+
+def reset_sequences(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    models = [auth_models.User] + [model for name, model, fields in MODELS if model is not User] + [ApiKey]
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), models):
+        cursor.execute(sql)
+    transaction.commit_unless_managed(using=using)
+
+
+def import_ndjson(lines, batch_size=500, using=DEFAULT_DB_ALIAS):
+    """
+    Inserts the rows of the NDJSON lines in batches of batch_size rows. Returns the number
+    of rows imported by model name.
+    """
+    models = dict((name, (model, fields)) for name, model, fields in MODELS)
+    offsets = get_id_offsets(using)
+    counts = dict((name, 0) for name in models)
+    # New ids of the imported posts with sharding, see build_sharded_object.
+    sharded = using == DEFAULT_DB_ALIAS and sharding.is_enabled()
+    post_ids = {}
+    pending = []
+    current = None
+    current_batch_size = batch_size
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        name = record.pop('model')
+        if name not in models:
+            raise ValueError("Unknown model '%s'." % name)
+        if name != current or len(pending) >= current_batch_size:
+            if pending:
+                insert_pending(models[current][0], pending, using)
+                counts[current] += len(pending)
+            pending = []
+            current = name
+            current_batch_size = get_batch_size(models[name][0], batch_size, using)
+        model = models[name][0]
+        if sharded and sharding.is_sharded(model):
+            pending.append(build_sharded_object(model, record, offsets, post_ids))
+        else:
+            pending.append((build_object(name, model, record, offsets), None))
+    if pending:
+        insert_pending(models[current][0], pending, using)
+        counts[current] += len(pending)
+    reset_sequences(using)
+    return counts
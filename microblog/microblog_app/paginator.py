@@ -0,0 +1,162 @@
+from urllib import urlencode
+from dateutil import parser
+from django.conf import settings
+from django.core.paginator import Paginator as DjangoPaginator
+from django.db import connections
+from django.db.models import Q
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+class HotColdPaginator(Paginator):
+    """
+    Paginates the hot objects followed by the archived ones, reading the archive only when
+    the requested page goes past the end of the hot objects.
+
+    Until the archive is reached ``total_count`` only counts the hot objects, and a next
+    page is linked whenever the current one is full. Objects whose ``count()`` returns None
+    (see microblog_app.feed.MergedFeed) are only counted once their end is reached,
+    ``total_count`` is null before.
+    """
+
+    def __init__(self, request_data, objects, archived_objects=None, resource_uri=None, limit=None, offset=0):
+        super(HotColdPaginator, self).__init__(request_data, objects, resource_uri=resource_uri, limit=limit, offset=offset)
+        self.archived_objects = archived_objects
+
+    def page(self):
+        limit = self.get_limit()
+        offset = self.get_offset()
+        count = self.get_count()
+
+        objects = None
+        if count is None:
+            # The page tells whether the end of the hot objects is reached.
+            objects = list(self.get_slice(limit, offset))
+            if not limit or len(objects) < limit:
+                count = offset + len(objects) if objects or not offset else self.objects.exact_count()
+
+        if self.archived_objects is None or (limit and (count is None or offset + limit <= count)):
+            if objects is None:
+                objects = self.get_slice(limit, offset)
+            archive_reached = self.archived_objects is None
+        else:
+            if objects is None:
+                objects = list(self.get_slice(limit, offset))
+            archived_offset = max(0, offset - count)
+            if limit:
+                archived = self.archived_objects[archived_offset:archived_offset + limit - len(objects)]
+            else:
+                archived = self.archived_objects[archived_offset:]
+            objects.extend(archived)
+            count += self.archived_objects.count()
+            archive_reached = True
+
+        meta = {
+            'offset': offset,
+            'limit': limit,
+            'total_count': count,
+        }
+
+        if limit:
+            meta['previous'] = self.get_previous(limit, offset)
+            if archive_reached and count is not None:
+                meta['next'] = self.get_next(limit, offset, count)
+            else:
+                meta['next'] = self._generate_uri(limit, offset + limit)
+
+        return {
+            'objects': objects,
+            'meta': meta,
+        }
+
+
+class CursorPaginator(Paginator):
+    """
+    Paginates newest first by ``order_field`` (a date) and ``id``, with an opaque cursor
+    instead of an offset, so every page is a single index range read however deep it is.
+
+    The next page is requested with the ``cursor`` parameter from ``meta.next``. The
+    archived objects, older than the hot ones, follow them and are only read once the end
+    of the hot objects is reached.
+    """
+
+    def __init__(self, request_data, objects, archived_objects=None, resource_uri=None, limit=None, offset=0, order_field='created_date'):
+        super(CursorPaginator, self).__init__(request_data, objects, resource_uri=resource_uri, limit=limit, offset=offset)
+        self.archived_objects = archived_objects
+        self.order_field = order_field
+
+    def encode_cursor(self, obj):
+        return '%s_%s' % (getattr(obj, self.order_field).isoformat(), obj.pk)
+
+    def decode_cursor(self, cursor):
+        try:
+            value, pk = cursor.rsplit('_', 1)
+            return parser.parse(value), int(pk)
+        except (ValueError, TypeError):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+    def _generate_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        request_params = dict([k, v.encode('utf-8')] for k, v in self.request_data.items())
+        request_params.update({'limit': limit, 'cursor': cursor})
+        request_params.pop('offset', None)
+        return '%s?%s' % (self.resource_uri, urlencode(request_params))
+
+    def get_slice(self, objects, limit, cursor):
+        objects = objects.order_by('-%s' % self.order_field, '-id')
+        if cursor:
+            value, pk = self.decode_cursor(cursor)
+            objects = objects.filter(Q(**{'%s__lt' % self.order_field: value})
+                                     | Q(**{self.order_field: value, 'id__lt': pk}))
+        return objects[:limit]
+
+    def page(self):
+        # Everything at once (limit=0) isn't supported.
+        limit = self.get_limit() or getattr(settings, 'API_LIMIT_PER_PAGE', 20)
+        cursor = self.request_data.get('cursor')
+        # Fetch one more to know if there's a next page without counting.
+        objects = list(self.get_slice(self.objects, limit + 1, cursor))
+        if self.archived_objects is not None and len(objects) <= limit:
+            objects.extend(self.get_slice(self.archived_objects, limit + 1 - len(objects), cursor))
+        next_uri = None
+        if len(objects) > limit:
+            objects = objects[:limit]
+            next_uri = self._generate_cursor_uri(limit, self.encode_cursor(objects[-1]))
+
+        return {
+            'objects': objects,
+            'meta': {
+                'limit': limit,
+                'cursor': cursor,
+                'next': next_uri,
+            },
+        }
+
+
+def estimate_count(queryset):
+    """
+    Counts the queryset, estimating the count of whole tables with more than
+    ADMIN_EXACT_COUNT_LIMIT rows from the PostgreSQL statistics instead of counting them.
+    """
+    connection = connections[queryset.db]
+    if queryset.query.where or connection.vendor != 'postgresql':
+        return queryset.count()
+    cursor = connection.cursor()
+    cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+    row = cursor.fetchone()
+    if row is None or row[0] < getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 100000):
+        return queryset.count()
+    return int(row[0])
+
+
+class EstimatedCountPaginator(DjangoPaginator):
+    """
+    Django paginator for the admin changelists, with the count of estimate_count.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimate_count(self.object_list)
+        return self._count
+    count = property(_get_count)
@@ -0,0 +1,260 @@
+"""
+Soft deletes for users and posts, and the background purge of their rows.
+
+Deleting a user (or a post with many likes, shares and replies) with Django's delete()
+loads every related row in memory and deletes them all in a single transaction. Instead,
+deleted users and posts are marked with a deleted_date, which hides them (and the
+content of deleted users) at once, and a Purge records them. The purgedeleted command
+then deletes their rows in chunks of PURGE_CHUNK_SIZE rows, each one in its own
+transaction, saving the progress of the purge with every chunk.
+
+As with Django's cascading deletes, the replies of a purged post are purged too. The
+thread of a purge (the purged posts and their replies) is kept in PurgedPost rows, built
+one chunk of posts at a time and expanded one level of replies at a time, then deleted
+deepest first with the rows of its posts. No step reloads the whole thread. With sharding
+the rows are purged from every database that may hold them.
+"""
+import logging
+import time
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils.timezone import now
+from tastypie.models import ApiKey
+from microblog_app.models import User, Post, Follow, Like, Share, Notification, NotificationActor, LostPassword, \
+    Purge, PurgedPost, DailyStats, PostTag, Mention, ArchivedPost, ArchivedLike, ArchivedShare, \
+    ArchivedPostTag, ArchivedMention
+from microblog_app import shared_cache, sharding
+from microblog_app.sharding import get_model_databases
+from microblog_app.tokens import revoke_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_chunk_size():
+    """
+    Rows deleted per transaction, from the PURGE_CHUNK_SIZE setting.
+    """
+    return getattr(settings, 'PURGE_CHUNK_SIZE', 500)
+
+
+def delete_user(user):
+    """
+    Hides the user and their content, and schedules the purge of their rows.
+    """
+    user.deleted_date = now()
+    user.is_active = False
+    user.save()
+    revoke_tokens(user)
+    return Purge.objects.create(kind=Purge.USER, object_id=user.pk)
+
+
+def delete_post(post):
+    """
+    Hides the post, and schedules the purge of its rows and replies.
+    """
+    post.deleted_date = now()
+    post.save()
+    purge = Purge.objects.create(kind=Purge.POST, object_id=post.pk)
+    PurgedPost.objects.create(purge=purge, post_id=post.pk)
+    return purge
+
+
+def hide_posts(ids):
+    """
+    Marks the posts deleted in every database, returns the number of posts updated.
+    """
+    updated = 0
+    for using in get_model_databases(Post):
+        with transaction.commit_on_success(using=using):
+            updated += Post.objects.using(using).filter(pk__in=ids, deleted_date__isnull=True).update(deleted_date=now())
+    # Sent no signals, the cached posts are made stale here.
+    for pk in ids:
+        shared_cache.invalidate(Post, pk)
+    return updated
+
+
+def add_to_thread(purge, ids, depth):
+    posts = [PurgedPost(purge=purge, post_id=pk, depth=depth) for pk in ids]
+    # SQLite binds at most 999 values per query.
+    for i in range(0, len(posts), 200):
+        PurgedPost.objects.bulk_create(posts[i:i + 200])
+
+
+def add_user_posts(purge, chunk_size):
+    """
+    Adds the next chunk_size posts of the deleted user to the thread, and hides them.
+    """
+    ids = []
+    for using in get_model_databases(Post):
+        posts = Post.objects.using(using).filter(user=purge.object_id, pk__gt=purge.last_post_id).order_by('pk')
+        ids.extend(posts.values_list('pk', flat=True)[:chunk_size])
+    ids = sorted(ids)[:chunk_size]
+    if not ids:
+        return None
+    add_to_thread(purge, ids, 0)
+    purge.last_post_id = ids[-1]
+    return hide_posts(ids)
+
+
+def add_replies(purge, chunk_size):
+    """
+    Adds the replies of the next chunk_size posts of the thread to it, and hides them. The
+    replies of a post are all added at once, in slices of chunk_size.
+    """
+    posts = list(purge.posts.filter(expanded=False).order_by('pk')[:chunk_size])
+    if not posts:
+        return None
+    depths = dict((post.post_id, post.depth) for post in posts)
+    replies = []
+    for using in get_model_databases(Post):
+        replies.extend(Post.objects.using(using).filter(in_reply_to__in=list(depths)).values_list('id', 'in_reply_to'))
+    hidden = 0
+    for i in range(0, len(replies), chunk_size):
+        replies_slice = replies[i:i + chunk_size]
+        # Replies of a deleted user to their own posts are in the thread already.
+        added = set(purge.posts.filter(post_id__in=[reply_id for reply_id, in_reply_to_id in replies_slice]).values_list('post_id', flat=True))
+        new_replies = [(reply_id, in_reply_to_id) for reply_id, in_reply_to_id in replies_slice if reply_id not in added]
+        for depth in set(depths[in_reply_to_id] + 1 for reply_id, in_reply_to_id in new_replies):
+            add_to_thread(purge, [reply_id for reply_id, in_reply_to_id in new_replies if depths[in_reply_to_id] + 1 == depth], depth)
+        hidden += hide_posts([reply_id for reply_id, in_reply_to_id in new_replies])
+    purge.posts.filter(pk__in=[post.pk for post in posts]).update(expanded=True)
+    return hidden
+
+
+def purge_thread(purge, chunk_size):
+    """
+    Deletes the rows of the next chunk_size posts of the thread, deepest first so replies
+    are deleted before the posts they reply to, up to chunk_size rows, and then the posts.
+    """
+    posts = list(purge.posts.order_by('-depth', '-post_id')[:chunk_size])
+    if not posts:
+        return None
+    ids = [post.post_id for post in posts]
+    for queryset in (
+            NotificationActor.objects.filter(notification__post__in=ids),
+            Like.objects.filter(post__in=ids),
+            Share.objects.filter(post__in=ids),
+            Notification.objects.filter(post__in=ids),
+            PostTag.objects.filter(post__in=ids),
+            Mention.objects.filter(post__in=ids)):
+        deleted = purge_rows(queryset, chunk_size)
+        if deleted is not None:
+            return deleted
+    deleted = 0
+    for using in get_model_databases(Post):
+        post_ids = list(Post.objects.using(using).filter(pk__in=ids).values_list('pk', flat=True))
+        if post_ids:
+            delete_rows(Post, post_ids, using)
+            deleted += len(post_ids)
+    purge.posts.filter(pk__in=[post.pk for post in posts]).delete()
+    return deleted
+
+
+def user_rows(user_id):
+    """
+    Returns the querysets of the rows of the user left once their posts are purged.
+    """
+    email = User.objects.filter(pk=user_id).values_list('email', flat=True)
+    archived_posts = ArchivedPost.objects.filter(user=user_id)
+    return [
+        Like.objects.filter(user=user_id),
+        Share.objects.filter(user=user_id),
+        Follow.objects.filter(Q(follower=user_id) | Q(followee=user_id)),
+        NotificationActor.objects.filter(Q(notification__user=user_id) | Q(notification__actor=user_id) | Q(actor=user_id)),
+        Notification.objects.filter(Q(user=user_id) | Q(actor=user_id)),
+        Mention.objects.filter(user=user_id),
+        ArchivedLike.objects.filter(Q(user=user_id) | Q(post__in=archived_posts)),
+        ArchivedShare.objects.filter(Q(user=user_id) | Q(post__in=archived_posts)),
+        ArchivedPostTag.objects.filter(post__in=archived_posts),
+        ArchivedMention.objects.filter(Q(user=user_id) | Q(post__in=archived_posts)),
+        archived_posts,
+        LostPassword.objects.filter(email__in=email),
+        ApiKey.objects.filter(user=user_id),
+        LogEntry.objects.filter(user=user_id),
+        # After the follows, unfollowing the user counts in their stats.
+        DailyStats.objects.filter(user=user_id),
+        User.objects.filter(pk=user_id),
+    ]
+
+
+def get_steps(purge):
+    """
+    Returns the steps of the purge, in order. Each one is a function of the purge and a
+    chunk size, or the queryset of the rows to delete at that step.
+    """
+    steps = [add_replies, purge_thread]
+    if purge.kind == Purge.USER:
+        steps = [add_user_posts] + steps + user_rows(purge.object_id)
+    return steps
+
+
+def delete_rows(model, ids, using):
+    with transaction.commit_on_success(using=using):
+        if using == DEFAULT_DB_ALIAS:
+            model.objects.using(using).filter(pk__in=ids).delete()
+        else:
+            # Shards only have the tables of the sharded and replicated models, their rows are
+            # deleted without cascades (the steps delete the related rows first).
+            for table in [model] + list(model._meta.get_parent_list()):
+                sharding.delete_rows(table, ids, using)
+    if using != DEFAULT_DB_ALIAS:
+        # Sent no signals, the cached rows are made stale here.
+        for pk in ids:
+            shared_cache.invalidate(model, pk)
+
+
+def purge_rows(queryset, chunk_size):
+    """
+    Deletes up to chunk_size rows of queryset, from the first database that has any of
+    them. Returns the number of rows deleted, None if there's none left.
+    """
+    for using in get_model_databases(queryset.model):
+        ids = list(queryset.using(using).values_list('pk', flat=True)[:chunk_size])
+        if ids:
+            delete_rows(queryset.model, ids, using)
+            return len(ids)
+    return None
+
+
+@transaction.commit_on_success
+def purge_chunk(purge, chunk_size):
+    """
+    Runs the first step of the purge with rows left, on up to chunk_size rows, and saves the
+    progress. Every query of a step reads at most chunk_size rows or ids. Returns the number
+    of rows deleted or updated, None once the purge is finished. Steps of sharded and
+    replicated models are run in every database.
+    """
+    for step in get_steps(purge):
+        if callable(step):
+            purged = step(purge, chunk_size)
+        else:
+            purged = purge_rows(step, chunk_size)
+        if purged is not None:
+            purge.deleted_rows += purged
+            purge.save()
+            return purged
+    purge.finished_date = now()
+    purge.save()
+    return None
+
+
+def purge_deleted(chunk_size=None, pause=0):
+    """
+    Purges the rows of every deleted user and post, in chunks of chunk_size rows, sleeping
+    pause seconds between chunks. Returns the total number of rows deleted or updated.
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    total = 0
+    for purge in Purge.objects.filter(finished_date__isnull=True).order_by('id'):
+        while True:
+            purged = purge_chunk(purge, chunk_size)
+            if purged is None:
+                break
+            total += purged
+            logger.info('purged %i rows of %s (%i so far)' % (purged, purge, purge.deleted_rows))
+            if pause:
+                time.sleep(pause)
+    return total
@@ -0,0 +1,174 @@
+"""
+Incremental rollup of posts, likes, shares, replies and follows into DailyStats.
+
+Each source table has a watermark, the created_date and id of the last row rolled up.
+Every run reads only the rows past it in (created_date, id) order, in chunks of
+ROLLUP_CHUNK_SIZE rows, counts them per user and day in Python and adds the counts to
+DailyStats, moving the watermark in the same transaction, so a run can be interrupted and
+resumed without counting a row twice. Rows become visible when their transaction commits,
+after their created_date is set, so a watermark past a row still being inserted would skip
+it: each run stops at the rows created less than ROLLUP_LAG seconds ago, longer than any
+transaction is expected to take. Ids aren't used as watermarks, with sharding they come
+from blocks reserved by each process and don't follow the order rows are created in.
+
+With sharding, the rows of each database have their own watermark, named after the table
+and the database ('post@shard0'). Days are UTC days. Unfollows delete their rows, they are
+counted by a signal instead (see microblog_app.models.count_unfollow).
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils.timezone import now, utc, is_naive
+from microblog_app.models import Post, Follow, Like, Share, DailyStats, RollupWatermark, add_daily_stats
+from microblog_app.sharding import get_model_databases
+
+
+logger = logging.getLogger(__name__)
+
+STATS_FIELDS = ('posts', 'likes_received', 'shares_received', 'replies_received', 'followers_gained', 'followers_lost')
+
+
+def get_chunk_size():
+    """
+    Rows rolled up per transaction, from the ROLLUP_CHUNK_SIZE setting.
+    """
+    return getattr(settings, 'ROLLUP_CHUNK_SIZE', 5000)
+
+
+def get_lag():
+    """
+    Rows created less than this timedelta ago are left for a later run, from the
+    ROLLUP_LAG setting (seconds).
+    """
+    return timedelta(seconds=getattr(settings, 'ROLLUP_LAG', 300))
+
+
+def utc_date(date):
+    if is_naive(date):
+        return date.date()
+    return date.astimezone(utc).date()
+
+
+def get_replied_users(rows):
+    """
+    Returns the authors of the posts replied to by rows that weren't joined, by post id.
+    With sharding the post replied to may be in another database.
+    """
+    ids = list(set(in_reply_to_id for user_id, in_reply_to_id, replied_user_id, created_date in rows
+                   if in_reply_to_id is not None and replied_user_id is None))
+    replied_users = {}
+    for using in get_model_databases(Post):
+        # SQLite binds at most 999 values per query.
+        for i in range(0, len(ids), 500):
+            replied_users.update(Post.objects.using(using).filter(pk__in=ids[i:i + 500]).values_list('pk', 'user'))
+    return replied_users
+
+
+def count_posts(rows, counts):
+    replied_users = get_replied_users(rows)
+    for user_id, in_reply_to_id, replied_user_id, created_date in rows:
+        date = utc_date(created_date)
+        counts[(user_id, date)]['posts'] += 1
+        if replied_user_id is None:
+            replied_user_id = replied_users.get(in_reply_to_id)
+        if replied_user_id is not None:
+            counts[(replied_user_id, date)]['replies_received'] += 1
+
+
+def counter(name):
+    def count(rows, counts):
+        for user_id, created_date in rows:
+            counts[(user_id, utc_date(created_date))][name] += 1
+    return count
+
+
+# (watermark name, model, fields of the rows, function adding the rows to the counts)
+SOURCES = [
+    ('post', Post, ('user', 'in_reply_to', 'in_reply_to__user', 'created_date'), count_posts),
+    ('like', Like, ('post__user', 'created_date'), counter('likes_received')),
+    ('share', Share, ('post__user', 'created_date'), counter('shares_received')),
+    ('follow', Follow, ('followee', 'created_date'), counter('followers_gained')),
+]
+
+
+def get_watermark_name(name, using):
+    # The default database keeps the names from before sharding.
+    if using == DEFAULT_DB_ALIAS:
+        return name
+    return '%s@%s' % (name, using)
+
+
+def get_watermark_date(watermark, model, using):
+    """
+    Returns the created_date of the watermark, the one of its last row for the watermarks
+    of ids only. Those were moved in id order, which was the order of creation.
+    """
+    if watermark.last_date is None and watermark.last_id:
+        last_rows = model.objects.using(using).filter(pk__lte=watermark.last_id).order_by('-pk')
+        dates = list(last_rows.values_list('created_date', flat=True)[:1])
+        return dates[0] if dates else None
+    return watermark.last_date
+
+
+@transaction.commit_on_success
+def rollup_chunk(name, model, fields, count, cutoff, chunk_size, using=DEFAULT_DB_ALIAS):
+    """
+    Rolls up the next chunk_size rows of model in the using database past its watermark,
+    created before cutoff. Returns the number of rows rolled up.
+    """
+    watermark, created = RollupWatermark.objects.get_or_create(name=get_watermark_name(name, using))
+    rows = model.objects.using(using).filter(created_date__lt=cutoff)
+    last_date = get_watermark_date(watermark, model, using)
+    if last_date is not None:
+        rows = rows.filter(Q(created_date__gt=last_date) | Q(created_date=last_date, pk__gt=watermark.last_id))
+    elif watermark.last_id:
+        rows = rows.filter(pk__gt=watermark.last_id)
+    rows = list(rows.order_by('created_date', 'pk').values_list('pk', *fields)[:chunk_size])
+    if not rows:
+        return 0
+    counts = defaultdict(lambda: defaultdict(int))
+    count([row[1:] for row in rows], counts)
+    for (user_id, date), user_counts in counts.items():
+        add_daily_stats(user_id, date, **user_counts)
+    watermark.last_id = rows[-1][0]
+    # The created date is the last field of every source.
+    watermark.last_date = rows[-1][-1]
+    watermark.save()
+    return len(rows)
+
+
+def rollup(chunk_size=None):
+    """
+    Rolls up the rows created since the last run. Returns the number of rows rolled up.
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    # Rows created after cutoff, and while the rollup runs, are left for the next one.
+    cutoff = now() - get_lag()
+    total = 0
+    for name, model, fields, count in SOURCES:
+        for using in get_model_databases(model):
+            while True:
+                rolled_up = rollup_chunk(name, model, fields, count, cutoff, chunk_size, using)
+                if not rolled_up:
+                    break
+                total += rolled_up
+                logger.info('rolled up %i %ss of %s' % (rolled_up, name, using))
+    return total
+
+
+def get_stats(user_id, since, until):
+    """
+    Returns the user's stats of every day from since to until (both included) that has
+    any, and their totals, with a single query.
+    """
+    days = []
+    totals = dict((name, 0) for name in STATS_FIELDS)
+    stats = DailyStats.objects.filter(user=user_id, date__gte=since, date__lte=until).order_by('date')
+    for day in stats.values('date', *STATS_FIELDS):
+        days.append(day)
+        for name in STATS_FIELDS:
+            totals[name] += day[name]
+    return days, totals
@@ -0,0 +1,503 @@
+"""
+Horizontal sharding of posts and their engagement by user id.
+
+SHARDS lists the database aliases the posts are spread over, empty (the default) keeps
+everything in the default database and makes this module a no-op. Each post is stored in
+the shard of its author, chosen by a jump consistent hash of the user id, and its likes,
+shares, hashtags and mentions are stored with it, so every join and count of a post stays
+within a shard. Notifications are stored in the shard of their recipient, with the posts
+they refer to, and their actors with them. Everything else (users, follows, hashtags, the
+archive) stays in the default database.
+
+- ShardRouter sends reads and writes of sharded objects to their shard, and keeps a copy
+  of the users in every shard, so the joins of posts with their authors keep working.
+- Sharded objects get their ids from blocks reserved in the default database
+  (ShardSequence), so ids are unique across shards.
+- fan_in wraps a queryset of a sharded model in a FanIn, which runs it in every shard
+  and merges the results in Python, ordered like the queryset.
+- rebalance moves the posts and notifications stored out of their user's shard (after
+  adding shards, or when turning sharding on) to the right one.
+
+Replies can be in a different shard than the posts they reply to, on PostgreSQL the
+foreign key constraint of Post.in_reply_to has to be dropped in the shards.
+
+The background jobs (archive, purge, tags backfill, stats rollup) and the feed stream
+poller run over every database. Ids reserved in blocks don't follow the order rows are
+created in, the ones reading new rows do it by created_date rather than past an id.
+"""
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import MultipleObjectsReturned
+from django.db import transaction, IntegrityError, DEFAULT_DB_ALIAS
+from microblog_app import shared_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Sharded models stored in the shard of their user (the author of posts, the recipient of
+# notifications, whose post is always one of theirs).
+USER_SHARDED_MODELS = set(['microblog_app.post', 'microblog_app.notification'])
+
+# Sharded models stored with their post.
+POST_SHARDED_MODELS = set(['microblog_app.like', 'microblog_app.share', 'microblog_app.posttag', 'microblog_app.mention'])
+
+# Sharded models stored with their notification.
+NOTIFICATION_SHARDED_MODELS = set(['microblog_app.notificationactor'])
+
+# Models with a copy of every row in every shard.
+REPLICATED_MODELS = set(['auth.user', 'microblog_app.user'])
+
+# Rows moved with the posts and notifications they belong to by rebalance.
+DEPENDENT_MODELS = {
+    'Post': ('Like', 'Share', 'PostTag', 'Mention'),
+    'Notification': ('NotificationActor',),
+}
+
+
+def load_model(name):
+    # django.db imports this module to load the router, before models can be imported.
+    from django.db.models.loading import get_model
+    return get_model(*name.split('.'))
+
+
+def get_shards():
+    return list(getattr(settings, 'SHARDS', None) or [])
+
+
+def is_enabled():
+    return bool(get_shards())
+
+
+def get_databases():
+    """
+    Returns every database that may hold sharded rows, the shards and the default one.
+    """
+    shards = get_shards()
+    return shards if DEFAULT_DB_ALIAS in shards else [DEFAULT_DB_ALIAS] + shards
+
+
+def get_model_databases(model):
+    """
+    Returns the databases that may hold rows of model: every one for sharded and replicated
+    models, the default one for the rest.
+    """
+    if is_enabled() and (is_sharded(model) or get_label(model) in REPLICATED_MODELS):
+        return get_databases()
+    return [DEFAULT_DB_ALIAS]
+
+
+def get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def is_sharded(model):
+    label = get_label(model)
+    return label in USER_SHARDED_MODELS or label in POST_SHARDED_MODELS or label in NOTIFICATION_SHARDED_MODELS
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping and Veach): maps key to one of buckets, and only moves
+    1/buckets of the keys when a bucket is added.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def get_shard(user_id):
+    """
+    Returns the database alias of the shard of the user.
+    """
+    shards = get_shards()
+    if not shards:
+        return DEFAULT_DB_ALIAS
+    return shards[jump_hash(int(user_id), len(shards))]
+
+
+def get_new_object_shard(instance):
+    """
+    Returns the shard a new object of a sharded model is stored in.
+    """
+    label = get_label(type(instance))
+    if label in USER_SHARDED_MODELS:
+        return get_shard(instance.user_id)
+    if label in NOTIFICATION_SHARDED_MODELS:
+        notification = getattr(instance, '_notification_cache', None)
+        if notification is None:
+            notification = fan_in(load_model('microblog_app.Notification')._base_manager.filter(pk=instance.notification_id)).get()
+        return notification._state.db or get_shard(notification.user_id)
+    post = getattr(instance, '_post_cache', None)
+    if post is None:
+        post = fan_in(load_model('microblog_app.Post')._base_manager.filter(pk=instance.post_id)).get()
+    # Posts not moved yet by rebalance are in the default database.
+    return post._state.db or get_shard(post.user_id)
+
+
+class ShardRouter(object):
+    """
+    Database router of the sharded models, inactive while SHARDS is empty. New objects of
+    sharded models have to be saved rather than created with objects.create(), which picks
+    the database before the object exists.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not is_enabled():
+            return None
+        if not is_sharded(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if get_label(type(instance)) in REPLICATED_MODELS and get_label(model) in USER_SHARDED_MODELS:
+            # The posts or notifications of a user.
+            return get_shard(instance.pk)
+        if is_sharded(type(instance)):
+            # Objects related to a post (or notification) are stored with it.
+            return instance._state.db
+        return None
+
+    def db_for_write(self, model, **hints):
+        if not is_enabled():
+            return None
+        if not is_sharded(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if isinstance(instance, model) and instance._state.adding:
+            # The database set on new objects by assigning them related objects is ignored.
+            return get_new_object_shard(instance)
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_enabled():
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db == DEFAULT_DB_ALIAS or db not in get_shards():
+            return None
+        return is_sharded(model) or get_label(model) in REPLICATED_MODELS
+
+
+class FanIn(object):
+    """
+    A queryset of a sharded model run in every shard. Filtering, ordering and the like
+    return a new FanIn, slicing merges the slices of every shard sorted by the ordering
+    of the queryset, and counting adds the counts of every shard.
+    """
+
+    def __init__(self, queryset, shards):
+        self.queryset = queryset
+        self.shards = shards
+        self.model = queryset.model
+        self._result_cache = None
+
+    def _chain(self, method, *args, **kwargs):
+        return FanIn(getattr(self.queryset, method)(*args, **kwargs), self.shards)
+
+    def all(self):
+        return self._chain('all')
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', *args, **kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._chain('exclude', *args, **kwargs)
+
+    def order_by(self, *args):
+        return self._chain('order_by', *args)
+
+    def distinct(self, *args):
+        return self._chain('distinct', *args)
+
+    def annotate(self, *args, **kwargs):
+        return self._chain('annotate', *args, **kwargs)
+
+    def values(self, *fields):
+        return self._chain('values', *fields)
+
+    def select_related(self, *args, **kwargs):
+        return self._chain('select_related', *args, **kwargs)
+
+    def prefetch_related(self, *args):
+        return self._chain('prefetch_related', *args)
+
+    def using(self, alias):
+        return self.queryset.using(alias)
+
+    def get_querysets(self):
+        return [self.queryset.using(alias) for alias in self.shards]
+
+    def get_ordering(self):
+        query = self.queryset.query
+        if query.extra_order_by:
+            return list(query.extra_order_by)
+        return list(query.order_by or (self.model._meta.ordering if query.default_ordering else []))
+
+    def sort(self, objects):
+        # Stable sorts from the last ordering field to the first.
+        for name in reversed(self.get_ordering()):
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            objects.sort(key=lambda obj: get_value(obj, name), reverse=descending)
+        return objects
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        if len(self.shards) == 1:
+            return self.queryset.using(self.shards[0])[k]
+        objects = []
+        for queryset in self.get_querysets():
+            objects.extend(queryset[:k.stop] if k.stop is not None else queryset)
+        return self.sort(objects)[k.start or 0:k.stop]
+
+    def __iter__(self):
+        if self._result_cache is None:
+            self._result_cache = list(self[:])
+        return iter(self._result_cache)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return sum(queryset.count() for queryset in self.get_querysets())
+
+    def exists(self):
+        return any(queryset.exists() for queryset in self.get_querysets())
+
+    def get(self, *args, **kwargs):
+        objects = list(self.filter(*args, **kwargs)[:2])
+        if not objects:
+            raise self.model.DoesNotExist('%s matching query does not exist.' % self.model._meta.object_name)
+        if len(objects) > 1:
+            raise MultipleObjectsReturned('get() returned more than one %s.' % self.model._meta.object_name)
+        return objects[0]
+
+    def update(self, **kwargs):
+        return sum(queryset.update(**kwargs) for queryset in self.get_querysets())
+
+    def delete(self):
+        for queryset in self.get_querysets():
+            queryset.delete()
+
+
+def get_value(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+    if name == 'pk' or hasattr(obj, name):
+        return getattr(obj, name)
+    # Lookups through related objects.
+    for part in name.split('__'):
+        obj = getattr(obj, part, None)
+    return obj
+
+
+def fan_in(queryset):
+    """
+    Returns a FanIn of the queryset if its model is sharded and sharding is enabled, the
+    queryset itself otherwise.
+    """
+    if not is_enabled() or not is_sharded(queryset.model):
+        return queryset
+    return FanIn(queryset, get_databases())
+
+
+def for_user(queryset, user_id):
+    """
+    Returns the queryset (or the queryset of a FanIn) restricted to the shard of the user.
+    """
+    if isinstance(queryset, FanIn):
+        queryset = queryset.queryset
+    if not is_enabled() or not is_sharded(queryset.model):
+        return queryset
+    return queryset.using(get_shard(user_id))
+
+
+class ShardedResourceMixin(object):
+    """
+    Reads the object list of the resources of sharded models from every shard.
+    """
+
+    def get_object_list(self, request):
+        return fan_in(super(ShardedResourceMixin, self).get_object_list(request))
+
+
+# Ids
+
+_blocks = {}
+_blocks_lock = threading.Lock()
+
+
+def get_id_block_size():
+    """
+    Ids reserved at a time by each process, from the SHARD_ID_BLOCK_SIZE setting.
+    """
+    return getattr(settings, 'SHARD_ID_BLOCK_SIZE', 100)
+
+
+def reserve_ids(model, count):
+    """
+    Reserves count ids of model in the default database, returns the first one.
+    """
+    ShardSequence = load_model('microblog_app.ShardSequence')
+    from django.db.models import Max
+    name = model._meta.db_table
+    with transaction.commit_on_success(using=DEFAULT_DB_ALIAS):
+        try:
+            sequence = ShardSequence.objects.select_for_update().get(name=name)
+        except ShardSequence.DoesNotExist:
+            # Starts past the ids already used in any database.
+            start = max(model._base_manager.using(alias).aggregate(Max('id'))['id__max'] or 0
+                        for alias in get_databases()) + 1
+            try:
+                sequence = ShardSequence.objects.create(name=name, next_id=start)
+            except IntegrityError:
+                sequence = ShardSequence.objects.select_for_update().get(name=name)
+        first = sequence.next_id
+        sequence.next_id += count
+        sequence.save()
+    return first
+
+
+def allocate_id(model):
+    with _blocks_lock:
+        block = _blocks.get(model)
+        if block is None or block[0] >= block[1]:
+            size = get_id_block_size()
+            first = reserve_ids(model, size)
+            block = _blocks[model] = [first, first + size]
+        block[0] += 1
+        return block[0] - 1
+
+
+def assign_ids(objects):
+    """
+    Assigns ids to new objects of a sharded model, which bulk_create doesn't.
+    """
+    if is_enabled():
+        for obj in objects:
+            if obj.pk is None:
+                obj.pk = allocate_id(type(obj))
+
+
+def reset_id_blocks():
+    with _blocks_lock:
+        _blocks.clear()
+
+
+# Replication of users
+
+def insert_rows(model, objects, using):
+    model._base_manager._insert(objects, fields=model._meta.local_fields, using=using, raw=True)
+    transaction.commit_unless_managed(using=using)
+
+
+def replicate_user(user):
+    """
+    Copies the user to every shard.
+    """
+    for alias in get_shards():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        for model in (load_model('auth.User'), type(user)):
+            values = dict((field.name, getattr(user, field.attname)) for field in model._meta.local_fields if not field.primary_key)
+            if not model._base_manager.using(alias).filter(pk=user.pk).update(**values):
+                insert_rows(model, [user], alias)
+
+
+# Rebalancing
+
+def copy_rows(model, objects, target):
+    """
+    Inserts the objects in the target database, except those already there.
+    """
+    existing = set(model._base_manager.using(target).filter(pk__in=[obj.pk for obj in objects]).values_list('pk', flat=True))
+    missing = [obj for obj in objects if obj.pk not in existing]
+    if missing:
+        insert_rows(model, missing, target)
+
+
+def delete_rows(model, ids, using):
+    # No cascades, the related rows are either moved too or in another database.
+    from django.db.models.sql import DeleteQuery
+    if ids:
+        DeleteQuery(model).delete_batch(ids, using)
+        transaction.commit_unless_managed(using=using)
+
+
+def move_rows(model, user_id, source, target, chunk_size):
+    """
+    Moves up to chunk_size rows of the user (posts or notifications), with the rows stored
+    with them, from source to target. Rows are copied before they are deleted, so an
+    interrupted move is finished by the next one. Returns the number of rows moved.
+    """
+    rows = list(model._base_manager.using(source).filter(user=user_id).order_by('pk')[:chunk_size])
+    if not rows:
+        return 0
+    ids = [row.pk for row in rows]
+    dependents = []
+    copy_rows(model, rows, target)
+    for name in DEPENDENT_MODELS[model._meta.object_name]:
+        dependent_model = load_model('microblog_app.%s' % name)
+        lookup = '%s__in' % model._meta.object_name.lower()
+        dependent_rows = list(dependent_model._base_manager.using(source).filter(**{lookup: ids}))
+        if dependent_rows:
+            copy_rows(dependent_model, dependent_rows, target)
+            dependents.append((dependent_model, [row.pk for row in dependent_rows]))
+    for dependent_model, dependent_ids in dependents:
+        delete_rows(dependent_model, dependent_ids, source)
+    delete_rows(model, ids, source)
+    # Cached posts would still be read from the source.
+    for pk in ids:
+        shared_cache.invalidate(model, pk)
+    return len(ids)
+
+
+def replicate_users(chunk_size):
+    User = load_model('microblog_app.User')
+    last_id = 0
+    while True:
+        users = list(User._base_manager.filter(pk__gt=last_id).order_by('pk')[:chunk_size])
+        if not users:
+            return
+        for user in users:
+            replicate_user(user)
+        last_id = users[-1].pk
+
+
+def rebalance(chunk_size=500, pause=0):
+    """
+    Copies the users to every shard, then moves every post (with the rows stored with it)
+    and notification that isn't in its user's shard, in chunks of chunk_size rows, sleeping
+    pause seconds between chunks. Returns the number of rows moved by model name.
+    """
+    replicate_users(chunk_size)
+    totals = {}
+    for name in ('Post', 'Notification'):
+        model = load_model('microblog_app.%s' % name)
+        totals[name] = 0
+        for source in get_databases():
+            user_ids = model._base_manager.using(source).order_by().values_list('user', flat=True).distinct()
+            for user_id in list(user_ids):
+                target = get_shard(user_id)
+                if target == source:
+                    continue
+                while True:
+                    moved = move_rows(model, user_id, source, target, chunk_size)
+                    if not moved:
+                        break
+                    totals[name] += moved
+                    logger.info('moved %i %ss of user %s from %s to %s' % (moved, name.lower(), user_id, source, target))
+                    if pause:
+                        time.sleep(pause)
+    return totals
@@ -0,0 +1,250 @@
+"""
+Cache of hot users and posts in a memory mapped file shared by the workers of a host, so a
+popular object is read from the database, and kept in memory, once per host instead of once
+per worker. Workers map the same file (SHARED_CACHE_PATH, best put in /dev/shm so it never
+touches the disk) and only read the slot of the object they need.
+
+The file is a table of versions followed by fixed size slots. An object is stored in the
+slot of the hash of its key, replacing whatever was there, as a compact record of the
+values of its fields and the version of its key. Saving or deleting an object increments
+that version (see the signals in microblog_app.models), which makes its entry stale. As in
+microblog_app.fragments the version is read before the database, so an entry racing with a
+change is never read. Entries also expire after SHARED_CACHE_TIMEOUT seconds, as changes
+made by other hosts aren't signaled here.
+
+Writers lock the file. Readers don't, a sequence number in each slot, odd while the slot
+is being written, tells them it changed while they were reading it. The cache is disabled
+while SHARED_CACHE_PATH is empty.
+"""
+import cPickle as pickle
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+
+MAGIC = 'MBSHCACH'
+
+# Magic, versions count, slots count and slot size.
+HEADER = struct.Struct('<8sIII')
+# Sequence, key hash, expiration time and record length.
+SLOT_HEADER = struct.Struct('<IQdI')
+VERSION = struct.Struct('<Q')
+
+_lock = threading.Lock()
+_caches = {}
+
+# Reads of this process, for the sharedcachestress command.
+stats = {'hits': 0, 'misses': 0}
+
+
+def hash_key(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class SharedCache(object):
+
+    def __init__(self, path, version_count, slot_count, slot_size):
+        self.path = path
+        self.version_count = version_count
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.versions_offset = HEADER.size
+        self.slots_offset = self.versions_offset + version_count * VERSION.size
+        self.size = self.slots_offset + slot_count * slot_size
+        self.lock = threading.Lock()
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0600), 'r+b')
+        with self.locked():
+            header = HEADER.pack(MAGIC, version_count, slot_count, slot_size)
+            self.file.seek(0)
+            if self.file.read(HEADER.size) != header or os.fstat(self.file.fileno()).st_size != self.size:
+                # New, or made with other settings, every entry is dropped.
+                self.file.truncate(0)
+                self.file.truncate(self.size)
+                self.file.seek(0)
+                self.file.write(header)
+                self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    @contextmanager
+    def locked(self):
+        # File locks are held by processes, the threads of this one take turns first.
+        with self.lock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN)
+
+    def get_version_offset(self, key_hash):
+        return self.versions_offset + key_hash % self.version_count * VERSION.size
+
+    def get_version(self, key):
+        return VERSION.unpack_from(self.map, self.get_version_offset(hash_key(key)))[0]
+
+    def invalidate(self, key):
+        offset = self.get_version_offset(hash_key(key))
+        with self.locked():
+            VERSION.pack_into(self.map, offset, VERSION.unpack_from(self.map, offset)[0] + 1)
+
+    def get_slot_offset(self, key_hash):
+        return self.slots_offset + key_hash % self.slot_count * self.slot_size
+
+    def get(self, key):
+        """
+        Returns the record of key, or None if it isn't cached or is stale.
+        """
+        key_hash = hash_key(key)
+        offset = self.get_slot_offset(key_hash)
+        sequence, slot_key_hash, expiration, length = SLOT_HEADER.unpack_from(self.map, offset)
+        if sequence % 2 or slot_key_hash != key_hash or expiration < time.time():
+            return None
+        start = offset + SLOT_HEADER.size
+        data = self.map[start:start + length]
+        if SLOT_HEADER.unpack_from(self.map, offset)[0] != sequence:
+            return None
+        slot_key, version, record = pickle.loads(data)
+        if slot_key != key or version != self.get_version(key):
+            return None
+        return record
+
+    def set(self, key, version, record, timeout):
+        """
+        Stores the record of key read at version, unless it doesn't fit in a slot.
+        """
+        data = pickle.dumps((key, version, record), pickle.HIGHEST_PROTOCOL)
+        if SLOT_HEADER.size + len(data) > self.slot_size:
+            return False
+        key_hash = hash_key(key)
+        offset = self.get_slot_offset(key_hash)
+        start = offset + SLOT_HEADER.size
+        with self.locked():
+            sequence = SLOT_HEADER.unpack_from(self.map, offset)[0]
+            struct.pack_into('<I', self.map, offset, sequence + 1)
+            self.map[start:start + len(data)] = data
+            SLOT_HEADER.pack_into(self.map, offset, sequence + 2, key_hash, time.time() + timeout, len(data))
+        return True
+
+    def clear(self):
+        # Every entry is made stale, without touching the pages of the slots.
+        with self.locked():
+            for offset in range(self.versions_offset, self.slots_offset, VERSION.size):
+                VERSION.pack_into(self.map, offset, VERSION.unpack_from(self.map, offset)[0] + 1)
+
+
+def get_cache():
+    """
+    Returns the cache of SHARED_CACHE_PATH mapped by this process, or None if it's disabled.
+    """
+    path = getattr(settings, 'SHARED_CACHE_PATH', '')
+    if not path:
+        return None
+    cache = _caches.get(path)
+    if cache is None:
+        with _lock:
+            cache = _caches.get(path)
+            if cache is None:
+                cache = _caches[path] = SharedCache(
+                    path,
+                    getattr(settings, 'SHARED_CACHE_VERSIONS', 65536),
+                    getattr(settings, 'SHARED_CACHE_SLOTS', 65536),
+                    getattr(settings, 'SHARED_CACHE_SLOT_SIZE', 1024))
+    return cache
+
+
+def get_timeout():
+    return getattr(settings, 'SHARED_CACHE_TIMEOUT', 300)
+
+
+def get_key(model, pk):
+    """
+    Returns the key of the object of model with pk, or None if pk isn't valid.
+    """
+    # The pk of a child model is a key to its parent's, converted by the parent's pk.
+    pk_field = model._meta.pk
+    while pk_field.rel is not None:
+        pk_field = pk_field.rel.get_related_field()
+    try:
+        pk = pk_field.to_python(pk)
+    except ValidationError:
+        return None
+    return '%s.%s:%s' % (model._meta.app_label, model._meta.object_name.lower(), pk)
+
+
+def dump(obj):
+    return obj._state.db, tuple(getattr(obj, field.attname) for field in obj._meta.fields)
+
+
+def load(model, record):
+    db, values = record
+    obj = model(*values)
+    obj._state.adding = False
+    obj._state.db = db
+    return obj
+
+
+def get_or_fetch(model, pk, fetch):
+    """
+    Returns the object of model with pk from the cache, or the one returned by fetch, which
+    is cached.
+    """
+    cache = get_cache()
+    key = get_key(model, pk)
+    if cache is None or key is None:
+        return fetch()
+    record = cache.get(key)
+    if record is not None:
+        stats['hits'] += 1
+        return load(model, record)
+    stats['misses'] += 1
+    version = cache.get_version(key)
+    obj = fetch()
+    cache.set(key, version, dump(obj), get_timeout())
+    return obj
+
+
+def invalidate(model, pk):
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(get_key(model, pk))
+
+
+def clear():
+    cache = get_cache()
+    if cache is not None:
+        cache.clear()
+
+
+class SharedCacheMixin(object):
+    """
+    Gets the objects of GET requests by pk from the shared cache, with the related objects
+    of the ``full`` to one fields RelatedFieldsMixin joins to the object list. Resources
+    check the objects are still listed with is_listed, as the cache doesn't know about
+    the filters of their object list.
+    """
+
+    def obj_get(self, request=None, **kwargs):
+        if request is None or request.method != 'GET' or kwargs.keys() != ['pk'] or get_cache() is None:
+            return super(SharedCacheMixin, self).obj_get(request, **kwargs)
+        model = self._meta.object_class
+        obj = get_or_fetch(model, kwargs['pk'], lambda: super(SharedCacheMixin, self).obj_get(request, **kwargs))
+        to_one, to_many = self.get_related_lookups()
+        for name in to_one:
+            field = model._meta.get_field(name)
+            related_pk = getattr(obj, field.attname)
+            if related_pk is not None and not hasattr(obj, field.get_cache_name()):
+                related_model = field.rel.to
+                related_obj = get_or_fetch(related_model, related_pk, lambda: related_model._default_manager.get(pk=related_pk))
+                setattr(obj, field.get_cache_name(), related_obj)
+        if not self.is_listed(obj):
+            raise model.DoesNotExist()
+        return obj
+
+    def is_listed(self, obj):
+        return True
@@ -0,0 +1 @@
+CREATE INDEX "microblog_app_archivedmention_user_created" ON "microblog_app_archivedmention" ("user_id", "created_date", "id");
@@ -0,0 +1 @@
+CREATE INDEX "microblog_app_archivedposttag_hashtag_created" ON "microblog_app_archivedposttag" ("hashtag_id", "created_date", "id");
@@ -0,0 +1 @@
+CREATE INDEX "microblog_app_follow_followee_follower" ON "microblog_app_follow" ("followee_id", "follower_id");
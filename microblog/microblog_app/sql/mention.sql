@@ -0,0 +1 @@
+CREATE INDEX "microblog_app_mention_user_created" ON "microblog_app_mention" ("user_id", "created_date", "id");
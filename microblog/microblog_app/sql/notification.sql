@@ -0,0 +1,2 @@
+CREATE INDEX "microblog_app_notification_inbox" ON "microblog_app_notification" ("user_id", "modified_date", "id");
+CREATE UNIQUE INDEX "microblog_app_notification_unread" ON "microblog_app_notification" ("user_id", "kind", COALESCE("post_id", 0)) WHERE NOT "read";
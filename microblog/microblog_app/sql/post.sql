@@ -0,0 +1 @@
+CREATE INDEX "microblog_app_post_user_created" ON "microblog_app_post" ("user_id", "created_date");
@@ -0,0 +1 @@
+CREATE INDEX "microblog_app_posttag_hashtag_created" ON "microblog_app_posttag" ("hashtag_id", "created_date", "id");
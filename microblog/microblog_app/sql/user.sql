@@ -1,2 +1,3 @@
 CREATE INDEX "microblog_app_user_first_name" ON "auth_user" ("first_name");
-CREATE INDEX "microblog_app_user_last_name" ON "auth_user" ("last_name");
\ No newline at end of file
+CREATE INDEX "microblog_app_user_last_name" ON "auth_user" ("last_name");
+CREATE INDEX "microblog_app_user_email" ON "auth_user" ("email");
\ No newline at end of file
@@ -0,0 +1,249 @@
+"""
+In process pub/sub bus for new posts and shares, used by the feed stream endpoint.
+
+Posts and shares created by this process are published by post_save signals as soon as
+they are saved. Those created by other processes (other gunicorn workers) are picked up
+by a single poller thread per process, which reads the new rows every
+FEED_STREAM_POLL_INTERVAL seconds, so the cost doesn't grow with the number of streams.
+
+Every event has a cursor, the creation time (in microseconds) of the newest event seen so
+far, used as the SSE event id so clients can resume with Last-Event-ID. Ids are allocated
+when rows are inserted but become visible when their transaction commits, so a row can
+show up after rows created later. The poller and resuming streams read again the rows
+created FEED_STREAM_LOOKBACK seconds before their cursor and drop the ones already sent,
+a resumed stream may repeat the events of those seconds (clients drop the ids they have).
+With sharding the rows are read from every database, their ids are unique across shards.
+"""
+from collections import deque
+from datetime import datetime, timedelta
+import calendar
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_connection
+from django.db.models import signals
+from django.utils.timezone import get_default_timezone, is_naive, make_aware, make_naive, now, utc
+from microblog_app.models import Post, Share
+from microblog_app.sharding import fan_in
+
+
+logger = logging.getLogger(__name__)
+
+
+class FeedEvent(object):
+
+    def __init__(self, seq, kind, obj_id, user_id, post_id, created_date, text=None, in_reply_to_id=None):
+        self.seq = seq
+        self.kind = kind
+        self.id = obj_id
+        self.user_id = user_id
+        self.post_id = post_id
+        self.created_date = created_date
+        self.text = text
+        self.in_reply_to_id = in_reply_to_id
+        self.cursor = None
+        # Serialized once, shared by all the streams the event is sent to.
+        self.data = None
+
+
+def get_lookback():
+    """
+    Rows are read again this timedelta before the cursor, from the FEED_STREAM_LOOKBACK
+    setting (seconds).
+    """
+    return timedelta(seconds=getattr(settings, 'FEED_STREAM_LOOKBACK', 10))
+
+
+def format_cursor(date):
+    if is_naive(date):
+        date = make_aware(date, get_default_timezone())
+    return '%i' % (calendar.timegm(date.utctimetuple()) * 1000000 + date.microsecond)
+
+
+def parse_cursor(cursor):
+    """
+    Returns the date of a cursor, or None if it's not valid.
+    """
+    try:
+        seconds, microseconds = divmod(int(cursor), 1000000)
+        date = datetime.fromtimestamp(seconds, utc).replace(microsecond=microseconds)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return date if settings.USE_TZ else make_naive(date, get_default_timezone())
+
+
+class FeedEventBus(object):
+    """
+    Keeps the last ``size`` events and wakes up the streams waiting for new ones.
+    """
+
+    def __init__(self, size=1000):
+        self.events = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.clear()
+
+    def clear(self):
+        with self.condition:
+            self.events.clear()
+            self.max_created_date = None
+            self._published = {'post': set(), 'share': set()}
+
+    def publish(self, kind, obj_id, user_id, post_id, created_date, text=None, in_reply_to_id=None):
+        with self.condition:
+            # The same object may be published by its signal and by the poller.
+            published = self._published[kind]
+            if obj_id in published:
+                return
+            published.add(obj_id)
+            if len(published) > 2 * self.events.maxlen:
+                published.clear()
+                published.update(event.id for event in self.events if event.kind == kind)
+
+            self.seq += 1
+            event = FeedEvent(self.seq, kind, obj_id, user_id, post_id, created_date, text, in_reply_to_id)
+            if self.max_created_date is None or created_date > self.max_created_date:
+                self.max_created_date = created_date
+            event.cursor = format_cursor(self.max_created_date)
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def wait(self, after_seq, timeout):
+        """
+        Returns the events published after the after_seq sequence number, waiting up to
+        timeout seconds for new ones.
+        """
+        with self.condition:
+            if self.seq <= after_seq:
+                self.condition.wait(timeout)
+            return [event for event in self.events if event.seq > after_seq]
+
+
+bus = FeedEventBus()
+
+
+def publish_post(sender, instance, created, **kwargs):
+    if created:
+        bus.publish('post', instance.pk, instance.user_id, instance.pk, instance.created_date,
+                    text=instance.text, in_reply_to_id=instance.in_reply_to_id)
+
+
+def publish_share(sender, instance, created, **kwargs):
+    if created:
+        bus.publish('share', instance.pk, instance.user_id, instance.post_id, instance.created_date)
+
+
+signals.post_save.connect(publish_post, sender=Post, dispatch_uid='stream_publish_post')
+signals.post_save.connect(publish_share, sender=Share, dispatch_uid='stream_publish_share')
+
+
+def get_rows(kind, since, user_ids=None):
+    """
+    Returns the posts or shares (as dicts) created since the date, oldest first, from every
+    database with sharding.
+    """
+    if kind == 'post':
+        rows = Post.objects.values('id', 'user_id', 'created_date', 'text', 'in_reply_to_id')
+    else:
+        rows = Share.objects.values('id', 'user_id', 'post_id', 'created_date')
+    rows = rows.filter(created_date__gte=since)
+    if user_ids is not None:
+        rows = rows.filter(user__in=user_ids)
+    return fan_in(rows.order_by('created_date', 'id'))
+
+
+def get_event(kind, row):
+    if kind == 'post':
+        return FeedEvent(0, 'post', row['id'], row['user_id'], row['id'], row['created_date'],
+                         text=row['text'], in_reply_to_id=row['in_reply_to_id'])
+    return FeedEvent(0, 'share', row['id'], row['user_id'], row['post_id'], row['created_date'])
+
+
+def publish_row(kind, row):
+    if kind == 'post':
+        bus.publish('post', row['id'], row['user_id'], row['id'], row['created_date'],
+                    text=row['text'], in_reply_to_id=row['in_reply_to_id'])
+    else:
+        bus.publish('share', row['id'], row['user_id'], row['post_id'], row['created_date'])
+
+
+class Poller(threading.Thread):
+    """
+    Publishes the posts and shares created by other processes.
+    """
+    daemon = True
+
+    def __init__(self, interval):
+        super(Poller, self).__init__(name='feed-stream-poller')
+        self.interval = interval
+        # Creation date of the newest row read.
+        self.since = None
+        # Ids of the rows read in the lookback window, with their creation dates.
+        self.seen = {'post': {}, 'share': {}}
+
+    def start_from_latest(self):
+        self.since = now()
+        # The rows created so far are not published.
+        self.poll(publish=False)
+
+    def poll(self, publish=True):
+        start = self.since - get_lookback()
+        for kind, seen in self.seen.items():
+            for row in get_rows(kind, start):
+                if row['id'] in seen:
+                    continue
+                seen[row['id']] = row['created_date']
+                self.since = max(self.since, row['created_date'])
+                if publish:
+                    publish_row(kind, row)
+        start = self.since - get_lookback()
+        for seen in self.seen.values():
+            for obj_id, created_date in seen.items():
+                if created_date < start:
+                    del seen[obj_id]
+
+    def run(self):
+        while True:
+            try:
+                if self.since is None:
+                    self.start_from_latest()
+                else:
+                    self.poll()
+            except Exception:
+                # A failed poll (the database went away) is retried on the next one.
+                logger.exception('feed stream poll failed')
+            finally:
+                close_connection()
+            time.sleep(self.interval)
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def ensure_poller():
+    global _poller
+    interval = getattr(settings, 'FEED_STREAM_POLL_INTERVAL', 2)
+    if not interval:
+        return
+    with _poller_lock:
+        if _poller is None or not _poller.is_alive():
+            _poller = Poller(interval)
+            _poller.start()
+
+
+def backfill(user_ids, since):
+    """
+    Returns the events for the posts and shares by the given users created since the date
+    of a cursor, and in the lookback window before it, read from the database, so a client
+    resuming with Last-Event-ID doesn't miss anything.
+    """
+    events = []
+    for kind in ('post', 'share'):
+        events.extend(get_event(kind, row) for row in get_rows(kind, since - get_lookback(), user_ids)[:500])
+    events.sort(key=lambda event: event.created_date)
+    for event in events:
+        since = max(since, event.created_date)
+        event.cursor = format_cursor(since)
+    return events
@@ -0,0 +1,59 @@
+"""
+Backfill of the hashtags and mentions of the posts written before they were extracted on
+save (see microblog_app.models.index_posts).
+
+Posts are indexed in chunks by id, each one in its own transaction, one database after
+the other when they're sharded. Indexing a post replaces its hashtags and mentions, so the
+backfill can be run again, or resumed from an id, safely.
+
+Only the posts of the Post table are indexed. Archiving moves the hashtags and mentions of
+a post to the archive (see microblog_app.archive), so run the backfill before archiving
+posts that were written before they were extracted on save.
+"""
+import logging
+import time
+from django.conf import settings
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from microblog_app.models import Post, index_posts
+from microblog_app.sharding import get_model_databases
+
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_chunk(start_id, chunk_size, using=DEFAULT_DB_ALIAS):
+    """
+    Indexes up to chunk_size posts of the using database with an id greater than start_id.
+    Returns the last id indexed, None once there are no posts left.
+    """
+    # Hashtags are written to the default database, the rest with the posts.
+    with transaction.commit_on_success():
+        with transaction.commit_on_success(using=using):
+            posts = Post.objects.using(using).filter(pk__gt=start_id, deleted_date__isnull=True)
+            # Posts without a # or @ have nothing to index.
+            posts = list(posts.filter(Q(text__contains='#') | Q(text__contains='@')).order_by('pk')[:chunk_size])
+            if not posts:
+                return None
+            index_posts(posts, using=using)
+            return posts[-1].pk
+
+
+def backfill_tags(start_id=0, chunk_size=None, pause=0):
+    """
+    Indexes the posts with an id greater than start_id, in chunks of chunk_size posts,
+    sleeping pause seconds between chunks. Returns the number of chunks indexed.
+    """
+    chunk_size = chunk_size or getattr(settings, 'TAGS_BACKFILL_CHUNK_SIZE', 500)
+    chunks = 0
+    for using in get_model_databases(Post):
+        last_id = start_id
+        while True:
+            last_id = backfill_chunk(last_id, chunk_size, using)
+            if last_id is None:
+                break
+            chunks += 1
+            logger.info('indexed the posts of %s up to id %i' % (using, last_id))
+            if pause:
+                time.sleep(pause)
+    return chunks
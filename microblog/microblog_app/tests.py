@@ -1,11 +1,54 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
+from django.test.utils import override_settings
 from django.http import HttpRequest
+from django.conf import settings
+from django.db.models import Q
+from django.db import connections, DatabaseError
+from django.core.cache import cache
 from django.utils import timezone
+from django.contrib.auth import models as auth_models
 from tastypie.models import ApiKey
+from tastypie.serializers import Serializer
+from tastypie.exceptions import ApiFieldError
 from copy import copy
+import re
+from StringIO import StringIO
+from datetime import timedelta
 from microblog_app.models import *
 from microblog_app.api import *
+from microblog.urls import v1_api
+from microblog_app import availability
+from microblog_app import cache_backends
+from microblog_app import shared_cache
+from microblog_app import coalesce
+from microblog_app import fragments
+from microblog_app import archive
+from microblog_app.archive import archive_posts, archive_chunk
+from microblog_app.feed import MergedFeed
+from microblog_app.purge import purge_deleted, purge_chunk, delete_post
+from microblog_app.ndjson import export_ndjson, import_ndjson
+from microblog_app.rollups import rollup
+from microblog_app.sharding import get_shard, rebalance, reset_id_blocks
+from microblog_app.stream import Poller, format_cursor
+from microblog_app.paginator import EstimatedCountPaginator
+from microblog_app.tags import backfill_tags
+from microblog_app.explain import advise, find_problems, propose_indexes
+from microblog_app.benchmarks import measure_all, compare
+from microblog_app.throttle import SlidingWindowThrottle
+from microblog_app.serializers import FastJSONSerializer
+from microblog_app.uris import cached_reverse
+from microblog_app.tokens import issue_token, verify_token, revoke_tokens
+from microblog.postgresql_persistent.pool import ConnectionPool, PoolExhausted
+from microblog.startup import measure, warm_up
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
+import time
 
 
 class BaseTestCase(TestCase):
@@ -183,6 +226,88 @@ class PostTest(BaseTestCase):
         self.assertTrue(old_created_date == post.created_date)
 
 
+class AvailabilityTest(BaseTestCase):
+
+    def setUp(self):
+        super(AvailabilityTest, self).setUp()
+        availability.reset()
+
+    def test_bloom_filter(self):
+        bloom = availability.BloomFilter(1000)
+        for i in range(1000):
+            bloom.add('value%i' % i)
+        self.assertTrue(all('value%i' % i in bloom for i in range(1000)))
+        false_positives = len([i for i in range(1000, 11000) if 'value%i' % i in bloom])
+        self.assertTrue(false_positives < 300)
+
+    def test_is_available(self):
+        availability.get_state()
+        self.assertNumQueries(0, availability.is_available, 'username', 'new')
+        self.assertNumQueries(1, availability.is_available, 'username', 'u1')
+        self.assertFalse(availability.is_available('username', 'u1'))
+        self.assertFalse(availability.is_available('email', 'u1@email.com'))
+        self.assertTrue(availability.is_available('email', 'new@email.com'))
+        # Users saved in this process are added at once.
+        User(username='new', email='new@email.com').save()
+        self.assertFalse(availability.is_available('username', 'new'))
+        self.assertFalse(availability.is_available('email', 'new@email.com'))
+
+    @override_settings(AVAILABILITY_REFRESH_INTERVAL=0)
+    def test_refresh(self):
+        availability.get_state()
+        # Saved without signals, as by another process.
+        auth_models.User.objects.filter(pk=self.u1.pk).update(username='other')
+        auth_models.User._base_manager._insert([auth_models.User(username='created')],
+                                               fields=auth_models.User._meta.local_fields, using='default', raw=True)
+        time.sleep(0.01)
+        self.assertFalse(availability.is_available('username', 'created'))
+        self.assertTrue(availability.is_available('username', 'u1'))
+
+    @override_settings(AVAILABILITY_REFRESH_INTERVAL=0)
+    def test_late_commit(self):
+        # a lower id than the users read
+        gap = auth_models.User.objects.create(username='gap')
+        gap.delete()
+        User(username='new', email='new@email.com').save()
+        state = availability.get_state()
+        # Joined before the newest user read, committed after the refresh read it.
+        auth_models.User._base_manager._insert([auth_models.User(id=gap.pk, username='late', date_joined=state['since'] - timedelta(seconds=1))],
+                                               fields=auth_models.User._meta.local_fields, using='default', raw=True)
+        read_rows = availability.read_rows
+        locked = []
+
+        def read_rows_unlocked(since):
+            locked.append(availability._lock.locked())
+            return read_rows(since)
+        availability.read_rows = read_rows_unlocked
+        try:
+            time.sleep(0.01)
+            self.assertFalse(availability.is_available('username', 'late'))
+        finally:
+            availability.read_rows = read_rows
+        # the users are read without holding the lock of the filter
+        self.assertEqual([False], locked)
+
+    @override_settings(AVAILABILITY_REBUILD_INTERVAL=0)
+    def test_rebuild(self):
+        state = availability.get_state()
+        time.sleep(0.01)
+        # rebuilt by a single thread, the others use the current filter meanwhile
+        availability._build_lock.acquire()
+        try:
+            self.assertTrue(availability.get_state() is state)
+        finally:
+            availability._build_lock.release()
+        self.assertFalse(availability.get_state() is state)
+        self.assertFalse(availability.is_available('username', 'u1'))
+
+    def test_get_available(self):
+        response = self.client.get('/api/v1/user/available/?username=u1&email=new@email.com')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'username': False, 'email': True}, json.loads(response.content))
+        self.assertEqual(400, self.client.get('/api/v1/user/available/').status_code)
+
+
 class FollowTest(BaseTestCase):
 
     def test_non_reflexive(self):
@@ -274,9 +399,1072 @@ class PostResourceTest(BaseTestCase):
         request = HttpRequest() # request mock
         request.user = self.u1
         post_resource = PostResource()
-        feed = post_resource.get_feed(request)
-        expected_result = [self.p11, self.p12, self.p13, self.p21, self.p22, self.p23, self.p31]
-        self.assertEqual(expected_result, list(feed))
+        expected_result = [self.p31, self.p23, self.p22, self.p21, self.p13, self.p12, self.p11]
+        for engine in ('merge', 'query'):
+            with self.settings(FEED_ENGINE=engine):
+                feed = post_resource.get_feed(request)
+                self.assertEqual(expected_result, list(feed[0:20]))
+                self.assertEqual(expected_result[2:5], list(feed[2:5]))
+                self.assertEqual(7, feed.exact_count() if engine == 'merge' else feed.count())
+
+    def test_merged_feed(self):
+        # u2 follows u3 and u4, shared p31 and u4 shared p11 and p31
+        request = HttpRequest()
+        request.user = self.u2
+        objects = PostResource().obj_get_list(request)
+        expected_result = [self.p33, self.p32, self.p31, self.p23, self.p22, self.p21, self.p11]
+        with self.settings(FEED_MERGE_MAX_STREAMS=1):
+            feed = MergedFeed(objects, self.u2.pk)
+            self.assertEqual(expected_result, list(feed[0:20]))
+            self.assertEqual(expected_result[3:6], list(feed[3:6]))
+            self.assertEqual(self.p31, feed[2])
+            self.assertIsNone(feed.count())
+            self.assertEqual(7, feed.exact_count())
+
+
+    def test_feed_cursor(self):
+        # u2 follows u3 and u4, shared p31 and u4 shared p11 and p31
+        auth = 'api_user=u2&api_key=%s' % ApiKey.objects.get(user=self.u2).key
+        data = json.loads(self.client.get('/api/v1/feed/?limit=2&%s' % auth).content)
+        texts = [post['text'] for post in data['objects']]
+        connection = connections['default']
+        connection.use_debug_cursor = True
+        try:
+            while data['meta']['next']:
+                del connection.queries[:]
+                data = json.loads(self.client.get(data['meta']['next']).content)
+                texts.extend(post['text'] for post in data['objects'])
+                # every source reads a page, whatever its depth
+                posts = [query['sql'] for query in connection.queries
+                         if 'FROM "microblog_app_post"' in query['sql'] and 'ORDER BY' in query['sql']]
+                self.assertTrue(posts and all(sql.endswith('LIMIT 3') for sql in posts), posts)
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(['p33', 'p32', 'p31', 'p23', 'p22', 'p21', 'p11'], texts)
+
+    def test_dehydrate_keeps_no_request_state(self):
+        # Resources are shared between concurrent requests, related fields must not keep per request state.
+        request = HttpRequest()
+        request.user = self.u1
+        post_resource = PostResource()
+        bundle = post_resource.full_dehydrate(post_resource.build_bundle(obj=self.p21, request=request))
+        self.assertEqual(self.u2.username, bundle.data['user'].data['username'])
+        self.assertFalse(getattr(post_resource.fields['user'], 'fk_resource', None))
+
+
+class RelatedFieldsTest(BaseTestCase):
+
+    def test_uris_from_foreign_keys(self):
+        request = HttpRequest()
+        request.user = self.u1
+        like_resource = LikeResource()
+        likes = list(Like.objects.order_by('id'))
+        # the URIs are built from user_id and post_id, without loading users and posts
+        with self.assertNumQueries(0):
+            bundles = [like_resource.full_dehydrate(like_resource.build_bundle(obj=like, request=request)) for like in likes]
+        self.assertEqual(UserResource().get_resource_uri(self.u1), bundles[0].data['user'])
+        self.assertEqual(PostResource().get_resource_uri(self.p21), bundles[0].data['post'])
+        post_resource = PostResource()
+        bundle = post_resource.full_dehydrate(post_resource.build_bundle(obj=self.p11, request=request))
+        self.assertIsNone(bundle.data['in_reply_to'])
+
+    def test_full_fields_are_joined(self):
+        request = HttpRequest()
+        request.user = self.u1
+        posts = list(PostResource().get_object_list(request))
+        with self.assertNumQueries(0):
+            self.assertEqual(['u1', 'u1', 'u1'], [post.user.username for post in posts[:3]])
+
+    def test_pks_from_uris(self):
+        auth = 'api_user=u1&api_key=%s' % ApiKey.objects.get(user=self.u1).key
+        data = json.dumps({
+            'user': UserResource().get_resource_uri(self.u1),
+            'post': PostResource().get_resource_uri(self.p31),
+        })
+        # the authentication, the post is checked to exist, the like and its notification;
+        # neither the user nor the post are saved again
+        with self.assertNumQueries(8):
+            response = self.client.post('/api/v1/like/?%s' % auth, data=data, content_type='application/json')
+        self.assertEqual(201, response.status_code)
+        self.assertTrue(Like.objects.filter(user=self.u1, post=self.p31).exists())
+        request = HttpRequest()
+        request.user = self.u1
+        like_resource = LikeResource()
+        bundle = like_resource.build_bundle(data={
+            'user': UserResource().get_resource_uri(self.u1),
+            'post': PostResource().get_resource_uri_for_pk(0),
+        }, request=request)
+        self.assertRaises(ApiFieldError, like_resource.full_hydrate, bundle)
+
+    def test_reply_by_uri(self):
+        api_key = ApiKey.objects.get(user=self.u1).key
+        response = self.client.post('/api/v1/post/?api_user=u1&api_key=%s' % api_key, data=json.dumps({
+            'user': UserResource().get_resource_uri(self.u1),
+            'in_reply_to': PostResource().get_resource_uri(self.p21),
+            'text': 'reply',
+        }), content_type='application/json')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(self.p21, Post.objects.get(text='reply').in_reply_to)
+        response = self.client.post('/api/v1/post/?api_user=u1&api_key=%s' % api_key, data=json.dumps({
+            'user': UserResource().get_resource_uri(self.u1),
+            'in_reply_to': PostResource().get_resource_uri_for_pk(0),
+            'text': 'reply',
+        }), content_type='application/json')
+        self.assertEqual(400, response.status_code)
+
+
+class CachedUriTest(BaseTestCase):
+
+    def test_same_uris_as_reverse(self):
+        resource = v1_api.canonical_resource_for('user')
+        self.assertEqual(ModelResource.get_resource_uri(resource, self.u1), resource.get_resource_uri(self.u1))
+        self.assertEqual(ModelResource.get_resource_uri(resource, self.u2), resource.get_resource_uri(self.u2))
+        self.assertEqual('/api/v1/user/%i/followers/' % self.u2.pk,
+                         cached_reverse(resource, 'api_get_followers', resource_name='user', pk=self.u2.pk))
+        self.assertEqual('/api/v1/feed/', cached_reverse(resource, 'api_dispatch_feed'))
+        self.assertEqual('/api/v1/user/', resource.get_resource_list_uri())
+
+
+class FastJSONSerializerTest(BaseTestCase):
+
+    def test_same_data_as_tastypie(self):
+        request = HttpRequest()
+        request.user = self.u1
+        resource = PostResource()
+        bundles = [resource.full_dehydrate(resource.build_bundle(obj=post, request=request)) for post in Post.objects.all()]
+        data = {'meta': {'limit': 20, 'next': None}, 'objects': bundles}
+        expected = json.loads(Serializer().to_json(data))
+        self.assertEqual(expected, json.loads(FastJSONSerializer().to_json(data)))
+        self.assertEqual(set(['u1', 'u2', 'u3']), set(post['user']['username'] for post in expected['objects']))
+
+
+class ArchiveTest(BaseTestCase):
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        cache.clear()
+        self.reply = Post(user=self.u2, in_reply_to=self.p12, text='reply to p12')
+        self.reply.save()
+        old = timezone.now() - timedelta(days=settings.POST_ARCHIVE_AGE_DAYS + 1)
+        Post.objects.filter(pk__in=[self.p11.pk, self.p12.pk]).update(created_date=old)
+
+    def test_archive_posts(self):
+        self.assertEqual(1, archive_posts())
+        self.assertFalse(Post.objects.filter(pk=self.p11.pk).exists())
+        archived = ArchivedPost.objects.get(pk=self.p11.pk)
+        self.assertEqual('p11', archived.text)
+        self.assertEqual(1, archived.liked_by_count())
+        self.assertEqual(1, archived.shared_by_count())
+        self.assertFalse(Like.objects.filter(pk=self.l311.pk).exists())
+        self.assertTrue(ArchivedLike.objects.filter(user=self.u3, post=archived).exists())
+        # p12 has a reply in the hot table, so it's not archived
+        self.assertTrue(Post.objects.filter(pk=self.p12.pk).exists())
+
+    def test_reply_while_archiving(self):
+        archivable_posts = archive.archivable_posts
+
+        def reply_and_select(cutoff):
+            # p11 gets a reply after being selected
+            posts = archivable_posts(cutoff)
+            Post.objects.create(user=self.u3, in_reply_to=self.p11, text='late reply')
+            return posts
+        archive.archivable_posts = reply_and_select
+        try:
+            self.assertEqual(0, archive_chunk(timezone.now() - archive.get_archive_age(), 10)[1])
+        finally:
+            archive.archivable_posts = archivable_posts
+        self.assertTrue(Post.objects.filter(pk=self.p11.pk, replies__text='late reply').exists())
+        self.assertFalse(ArchivedPost.objects.filter(pk=self.p11.pk).exists())
+
+    def test_api(self):
+        archive_posts()
+        api_key = ApiKey.objects.get(user=self.u1).key
+        auth = 'api_user=u1&api_key=%s' % api_key
+        response = self.client.get('/api/v1/post/%i/?%s' % (self.p11.pk, auth))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('p11', json.loads(response.content)['text'])
+        # the archive is only read past the recent posts
+        response = self.client.get('/api/v1/feed/?limit=3&%s' % auth)
+        data = json.loads(response.content)
+        texts = [post['text'] for post in data['objects']]
+        # the merged feed is paginated with a cursor
+        self.assertTrue('cursor=' in data['meta']['next'])
+        while data['meta']['next']:
+            data = json.loads(self.client.get(data['meta']['next']).content)
+            texts.extend(post['text'] for post in data['objects'])
+        self.assertEqual(8, len(set(texts)))
+        self.assertEqual('p11', texts[-1])
+        # offsets are still supported, the merged feed isn't counted while the pages are full
+        response = self.client.get('/api/v1/feed/?limit=2&offset=0&%s' % auth)
+        data = json.loads(response.content)
+        self.assertIsNone(data['meta']['total_count'])
+        self.assertTrue('offset=2' in data['meta']['next'])
+        for offset in (6, 7):
+            response = self.client.get('/api/v1/feed/?limit=2&offset=%i&%s' % (offset, auth))
+            data = json.loads(response.content)
+            self.assertEqual(8, data['meta']['total_count'])
+            self.assertEqual('p11', data['objects'][-1]['text'])
+        response = self.client.get('/api/v1/post/search/?q=p11&%s' % auth)
+        self.assertEqual(['p11'], [post['text'] for post in json.loads(response.content)['objects']])
+
+
+class PurgeTest(BaseTestCase):
+
+    def setUp(self):
+        super(PurgeTest, self).setUp()
+        cache.clear()
+        self.reply = Post(user=self.u1, in_reply_to=self.p22, text='reply to p22')
+        self.reply.save()
+
+    def test_delete_user(self):
+        api_key = ApiKey.objects.get(user=self.u1).key
+        auth = 'api_user=u1&api_key=%s' % api_key
+        response = self.client.delete('/api/v1/user/%i/?%s' % (self.u2.pk, auth))
+        self.assertEqual(204, response.status_code)
+        # hidden at once, but nothing is deleted yet
+        self.assertEqual(404, self.client.get('/api/v1/user/%i/?%s' % (self.u2.pk, auth)).status_code)
+        self.assertEqual(404, self.client.get('/api/v1/post/%i/?%s' % (self.p21.pk, auth)).status_code)
+        response = self.client.get('/api/v1/feed/?%s' % auth)
+        self.assertEqual(['reply to p22', 'p13', 'p12', 'p11'], [post['text'] for post in json.loads(response.content)['objects']])
+        self.assertTrue(Like.objects.filter(post=self.p21).exists())
+
+        # some of the posts are archived before the purge
+        Post.objects.update(created_date=timezone.now() - timedelta(days=settings.POST_ARCHIVE_AGE_DAYS + 1))
+        self.assertTrue(archive_posts() > 0)
+        self.assertTrue(purge_deleted(chunk_size=2) > 0)
+        self.assertFalse(User.objects.filter(pk=self.u2.pk).exists())
+        self.assertFalse(auth_models.User.objects.filter(pk=self.u2.pk).exists())
+        self.assertFalse(Post.objects.filter(user=self.u2.pk).exists())
+        self.assertFalse(ArchivedPost.objects.filter(user=self.u2.pk).exists())
+        self.assertFalse(Follow.objects.filter(follower=self.u2.pk).exists())
+        self.assertFalse(ApiKey.objects.filter(user=self.u2.pk).exists())
+        # replies are purged with the post they reply to
+        self.assertFalse(Post.objects.filter(pk=self.reply.pk).exists())
+        self.assertTrue(Post.objects.filter(pk=self.p11.pk).exists() or ArchivedPost.objects.filter(pk=self.p11.pk).exists())
+        purge = Purge.objects.get(kind=Purge.USER, object_id=self.u2.pk)
+        self.assertIsNotNone(purge.finished_date)
+        self.assertTrue(purge.deleted_rows > 10)
+
+    def test_delete_post(self):
+        api_key = ApiKey.objects.get(user=self.u2).key
+        response = self.client.delete('/api/v1/post/%i/?api_user=u2&api_key=%s' % (self.p22.pk, api_key))
+        self.assertEqual(204, response.status_code)
+        self.assertFalse(PostResource().get_object_list(None).filter(pk=self.p22.pk).exists())
+        # the reply, its notification (and its actor) and both posts
+        self.assertEqual(5, purge_deleted())
+        self.assertFalse(Post.objects.filter(pk__in=[self.p22.pk, self.reply.pk]).exists())
+        self.assertEqual(0, purge_deleted())
+
+    def test_purges_are_separate(self):
+        reply = Post(user=self.u3, in_reply_to=self.reply, text='reply to the reply')
+        reply.save()
+        other = delete_post(self.p31)
+        purge = delete_post(self.p22)
+        total = purge_deleted(chunk_size=1)
+        # both replies, their notifications (and their actors) and the three posts
+        self.assertEqual(9, Purge.objects.get(pk=purge.pk).deleted_rows)
+        self.assertEqual(total - 9, Purge.objects.get(pk=other.pk).deleted_rows)
+        self.assertFalse(Post.objects.filter(pk__in=[self.p22.pk, self.reply.pk, reply.pk, self.p31.pk]).exists())
+        self.assertTrue(Post.objects.filter(pk=self.p21.pk).exists())
+
+    def test_bounded_chunks(self):
+        replies = [Post.objects.create(user=self.u3, in_reply_to=self.p22, text='reply %i' % i) for i in range(5)]
+        for i in range(3):
+            Post.objects.create(user=self.u1, in_reply_to=replies[0], text='reply to reply %i' % i)
+        purge = delete_post(self.p22)
+        connection = connections['default']
+        connection.use_debug_cursor = True
+        del connection.queries[:]
+        try:
+            while purge_chunk(purge, 2) is not None:
+                pass
+            in_lists = [len(values.split(',')) for query in connection.queries for values in re.findall(r' IN \(([^()]*)\)', query['sql'])]
+        finally:
+            connection.use_debug_cursor = None
+        # no chunk reads the whole thread
+        self.assertTrue(in_lists)
+        self.assertEqual(2, max(in_lists))
+        self.assertFalse(Post.objects.filter(Q(pk=self.p22.pk) | Q(text__startswith='reply')).exists())
+        self.assertFalse(PurgedPost.objects.exists())
+
+
+class NDJSONTest(BaseTestCase):
+
+    def test_export_import(self):
+        reply = Post(user=self.u1, in_reply_to=self.p31, text='reply to p31')
+        reply.save()
+        out = StringIO()
+        counts = export_ndjson(out, user_ids=[self.u1.pk, self.u2.pk], chunk_size=2)
+        self.assertEqual({'user': 2, 'post': 7, 'follow': 1, 'like': 2, 'share': 0}, counts)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(['user', 'post', 'follow', 'like'], sorted(set(record['model'] for record in records), key=[record['model'] for record in records].index))
+        # the reply to a post that isn't exported is exported as a post
+        self.assertEqual(None, [record for record in records if record.get('text') == 'reply to p31'][0]['in_reply_to_id'])
+        post_ids = [record['id'] for record in records if record['model'] == 'post']
+        self.assertEqual(sorted(post_ids), post_ids)
+
+        user_offset = auth_models.User.objects.latest('id').pk
+        post_offset = Post.objects.latest('id').pk
+        # usernames are unique, as if importing in another database
+        for user in User.objects.all():
+            user.username = user.email = 'old_%s' % user.username
+            user.save()
+        out.seek(0)
+        self.assertEqual(counts, import_ndjson(out, batch_size=3))
+        u1 = User.objects.get(pk=self.u1.pk + user_offset)
+        self.assertEqual(('u1', 'u1@email.com'), (u1.username, u1.email))
+        self.assertTrue(ApiKey.objects.filter(user=u1).exists())
+        p11 = Post.objects.get(pk=self.p11.pk + post_offset)
+        self.assertEqual(('p11', u1), (p11.text, p11.user))
+        self.assertEqual(self.p11.created_date, p11.created_date)
+        self.assertTrue(Follow.objects.filter(follower=u1, followee=self.u2.pk + user_offset).exists())
+        self.assertTrue(Like.objects.filter(user=u1, post=self.p21.pk + post_offset).exists())
+        # the sequences continue after the imported ids
+        self.assertTrue(Post.objects.create(user=u1, text='new').pk > p11.pk)
+
+    def test_export_replies_since(self):
+        Post.objects.filter(pk=self.p11.pk).update(created_date=timezone.now() - timedelta(days=2))
+        Post(user=self.u2, in_reply_to=self.p11, text='reply to p11').save()
+        Post(user=self.u2, in_reply_to=self.p12, text='reply to p12').save()
+        out = StringIO()
+        export_ndjson(out, since=timezone.now() - timedelta(days=1))
+        records = dict((record.get('text'), record) for record in map(json.loads, out.getvalue().splitlines()))
+        # p11 is older, p12 is exported before its reply
+        self.assertFalse('p11' in records)
+        self.assertIsNone(records['reply to p11']['in_reply_to_id'])
+        self.assertEqual(self.p12.pk, records['reply to p12']['in_reply_to_id'])
+
+    def test_import_large_batches(self):
+        # more rows than fit in a single insert on SQLite
+        out = StringIO()
+        for i in range(300):
+            out.write(json.dumps({'model': 'user', 'id': i + 1, 'username': 'user%i' % i, 'email': 'user%i@email.com' % i,
+                                  'password': '', 'first_name': '', 'last_name': '', 'is_active': True,
+                                  'date_joined': '2013-01-01T00:00:00+00:00', 'last_login': '2013-01-01T00:00:00+00:00',
+                                  'avatar_url': ''}) + '\n')
+        for i in range(300):
+            out.write(json.dumps({'model': 'post', 'id': i + 1, 'user_id': 1, 'in_reply_to_id': None, 'text': 'post %i' % i,
+                                  'created_date': '2013-01-01T00:00:00+00:00', 'modified_date': '2013-01-01T00:00:00+00:00'}) + '\n')
+        out.seek(0)
+        connection = connections['default']
+        connection.use_debug_cursor = True
+        try:
+            self.assertEqual({'user': 300, 'post': 300, 'follow': 0, 'like': 0, 'share': 0}, import_ndjson(out))
+            inserts = [query for query in connection.queries if query['sql'].startswith('INSERT INTO "microblog_app_post"')]
+        finally:
+            connection.use_debug_cursor = None
+        # every insert binds at most 999 values
+        self.assertTrue(len(inserts) >= 300 * len(Post._meta.local_fields) / 999.0)
+        self.assertEqual(300, Post.objects.filter(text__startswith='post ').count())
+
+
+@override_settings(ROLLUP_LAG=0)
+class RollupTest(BaseTestCase):
+
+    def setUp(self):
+        super(RollupTest, self).setUp()
+        cache.clear()
+        Post(user=self.u1, in_reply_to=self.p21, text='reply to p21').save()
+
+    def test_rollup(self):
+        self.assertEqual(20, rollup(chunk_size=4))
+        today = timezone.now().date()
+        stats = DailyStats.objects.get(user=self.u2, date=today)
+        self.assertEqual((3, 2, 0, 1, 1, 0), (stats.posts, stats.likes_received, stats.shares_received,
+            stats.replies_received, stats.followers_gained, stats.followers_lost))
+        # only new rows are rolled up, unfollows are counted when they happen
+        self.assertEqual(0, rollup())
+        Like(user=self.u4, post=self.p22).save()
+        self.f12.delete()
+        self.assertEqual(1, rollup())
+        stats = DailyStats.objects.get(user=self.u2, date=today)
+        self.assertEqual((3, 1), (stats.likes_received, stats.followers_lost))
+
+    def test_lag(self):
+        Post.objects.filter(pk__lte=self.p21.pk).update(created_date=timezone.now() - timedelta(minutes=10))
+        with self.settings(ROLLUP_LAG=60):
+            rollup()
+        # the posts up to p21 are rolled up, the ones after it are recent
+        self.assertEqual(self.p21.pk, RollupWatermark.objects.get(name='post').last_id)
+        self.assertTrue(rollup() > 0)
+        self.assertEqual(Post.objects.latest('id').pk, RollupWatermark.objects.get(name='post').last_id)
+
+    def test_stats_endpoint(self):
+        rollup()
+        DailyStats.objects.create(user=self.u2, date=timezone.now().date() - timedelta(days=40), posts=5)
+        api_key = ApiKey.objects.get(user=self.u1).key
+        auth = 'api_user=u1&api_key=%s' % api_key
+        response = self.client.get('/api/v1/user/%i/stats/?%s' % (self.u2.pk, auth))
+        self.assertEqual(200, response.status_code)
+        content = json.loads(response.content)
+        self.assertEqual(1, len(content['objects']))
+        self.assertEqual(3, content['totals']['posts'])
+        response = self.client.get('/api/v1/user/%i/stats/?since=2000-01-01&%s' % (self.u2.pk, auth))
+        content = json.loads(response.content)
+        self.assertEqual(2, len(content['objects']))
+        self.assertEqual(8, content['totals']['posts'])
+        self.assertEqual(400, self.client.get('/api/v1/user/%i/stats/?since=yesterday&%s' % (self.u2.pk, auth)).status_code)
+
+
+class AdminTest(BaseTestCase):
+
+    def setUp(self):
+        super(AdminTest, self).setUp()
+        admin = User(username='admin', email='admin@email.com', is_staff=True, is_superuser=True)
+        admin.set_password('admin')
+        admin.save()
+        self.client.login(username='admin', password='admin')
+
+    def test_changelists(self):
+        year = timezone.now().year
+        for model in ('user', 'post', 'follow', 'like', 'share'):
+            response = self.client.get('/admin/microblog_app/%s/' % model)
+            self.assertEqual(200, response.status_code)
+        response = self.client.get('/admin/microblog_app/post/?created_date__year=%i' % year)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(9, response.context['cl'].result_count)
+        self.assertEqual(9, response.context['cl'].full_result_count)
+        # foreign keys are edited as ids
+        response = self.client.get('/admin/microblog_app/like/%i/' % self.l121.pk)
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+
+    def test_estimated_count_paginator(self):
+        self.assertEqual(9, EstimatedCountPaginator(Post.objects.all(), 2).count)
+        self.assertEqual(3, EstimatedCountPaginator(Post.objects.filter(user=self.u1), 2).count)
+
+
+class TagTest(BaseTestCase):
+
+    def setUp(self):
+        super(TagTest, self).setUp()
+        cache.clear()
+        self.auth = 'api_user=u1&api_key=%s' % ApiKey.objects.get(user=self.u1).key
+
+    def test_index_on_save(self):
+        post = Post(user=self.u1, text='#Django and #django, not a#tag, hi @u2 @nobody')
+        post.save()
+        self.assertEqual(['django'], [tag.hashtag.name for tag in post.tags.all()])
+        self.assertEqual([self.u2.pk], [mention.user_id for mention in post.mentions.all()])
+        post.text = '#python @u3'
+        post.save()
+        self.assertEqual(['python'], [tag.hashtag.name for tag in post.tags.all()])
+        self.assertEqual([self.u3.pk], [mention.user_id for mention in post.mentions.all()])
+
+    def test_backfill(self):
+        Post.objects.filter(pk=self.p11.pk).update(text='old #tag')
+        Post.objects.filter(pk=self.p21.pk).update(text='old @u1')
+        self.assertEqual(2, backfill_tags(chunk_size=1))
+        self.assertTrue(PostTag.objects.filter(post=self.p11, hashtag__name='tag').exists())
+        self.assertTrue(Mention.objects.filter(post=self.p21, user=self.u1).exists())
+        # running it again doesn't duplicate them
+        backfill_tags()
+        self.assertEqual(1, PostTag.objects.count())
+
+    def test_tag_posts(self):
+        for i in range(3):
+            Post(user=self.u2, text='post %i #Topic' % i).save()
+        Post(user=self.u2, text='#topics').save()
+        response = self.client.get('/api/v1/tag/topic/posts/?limit=2&%s' % self.auth)
+        self.assertEqual(200, response.status_code)
+        content = json.loads(response.content)
+        self.assertEqual(['post 2 #Topic', 'post 1 #Topic'], [post['text'] for post in content['objects']])
+        response = self.client.get(content['meta']['next'])
+        content = json.loads(response.content)
+        self.assertEqual(['post 0 #Topic'], [post['text'] for post in content['objects']])
+        self.assertEqual(None, content['meta']['next'])
+
+    def test_mentions(self):
+        Post(user=self.u2, text='hi @u1').save()
+        Post(user=self.u3, text='@u1 hi').save()
+        response = self.client.get('/api/v1/user/%i/mentions/?%s' % (self.u1.pk, self.auth))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['@u1 hi', 'hi @u1'], [post['text'] for post in json.loads(response.content)['objects']])
+        self.assertEqual(404, self.client.get('/api/v1/user/0/mentions/?%s' % self.auth).status_code)
+
+    def test_archived_posts_indexed(self):
+        old = Post(user=self.u2, text='old #topic @u1')
+        old.save()
+        Post(user=self.u2, text='new #topic @u1').save()
+        Post.objects.filter(pk=old.pk).update(created_date=timezone.now() - timedelta(days=settings.POST_ARCHIVE_AGE_DAYS + 1))
+        archive_posts()
+        self.assertTrue(ArchivedPost.objects.filter(pk=old.pk).exists())
+        self.assertFalse(PostTag.objects.filter(post=old.pk).exists() or Mention.objects.filter(post=old.pk).exists())
+        self.assertTrue(ArchivedPostTag.objects.filter(post=old.pk).exists() and ArchivedMention.objects.filter(post=old.pk).exists())
+        # the archived posts follow the hot ones
+        for uri in ['/api/v1/tag/topic/posts/', '/api/v1/user/%i/mentions/' % self.u1.pk]:
+            content = json.loads(self.client.get('%s?limit=1&%s' % (uri, self.auth)).content)
+            texts = [post['text'] for post in content['objects']]
+            while content['meta']['next']:
+                content = json.loads(self.client.get(content['meta']['next']).content)
+                texts.extend(post['text'] for post in content['objects'])
+            self.assertEqual(['new #topic @u1', 'old #topic @u1'], texts)
+
+
+class FragmentTest(BaseTestCase):
+
+    def setUp(self):
+        super(FragmentTest, self).setUp()
+        cache.clear()
+
+    def dehydrate_authors(self, viewer):
+        posts = list(Post.objects.filter(user=self.u1).select_related('user'))
+        request = HttpRequest()
+        request.user = viewer
+        resource = UserResource()
+        return [resource.full_dehydrate(resource.build_bundle(obj=post.user, request=request)).data for post in posts]
+
+    def test_fragments(self):
+        # the fragment is dehydrated once per request, then read from the cache
+        with self.assertNumQueries(8):
+            authors = self.dehydrate_authors(self.u2)
+        self.assertEqual([0, 0, 0], [author['followers_count'] for author in authors])
+        # only the viewer fields are dehydrated
+        with self.assertNumQueries(4):
+            authors = self.dehydrate_authors(self.u2)
+        # viewer fields aren't cached
+        self.assertEqual(False, authors[0]['followed_by_current_user'])
+        Follow(follower=self.u4, followee=self.u1).save()
+        authors = self.dehydrate_authors(self.u4)
+        self.assertEqual((1, True), (authors[0]['followers_count'], authors[0]['followed_by_current_user']))
+        self.u1.first_name = 'First'
+        self.u1.save()
+        self.assertEqual('First', self.dehydrate_authors(self.u4)[0]['first_name'])
+
+    def test_timeout(self):
+        # changes in other workers aren't seen with a per process cache, fragments expire soon
+        self.assertEqual(settings.USER_FRAGMENT_LOCAL_TIMEOUT, fragments.get_timeout())
+        is_shared = cache_backends.is_shared
+        cache_backends.is_shared = lambda: True
+        try:
+            self.assertEqual(settings.USER_FRAGMENT_TIMEOUT, fragments.get_timeout())
+        finally:
+            cache_backends.is_shared = is_shared
+
+
+class ShardingTest(BaseTestCase):
+
+    def setUp(self):
+        super(ShardingTest, self).setUp()
+        cache.clear()
+        self.shards = ['shard0', 'shard1']
+        for alias in self.shards:
+            connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+            connections.ensure_defaults(alias)
+        self.override = override_settings(SHARDS=self.shards)
+        self.override.enable()
+        reset_id_blocks()
+        for alias in self.shards:
+            call_command('syncdb', database=alias, interactive=False, verbosity=0)
+        self.reply = Post(user=self.u1, in_reply_to=self.p31, text='reply to p31')
+        self.reply.save()
+        self.moved = rebalance(chunk_size=2)
+        self.auth = 'api_user=u1&api_key=%s' % ApiKey.objects.get(user=self.u1).key
+
+    def tearDown(self):
+        self.override.disable()
+        reset_id_blocks()
+        for alias in self.shards:
+            connections[alias].close()
+            del connections.databases[alias]
+            delattr(connections._connections, alias)
+        super(ShardingTest, self).tearDown()
+
+    def test_rebalance(self):
+        # the reply was written to its shard, the rest were in the default database
+        self.assertEqual({'Post': 9, 'Notification': 7}, self.moved)
+        self.assertFalse(Post.objects.using('default').exists())
+        for user in (self.u1, self.u2, self.u3):
+            shard = get_shard(user.pk)
+            self.assertEqual(user.posts_count(), Post.objects.using(shard).filter(user=user).count())
+            self.assertEqual('u1', User.objects.using(shard).get(pk=self.u1.pk).username)
+        self.assertEqual(4, self.u1.posts_count())
+        shard = get_shard(self.u2.pk)
+        self.assertEqual(2, Like.objects.using(shard).filter(post=self.p21.pk).count())
+        self.assertEqual(3, Notification.objects.using(get_shard(self.u3.pk)).filter(user=self.u3).count())
+        # with their actors
+        notifications = Notification.objects.using(get_shard(self.u3.pk)).filter(user=self.u3)
+        self.assertEqual(sum(notifications.values_list('actors_count', flat=True)),
+                         NotificationActor.objects.using(get_shard(self.u3.pk)).filter(notification__user=self.u3).count())
+        # nothing is left to move
+        self.assertEqual({'Post': 0, 'Notification': 0}, rebalance())
+
+    def test_writes(self):
+        post = Post(user=self.u4, text='new #post')
+        post.save()
+        self.assertEqual(get_shard(self.u4.pk), post._state.db)
+        self.assertTrue(post.pk > self.reply.pk)
+        like = Like(user=self.u1, post=post)
+        like.save()
+        self.assertEqual(post._state.db, like._state.db)
+        self.assertEqual(1, post.liked_by_count())
+        self.assertEqual(1, PostTag.objects.using(post._state.db).filter(post=post).count())
+        other = Post(user=self.u1, text='other')
+        other.save()
+        self.assertNotEqual(post.pk, other.pk)
+        self.assertEqual(1, self.p31.replies_count())
+
+    def test_api(self):
+        response = self.client.get('/api/v1/feed/?%s' % self.auth)
+        content = json.loads(response.content)
+        self.assertEqual(['reply to p31', 'p31', 'p23', 'p22', 'p21', 'p13', 'p12', 'p11'],
+                         [post['text'] for post in content['objects']])
+        self.assertIsNone(content['meta']['next'])
+        response = self.client.get('/api/v1/post/%i/?%s' % (self.p21.pk, self.auth))
+        content = json.loads(response.content)
+        self.assertEqual(2, content['likes_count'])
+        self.assertTrue(content['liked_by_current_user'])
+        response = self.client.get('/api/v1/post/search/?q=p&limit=3&%s' % self.auth)
+        content = json.loads(response.content)
+        self.assertEqual(['p21', 'p11'], [post['text'] for post in content['objects']][:2])
+        self.assertEqual(10, content['meta']['total_count'])
+        response = self.client.post('/api/v1/like/?%s' % self.auth, data=json.dumps({
+            'user': '/api/v1/user/%i/' % self.u1.pk,
+            'post': '/api/v1/post/%i/' % self.p31.pk,
+        }), content_type='application/json')
+        self.assertEqual(201, response.status_code)
+        self.assertTrue(Like.objects.using(get_shard(self.u3.pk)).filter(user=self.u1, post=self.p31.pk).exists())
+
+    def test_ndjson(self):
+        # u1 and u4 are in different shards
+        p11 = Post.objects.using(get_shard(self.u1.pk)).get(pk=self.p11.pk)
+        reply = Post(user=self.u4, in_reply_to=p11, text='reply to p11')
+        reply.save()
+        Like(user=self.u1, post=reply).save()
+        out = StringIO()
+        counts = export_ndjson(out, user_ids=[self.u1.pk, self.u4.pk], chunk_size=2)
+        self.assertEqual({'user': 2, 'post': 5, 'follow': 0, 'like': 1, 'share': 1}, counts)
+        records = dict((record.get('text'), record) for record in map(json.loads, out.getvalue().splitlines()))
+        post_ids = [json.loads(line)['id'] for line in out.getvalue().splitlines() if '"model":"post"' in line]
+        self.assertEqual(sorted(post_ids), post_ids)
+        # the reply to a post of another shard keeps it
+        self.assertEqual(self.p11.pk, records['reply to p11']['in_reply_to_id'])
+        self.assertIsNone(records['reply to p31']['in_reply_to_id'])
+
+        user_offset = auth_models.User.objects.latest('id').pk
+        for user in User.objects.all():
+            user.username = user.email = 'old_%s' % user.username
+            user.save()
+        out = StringIO(out.getvalue())
+        self.assertEqual(counts, import_ndjson(out, batch_size=3))
+        u1 = User.objects.get(pk=self.u1.pk + user_offset)
+        u4 = User.objects.get(pk=self.u4.pk + user_offset)
+        self.assertEqual('u4', User.objects.using(get_shard(u1.pk)).get(pk=u4.pk).username)
+        # posts get new ids in the shard of their user, likes and replies follow them
+        reply = Post.objects.using(get_shard(u4.pk)).get(user=u4, text='reply to p11')
+        p11 = Post.objects.using(get_shard(u1.pk)).get(pk=reply.in_reply_to_id)
+        self.assertEqual(('p11', u1.pk), (p11.text, p11.user_id))
+        self.assertNotEqual(self.p11.pk, p11.pk)
+        self.assertTrue(Like.objects.using(get_shard(u4.pk)).filter(post=reply.pk, user=u1).exists())
+        self.assertTrue(Post.objects.create(user=u1, text='new').pk not in [reply.pk, p11.pk])
+
+    def test_background_jobs(self):
+        shard = get_shard(self.u1.pk)
+        Post.objects.using(shard).filter(pk=self.p12.pk).update(text='old #tag')
+        backfill_tags()
+        self.assertTrue(PostTag.objects.using(shard).filter(post=self.p12.pk).exists())
+        Post.objects.using(shard).filter(pk=self.p11.pk).update(
+            created_date=timezone.now() - timedelta(days=settings.POST_ARCHIVE_AGE_DAYS + 1))
+        self.assertEqual(1, archive_posts())
+        self.assertEqual(1, ArchivedPost.objects.get(pk=self.p11.pk).liked_by_count())
+        self.assertFalse(Post.objects.using(shard).filter(pk=self.p11.pk).exists())
+        delete_user(User.objects.get(pk=self.u2.pk))
+        self.assertTrue(purge_deleted() > 0)
+        for alias in ['default'] + self.shards:
+            self.assertFalse(Post.objects.using(alias).filter(user=self.u2.pk).exists())
+            self.assertFalse(Like.objects.using(alias).filter(Q(user=self.u2.pk) | Q(post=self.p21.pk)).exists())
+            self.assertFalse(auth_models.User.objects.using(alias).filter(pk=self.u2.pk).exists())
+
+    def test_rollup(self):
+        # a reply to a post of another shard
+        p11 = Post.objects.using(get_shard(self.u1.pk)).get(pk=self.p11.pk)
+        Post(user=self.u4, in_reply_to=p11, text='reply to p11').save()
+        with self.settings(ROLLUP_LAG=0):
+            self.assertTrue(rollup() > 0)
+            self.assertEqual(0, rollup())
+        self.assertEqual(set(['post', 'post@shard0', 'post@shard1']),
+                         set(RollupWatermark.objects.filter(name__startswith='post').values_list('name', flat=True)))
+        stats = DailyStats.objects.get(user=self.u1, date=timezone.now().date())
+        self.assertEqual((4, 1), (stats.posts, stats.replies_received))
+
+    def test_stream(self):
+        poller = Poller(0)
+        poller.start_from_latest()
+        after_seq = stream_bus.seq
+        # without signals, as by another process
+        Post.objects.using(get_shard(self.u4.pk)).bulk_create([Post(id=10000, user=self.u4, text='new post')])
+        poller.poll()
+        self.assertEqual([10000], [event.id for event in stream_bus.wait(after_seq, 0)])
+
+
+class NotificationTest(BaseTestCase):
+
+    def setUp(self):
+        super(NotificationTest, self).setUp()
+        cache.clear()
+
+    def test_grouping(self):
+        # u1 and u2 liked p21, but u2 liking its own post isn't notified
+        notification = Notification.objects.get(user=self.u2, kind=Notification.LIKE)
+        self.assertEqual(self.p21, notification.post)
+        self.assertEqual(1, notification.actors_count)
+        Like(user=self.u3, post=self.p21).save()
+        notification = Notification.objects.get(user=self.u2, kind=Notification.LIKE)
+        self.assertEqual(2, notification.actors_count)
+        self.assertEqual(self.u3, notification.actor)
+        # once read, new events start a new notification
+        Notification.objects.filter(user=self.u2).update(read=True)
+        Like(user=self.u4, post=self.p21).save()
+        self.assertEqual(2, Notification.objects.filter(user=self.u2, kind=Notification.LIKE).count())
+
+    def test_distinct_actors(self):
+        # repeated events of the same user are counted once
+        for i in range(3):
+            Post(user=self.u4, in_reply_to=self.p31, text='reply %i' % i).save()
+        Like.objects.get(user=self.u1, post=self.p21).delete()
+        Like(user=self.u1, post=self.p21).save()
+        self.assertEqual(1, Notification.objects.get(user=self.u3, kind=Notification.REPLY).actors_count)
+        self.assertEqual(1, Notification.objects.get(user=self.u2, kind=Notification.LIKE).actors_count)
+        self.assertEqual([self.u1.pk], list(NotificationActor.objects.filter(notification__user=self.u2, notification__kind=Notification.LIKE).values_list('actor', flat=True)))
+
+    def test_single_unread_group(self):
+        notification = Notification.objects.get(user=self.u2, kind=Notification.LIKE)
+        duplicate = Notification(user=self.u2, kind=Notification.LIKE, post=self.p21, actor=self.u3, modified_date=timezone.now())
+        self.assertFalse(save_unique(duplicate, 'default'))
+        follow = Notification(user=self.u4, kind=Notification.FOLLOW, actor=self.u1, modified_date=timezone.now())
+        self.assertFalse(save_unique(follow, 'default'))
+        notification.read = True
+        notification.save()
+        self.assertTrue(save_unique(duplicate, 'default'))
+        # it can't be marked unread again
+        api_key = ApiKey.objects.get(user=self.u2).key
+        response = self.client.put('/api/v1/notification/%i/?api_user=u2&api_key=%s' % (notification.pk, api_key),
+                                   json.dumps({'read': False}), content_type='application/json',
+                                   REQUEST_METHOD='PATCH')
+        self.assertEqual(400, response.status_code)
+        self.assertTrue(Notification.objects.get(pk=notification.pk).read)
+
+    def test_follow_and_reply(self):
+        self.assertEqual(2, Notification.objects.get(user=self.u4, kind=Notification.FOLLOW).actors_count)
+        Post(user=self.u4, in_reply_to=self.p31, text='reply to p31').save()
+        notification = Notification.objects.get(user=self.u3, kind=Notification.REPLY)
+        self.assertEqual(self.u4, notification.actor)
+        self.assertEqual(self.p31, notification.post)
+
+    def test_api(self):
+        api_key = ApiKey.objects.get(user=self.u1).key
+        auth = 'api_user=u1&api_key=%s' % api_key
+        # p11 liked by u3 and shared by u4
+        response = self.client.get('/api/v1/notification/?limit=1&%s' % auth)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual(2, data['meta']['unread_count'])
+        self.assertEqual(['share'], [notification['kind'] for notification in data['objects']])
+        response = self.client.get(data['meta']['next'])
+        data = json.loads(response.content)
+        self.assertEqual(['like'], [notification['kind'] for notification in data['objects']])
+        self.assertIsNone(data['meta']['next'])
+        response = self.client.get('/api/v1/notification/?cursor=invalid&%s' % auth)
+        self.assertEqual(400, response.status_code)
+
+        notification = Notification.objects.get(user=self.u1, kind=Notification.LIKE)
+        # PATCH is sent with put, the test client has no patch
+        for read in (True, 'false', 'true', '0'):
+            response = self.client.put('/api/v1/notification/%i/?%s' % (notification.pk, auth),
+                                       json.dumps({'read': read}), content_type='application/json',
+                                       REQUEST_METHOD='PATCH')
+            self.assertEqual(202, response.status_code)
+            self.assertEqual(read in (True, 'true'), Notification.objects.get(pk=notification.pk).read)
+
+        response = self.client.post('/api/v1/notification/read/?%s' % auth)
+        self.assertEqual(204, response.status_code)
+        response = self.client.get('/api/v1/notification/?%s' % auth)
+        self.assertEqual(0, json.loads(response.content)['meta']['unread_count'])
+
+    def test_other_users_notifications(self):
+        api_key = ApiKey.objects.get(user=self.u1).key
+        notification = Notification.objects.get(user=self.u2, kind=Notification.LIKE)
+        response = self.client.get('/api/v1/notification/%i/?api_user=u1&api_key=%s' % (notification.pk, api_key))
+        self.assertEqual(404, response.status_code)
+
+
+class SharedCacheTest(BaseTestCase):
+
+    def setUp(self):
+        super(SharedCacheTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.settings_override = override_settings(SHARED_CACHE_PATH=os.path.join(self.directory, 'cache'),
+                                                   SHARED_CACHE_VERSIONS=16, SHARED_CACHE_SLOTS=64)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        shared_cache._caches.clear()
+        self.settings_override.disable()
+        shutil.rmtree(self.directory)
+        super(SharedCacheTest, self).tearDown()
+
+    def test_get_or_fetch(self):
+        fetch = lambda: Post.objects.get(pk=self.p11.pk)
+        self.assertNumQueries(1, shared_cache.get_or_fetch, Post, self.p11.pk, fetch)
+        with self.assertNumQueries(0):
+            post = shared_cache.get_or_fetch(Post, str(self.p11.pk), fetch)
+        self.assertEqual((self.p11.pk, 'p11', self.u1.pk, 'default'), (post.pk, post.text, post.user_id, post._state.db))
+        shared_cache.get_or_fetch(User, self.u1.pk, lambda: User.objects.get(pk=self.u1.pk))
+        self.assertEqual('u1', shared_cache.get_or_fetch(User, self.u1.pk, None).username)
+        # saving makes the entry stale
+        self.p11.text = 'edited'
+        self.p11.save()
+        self.assertEqual('edited', shared_cache.get_or_fetch(Post, self.p11.pk, fetch).text)
+        shared_cache.clear()
+        self.assertNumQueries(1, shared_cache.get_or_fetch, Post, self.p11.pk, fetch)
+
+    def test_slot_being_written(self):
+        cache = shared_cache.get_cache()
+        key = shared_cache.get_key(Post, self.p11.pk)
+        cache.set(key, cache.get_version(key), 'record', 60)
+        self.assertEqual('record', cache.get(key))
+        offset = cache.get_slot_offset(shared_cache.hash_key(key))
+        sequence = struct.unpack_from('<I', cache.map, offset)[0]
+        struct.pack_into('<I', cache.map, offset, sequence + 1)
+        self.assertIsNone(cache.get(key))
+
+    def test_get_post(self):
+        auth = 'api_user=u1&api_key=%s' % ApiKey.objects.get(user=self.u1).key
+        self.assertEqual(200, self.client.get('/api/v1/post/%i/?%s' % (self.p21.pk, auth)).status_code)
+        response = self.client.get('/api/v1/post/%i/?%s' % (self.p21.pk, auth))
+        self.assertEqual('u2', json.loads(response.content)['user']['username'])
+        # posts of deleted users aren't listed, even when cached
+        delete_user(self.u2)
+        self.assertEqual(404, self.client.get('/api/v1/post/%i/?%s' % (self.p21.pk, auth)).status_code)
+
+    @override_settings(SHARED_CACHE_VERSIONS=65536)
+    def test_purge_invalidates(self):
+        # enough versions for the reply not to share the one of p21
+        reply = Post(user=self.u3, in_reply_to=self.p21, text='reply to p21')
+        reply.save()
+        fetch = lambda: Post.objects.get(pk=reply.pk)
+        shared_cache.get_or_fetch(Post, reply.pk, fetch)
+        purge = delete_post(self.p21)
+        # the first step marks the reply as deleted with an update
+        purge_chunk(purge, 10)
+        self.assertIsNotNone(shared_cache.get_or_fetch(Post, reply.pk, fetch).deleted_date)
+
+
+class CoalesceTest(TestCase):
+
+    def start_threads(self, count, target):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(target())) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_run_once(self):
+        calls = []
+        release = threading.Event()
+        def compute():
+            calls.append(1)
+            release.wait()
+            return 'result'
+        threads, results = self.start_threads(4, lambda: coalesce.run('key', compute))
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['result'] * 4, results)
+        self.assertEqual(1, len(calls))
+
+    def test_leader_failure(self):
+        calls = []
+        release = threading.Event()
+        def compute():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait()
+                raise ValueError()
+            return 'result'
+        leader, failures = self.start_threads(1, lambda: self.assertRaises(ValueError, coalesce.run, 'key', compute))
+        time.sleep(0.02)
+        followers, results = self.start_threads(2, lambda: coalesce.run('key', compute))
+        time.sleep(0.02)
+        release.set()
+        for thread in leader + followers:
+            thread.join()
+        # the followers ran it themselves
+        self.assertEqual(['result', 'result'], results)
+        self.assertEqual(3, len(calls))
+
+    @override_settings(COALESCE_TIMEOUT=0.01)
+    def test_timeout(self):
+        release = threading.Event()
+        leader, results = self.start_threads(1, lambda: coalesce.run('key', lambda: release.wait(1) and 'leader'))
+        time.sleep(0.02)
+        self.assertEqual('follower', coalesce.run('key', lambda: 'follower'))
+        release.set()
+        leader[0].join()
+        self.assertEqual(['leader'], results)
+
+    @override_settings(COALESCE_SHARED=True, COALESCE_POLL_INTERVAL=0.01)
+    def test_shared(self):
+        # another process holds the lock
+        cache.add('coalesce_lock:key', 'other', 5)
+        def finish():
+            time.sleep(0.03)
+            cache.set('coalesce_result:key', ('other', 'shared'))
+            cache.delete('coalesce_lock:key')
+        threads, results = self.start_threads(1, finish)
+        self.assertEqual('shared', coalesce.run('key', lambda: 'computed'))
+        threads[0].join()
+        # the other process failed, the result is computed here
+        cache.add('coalesce_lock:key', 'failed', 5)
+        threads, results = self.start_threads(1, lambda: time.sleep(0.03) or cache.delete('coalesce_lock:key'))
+        self.assertEqual('computed', coalesce.run('key', lambda: 'computed'))
+        threads[0].join()
+        cache.delete('coalesce_result:key')
+
+    def test_query_key(self):
+        key = coalesce.get_query_key(Post.objects.filter(text__icontains='p'))
+        self.assertEqual(key, coalesce.get_query_key(Post.objects.filter(text__icontains='p')))
+        self.assertNotEqual(key, coalesce.get_query_key(Post.objects.filter(text__icontains='q')))
+        self.assertIsNone(coalesce.get_query_key(Post.objects.filter(pk__in=[])))
+
+
+class ExplainTest(BaseTestCase):
+
+    # SQLite commits before an EXPLAIN, so these tests can't run in a transaction.
+    def _fixture_setup(self):
+        TransactionTestCase._fixture_setup(self)
+
+    def _fixture_teardown(self):
+        call_command('flush', verbosity=0, interactive=False)
+
+    def test_find_problems(self):
+        plan = ['Limit', '  ->  Sort', '        ->  Seq Scan on microblog_app_post']
+        problems = find_problems(plan, 'postgresql')
+        self.assertEqual([('sort', None), ('sequential scan', 'microblog_app_post')], problems)
+        self.assertEqual(['CREATE INDEX "microblog_app_post_user_created" ON "microblog_app_post" ("user_id", "created_date");'],
+                         propose_indexes(problems))
+        self.assertEqual([], propose_indexes(problems, existing=['microblog_app_post_user_created']))
+        plan = ['SCAN TABLE microblog_app_follow', 'SCAN microblog_app_like USING COVERING INDEX x', 'USE TEMP B-TREE FOR ORDER BY']
+        self.assertEqual([('sequential scan', 'microblog_app_follow'), ('sort', None)], find_problems(plan, 'sqlite'))
+
+    def test_advise(self):
+        report, indexes = advise()
+        names = [name for name, plan, problems in report]
+        self.assertIn('user posts', names)
+        self.assertIn('feed stream 0', names)
+        self.assertTrue(all(plan for name, plan, problems in report))
+        # the composite indexes are created on syncdb by the sql files
+        self.assertEqual([], indexes)
+
+
+class BenchmarkTest(BaseTestCase):
+
+    def test_measure_all(self):
+        results = measure_all(repeat=1)
+        self.assertEqual(['feed', 'full_dehydrate', 'is_authenticated', 'search'], sorted(results))
+        self.assertTrue(results['feed']['queries'] > 0)
+        self.assertEqual(2, results['is_authenticated']['queries'])
+        self.assertTrue(results['search']['time'] >= 0)
+
+    def test_compare(self):
+        baseline = {'small': {'users': 100, 'benchmarks': {
+            'feed': {'time': 0.010, 'queries': 4, 'memory': 100},
+            'search': {'time': 0.010, 'queries': 1, 'memory': None},
+        }}}
+        results = {'small': {'users': 100, 'benchmarks': {
+            'feed': {'time': 0.011, 'queries': 5, 'memory': 2000},
+            'search': {'time': 0.020, 'queries': 1, 'memory': 0},
+            'new': {'time': 1, 'queries': 1, 'memory': 0},
+        }}}
+        self.assertEqual([('small', 'feed', 'queries', 4, 5), ('small', 'feed', 'memory', 100, 2000),
+                          ('small', 'search', 'time', 0.010, 0.020)], compare(baseline, results))
+        self.assertEqual([('small', 'feed', 'queries', 4, 5), ('small', 'feed', 'memory', 100, 2000)],
+                         compare(baseline, results, threshold=1.5))
+
+
+@override_settings(FEED_STREAM_POLL_INTERVAL=0, FEED_STREAM_HEARTBEAT=0.01, FEED_STREAM_TIMEOUT=1)
+class FeedStreamTest(BaseTestCase):
+
+    def setUp(self):
+        # Ids are reused between tests, which would look like already published events.
+        stream_bus.clear()
+        super(FeedStreamTest, self).setUp()
+
+    def stream_request(self, user, last_event_id=None):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET['api_user'] = user.username
+        request.GET['api_key'] = ApiKey.objects.get(user=user).key
+        if last_event_id:
+            request.META['HTTP_LAST_EVENT_ID'] = last_event_id
+        return request
+
+    def test_stream(self):
+        response = PostResource().dispatch_feed_stream(self.stream_request(self.u1))
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        chunks = iter(response)
+        self.assertTrue(next(chunks).startswith('retry:'))
+        # posts by users not followed are not sent
+        Post(user=self.u3, text='not followed').save()
+        post = Post(user=self.u2, text='new post')
+        post.save()
+        chunk = next(chunks)
+        self.assertTrue('event: post' in chunk)
+        self.assertTrue('"text": "new post"' in chunk)
+        self.assertTrue(chunk.startswith('id: %s\n' % format_cursor(post.created_date)))
+        Share(user=self.u2, post=self.p11).save()
+        self.assertTrue('event: share' in next(chunks))
+        self.assertEqual(': heartbeat\n\n', next(chunks))
+
+    @override_settings(FEED_STREAM_LOOKBACK=0)
+    def test_resume(self):
+        cursor = format_cursor(timezone.now())
+        post = Post(user=self.u2, text='missed post')
+        post.save()
+        Post(user=self.u3, text='not followed').save()
+        chunks = iter(PostResource().dispatch_feed_stream(self.stream_request(self.u1, cursor)))
+        next(chunks)
+        chunk = next(chunks)
+        self.assertTrue('"text": "missed post"' in chunk)
+        self.assertEqual(': heartbeat\n\n', next(chunks), 'Backfilled events should not be sent again')
+
+    def test_late_commit(self):
+        poller = Poller(0)
+        poller.start_from_latest()
+        post = Post(id=1000, user=self.u2, text='new post')
+        post.save()
+        poller.poll()
+        # A lower id committed after the post, without signals, as by a slow transaction of another process.
+        Post.objects.bulk_create([Post(id=999, user=self.u2, text='slow post')])
+        slow = Post.objects.get(pk=999)
+        Post.objects.filter(pk=slow.pk).update(created_date=post.created_date - timedelta(seconds=1))
+        after_seq = stream_bus.seq
+        poller.poll()
+        self.assertEqual([slow.pk], [event.id for event in stream_bus.wait(after_seq, 0)])
+        poller.poll()
+        self.assertEqual(after_seq + 1, stream_bus.seq, 'Posts should be published once')
+        # and it's sent to the clients resuming after the post
+        chunks = iter(PostResource().dispatch_feed_stream(self.stream_request(self.u1, format_cursor(post.created_date))))
+        backfilled = list(iter(chunks.next, ': heartbeat\n\n'))
+        self.assertTrue(any('"text": "slow post"' in chunk for chunk in backfilled))
+
+    def test_poller_survives_errors(self):
+        polled = threading.Event()
+
+        class FlakyPoller(Poller):
+            failures = [DatabaseError('server closed the connection')]
+
+            def poll(self):
+                if self.failures:
+                    raise self.failures.pop()
+                polled.set()
+                # stops the thread
+                raise SystemExit()
+        poller = FlakyPoller(0.01)
+        poller.since = timezone.now()
+        poller.start()
+        self.assertTrue(polled.wait(1), 'The poller should keep polling after an error')
+        poller.join(1)
 
 
 class MicroblogApiKeyAuthenticationTest(BaseTestCase):
@@ -402,4 +1590,152 @@ class MicroblogApiKeyAuthenticationTest(BaseTestCase):
         request.GET[user_identifier] = user.email
         request.GET['api_key'] = 'bad_key'
         self.assertFalse(auth.is_authenticated(request))
-        
\ No newline at end of file
+        
+
+    def test_token_authorization(self):
+        cache.clear()
+        request = HttpRequest()
+        request.META['HTTP_AUTHORIZATION'] = 'Token %s' % issue_token(self.u1)
+        auth = MicroblogApiKeyAuthentication()
+        self.assertTrue(auth.is_authenticated(request))
+        self.assertEqual(self.u1.pk, request.user.pk)
+        # with a per process cache the generation is read every time, revoking in another worker isn't seen
+        with self.assertNumQueries(1):
+            self.assertTrue(auth.is_authenticated(request))
+        is_shared = cache_backends.is_shared
+        cache_backends.is_shared = lambda: True
+        try:
+            self.assertTrue(auth.is_authenticated(request))
+            # verified without DB access once the token generation is cached
+            with self.assertNumQueries(0):
+                self.assertTrue(auth.is_authenticated(request))
+            # deactivating the user drops it
+            self.u1.is_active = False
+            self.u1.save()
+            self.assertFalse(auth.is_authenticated(request))
+            self.u1.is_active = True
+            self.u1.save()
+            self.assertTrue(auth.is_authenticated(request))
+        finally:
+            cache_backends.is_shared = is_shared
+        # query parameter
+        request = HttpRequest()
+        request.GET['access_token'] = issue_token(self.u1)
+        self.assertTrue(auth.is_authenticated(request))
+        # tampered
+        request.GET['access_token'] = issue_token(self.u1)[:-1] + 'x'
+        self.assertFalse(auth.is_authenticated(request))
+        # revoked
+        request.GET['access_token'] = issue_token(self.u1)
+        revoke_tokens(self.u1)
+        self.assertFalse(auth.is_authenticated(request))
+        request.GET['access_token'] = issue_token(self.u1)
+        self.assertTrue(auth.is_authenticated(request))
+        # deleted
+        delete_user(self.u1)
+        self.assertFalse(auth.is_authenticated(request))
+
+    def test_login_issues_token(self):
+        self.u1.set_password('1234')
+        self.u1.save()
+        response = self.client.post('/api/v1/login/', '{"username": "u1", "password": "1234"}', content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual(self.api_key(self.u1), data['api_key'])
+        self.assertEqual(self.u1.pk, verify_token(data['access_token']))
+        response = self.client.get('/api/v1/feed/?access_token=%s' % data['access_token'])
+        self.assertEqual(200, response.status_code)
+
+
+class ThrottleTest(BaseTestCase):
+
+    def setUp(self):
+        super(ThrottleTest, self).setUp()
+        cache.clear()
+
+    def test_sliding_window(self):
+        throttle = SlidingWindowThrottle(throttle_at=2, timeframe=60)
+        self.assertFalse(throttle.should_be_throttled('u1'))
+        throttle.accessed('u1')
+        self.assertFalse(throttle.should_be_throttled('u1'))
+        throttle.accessed('u1')
+        retry_after = throttle.should_be_throttled('u1')
+        self.assertTrue(0 < retry_after <= 60)
+        self.assertFalse(throttle.should_be_throttled('u2'), 'Requestors should be throttled independently')
+
+    def test_headers(self):
+        api_key = ApiKey.objects.get(user=self.u1).key
+        url = '/api/v1/post/?api_user=u1&api_key=%s' % api_key
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(str(settings.API_THROTTLE_AT), response['X-RateLimit-Limit'])
+        self.assertEqual(str(settings.API_THROTTLE_AT - 1), response['X-RateLimit-Remaining'])
+        self.assertFalse(response.has_header('X-RateLimit-Reset'))
+
+    def test_too_many_requests(self):
+        api_key = ApiKey.objects.get(user=self.u1).key
+        url = '/api/v1/post/?api_user=u1&api_key=%s' % api_key
+        PostResource._meta.throttle.throttle_at = 1
+        try:
+            self.assertEqual(200, self.client.get(url).status_code)
+            response = self.client.get(url)
+            self.assertEqual(429, response.status_code)
+            self.assertTrue(int(response['Retry-After']) > 0)
+            self.assertEqual(response['Retry-After'], response['X-RateLimit-Reset'])
+            # Other endpoints have their own limits.
+            self.assertEqual(200, self.client.get('/api/v1/feed/?api_user=u1&api_key=%s' % api_key).status_code)
+        finally:
+            PostResource._meta.throttle.throttle_at = settings.API_THROTTLE_AT
+
+
+# Infrastructure tests
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = ConnectionPool(FakeConnection, 2)
+        conn, is_new = pool.get()
+        self.assertTrue(is_new)
+        pool.put(conn)
+        reused, is_new = pool.get()
+        self.assertFalse(is_new)
+        self.assertTrue(reused is conn)
+        self.assertFalse(conn.closed)
+
+    def test_exhausted(self):
+        pool = ConnectionPool(FakeConnection, 1, timeout=0.01)
+        pool.get()
+        with self.assertRaises(PoolExhausted):
+            pool.get()
+
+    def test_max_age(self):
+        pool = ConnectionPool(FakeConnection, 1, max_age=0.01)
+        conn, is_new = pool.get()
+        time.sleep(0.02)
+        pool.put(conn)
+        self.assertTrue(conn.closed, 'Connections older than max_age should be closed when returned')
+        new_conn, is_new = pool.get()
+        self.assertTrue(is_new)
+        self.assertFalse(new_conn is conn)
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_measure(self):
+        self.assertEqual(['settings', 'models', 'urlconf', 'middleware'], [name for name, seconds in measure()])
+        warm_up()
+
+    def test_profilestartup(self):
+        out = StringIO()
+        call_command('profilestartup', runs=1, stdout=out)
+        self.assertEqual(['settings', 'models', 'urlconf', 'middleware', 'process'],
+                         [line.split()[0] for line in out.getvalue().splitlines()])
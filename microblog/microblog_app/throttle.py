@@ -0,0 +1,133 @@
+import math
+import re
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from tastypie.exceptions import ImmediateHttpResponse
+from tastypie.throttle import BaseThrottle
+
+
+class HttpTooManyRequests(HttpResponse):
+    status_code = 429
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Limits each requestor to ``throttle_at`` requests in any ``timeframe`` seconds.
+
+    Uses the sliding window counter approximation: requests are counted in fixed windows
+    of ``timeframe`` seconds and the count of the previous window is weighted by how much
+    of it still overlaps the sliding window. This takes two counters per requestor stored
+    in the default cache, which must be shared by all the workers (see CACHES in settings),
+    so each check is a single get_many and each access a single incr, with no DB writes.
+
+    Defaults are taken from the API_THROTTLE_AT and API_THROTTLE_TIMEFRAME settings.
+    """
+
+    def __init__(self, throttle_at=None, timeframe=None):
+        if throttle_at is None:
+            throttle_at = getattr(settings, 'API_THROTTLE_AT', 150)
+        if timeframe is None:
+            timeframe = getattr(settings, 'API_THROTTLE_TIMEFRAME', 60)
+        # Counters are only needed while they overlap the sliding window.
+        super(SlidingWindowThrottle, self).__init__(throttle_at, timeframe, expiration=2 * timeframe)
+
+    def convert_identifier_to_key(self, identifier, window=None):
+        key = super(SlidingWindowThrottle, self).convert_identifier_to_key(identifier)
+        return 'throttle_%s_%i' % (key, window)
+
+    def status(self, identifier):
+        """
+        Returns a ``(remaining, retry_after)`` tuple with the number of requests still allowed
+        in the sliding window, and the seconds to wait before the next one is allowed (0 if
+        there are requests remaining).
+        """
+        now = time.time()
+        window = int(now // self.timeframe)
+        current_key = self.convert_identifier_to_key(identifier, window)
+        previous_key = self.convert_identifier_to_key(identifier, window - 1)
+        counts = cache.get_many([current_key, previous_key])
+        current = counts.get(current_key, 0)
+        previous = counts.get(previous_key, 0)
+
+        elapsed = now - window * self.timeframe
+        used = current + previous * (1 - elapsed / self.timeframe)
+        remaining = max(0, self.throttle_at - int(math.ceil(used)))
+        if remaining:
+            return remaining, 0
+        if current >= self.throttle_at or not previous:
+            # Nothing will be allowed until this window becomes the previous one.
+            retry_after = self.timeframe - elapsed
+        else:
+            # Wait until the weight of the previous window leaves room for one more request.
+            retry_after = self.timeframe * (1 - float(self.throttle_at - 1 - current) / previous) - elapsed
+        return remaining, max(1, int(math.ceil(retry_after)))
+
+    def should_be_throttled(self, identifier, **kwargs):
+        """
+        Returns ``False`` if the requestor is allowed, otherwise the seconds to wait.
+        """
+        remaining, retry_after = self.status(identifier)
+        return retry_after if not remaining else False
+
+    def accessed(self, identifier, **kwargs):
+        window = int(time.time() // self.timeframe)
+        key = self.convert_identifier_to_key(identifier, window)
+        if not cache.add(key, 1, self.expiration):
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Expired between add and incr.
+                cache.set(key, 1, self.expiration)
+
+
+class ThrottledResourceMixin(object):
+    """
+    Resource mixin that throttles each requestor per endpoint, and adds the
+    X-RateLimit-Limit and X-RateLimit-Remaining headers to the responses, and Retry-After
+    and X-RateLimit-Reset (both the seconds to wait) to the throttled ones.
+    """
+
+    def get_throttle_identifier(self, request):
+        # Ids in the path are replaced so all the details of a resource are one endpoint.
+        endpoint = re.sub(r'/\d+/', '/*/', request.path)
+        return '%s%s' % (self._meta.authentication.get_identifier(request), endpoint)
+
+    def throttle_check(self, request):
+        throttle = self._meta.throttle
+        if not hasattr(throttle, 'status'):
+            return super(ThrottledResourceMixin, self).throttle_check(request)
+
+        remaining, retry_after = throttle.status(self.get_throttle_identifier(request))
+        request.throttle_status = (throttle.throttle_at, max(0, remaining - 1), retry_after)
+        if not remaining:
+            response = HttpTooManyRequests()
+            response['Retry-After'] = str(retry_after)
+            self.add_throttle_headers(request, response)
+            raise ImmediateHttpResponse(response=response)
+
+    def log_throttled_access(self, request):
+        self._meta.throttle.accessed(self.get_throttle_identifier(request))
+
+    def add_throttle_headers(self, request, response):
+        status = getattr(request, 'throttle_status', None)
+        if status is not None:
+            limit, remaining, retry_after = status
+            response['X-RateLimit-Limit'] = str(limit)
+            response['X-RateLimit-Remaining'] = str(remaining)
+            # The sliding window keeps no time per request, the reset is only known when throttled.
+            if retry_after:
+                response['X-RateLimit-Reset'] = str(retry_after)
+
+    def wrap_view(self, view):
+        wrapper = super(ThrottledResourceMixin, self).wrap_view(view)
+
+        @csrf_exempt
+        def throttled_wrapper(request, *args, **kwargs):
+            response = wrapper(request, *args, **kwargs)
+            self.add_throttle_headers(request, response)
+            return response
+
+        return throttled_wrapper
@@ -0,0 +1,83 @@
+"""
+Short lived signed access tokens.
+
+A token is the signed user id plus the user's token generation, timestamped by
+django.core.signing. Tokens are revoked by incrementing the user's token generation, and
+stop being valid when the user is deactivated or deleted. When the default cache is shared
+by the workers the generation of active users is cached, so verifying doesn't need the
+database (except right after a cache miss). A per-process cache would keep accepting the
+tokens revoked by other workers, so without one the generation is read from the database,
+a single query by pk.
+"""
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import F
+from microblog_app import cache_backends
+
+SALT = 'microblog_app.tokens'
+
+
+def get_lifetime():
+    """
+    Seconds a token is valid for, from the ACCESS_TOKEN_LIFETIME setting.
+    """
+    return getattr(settings, 'ACCESS_TOKEN_LIFETIME', 3600)
+
+
+def generation_cache_key(user_id):
+    return 'token_generation_%s' % user_id
+
+
+def get_generation(user_id):
+    """
+    Returns the token generation of the user, or None if they don't exist or aren't active.
+    """
+    from microblog_app.models import User
+    shared = cache_backends.is_shared()
+    key = generation_cache_key(user_id)
+    generation = cache.get(key) if shared else None
+    if generation is None:
+        generations = list(User.objects.filter(pk=user_id, is_active=True, deleted_date__isnull=True)
+                           .values_list('token_generation', flat=True))
+        if not generations:
+            return None
+        generation = generations[0]
+        if shared:
+            cache.set(key, generation, get_lifetime())
+    return generation
+
+
+def forget_generation(user_id):
+    """
+    Drops the cached generation of the user, whose active state may have changed.
+    """
+    cache.delete(generation_cache_key(user_id))
+
+
+def issue_token(user):
+    return signing.dumps([user.pk, user.token_generation], salt=SALT, compress=False)
+
+
+def verify_token(token):
+    """
+    Returns the id of the user the token was issued to, or None if the token is invalid,
+    expired or revoked.
+    """
+    try:
+        user_id, generation = signing.loads(token, salt=SALT, max_age=get_lifetime())
+    except (signing.BadSignature, ValueError, TypeError):
+        return None
+    if get_generation(user_id) != generation:
+        return None
+    return user_id
+
+
+def revoke_tokens(user):
+    """
+    Invalidates every token issued to the user so far.
+    """
+    from microblog_app.models import User
+    User.objects.filter(pk=user.pk).update(token_generation=F('token_generation') + 1)
+    user.token_generation = User.objects.filter(pk=user.pk).values_list('token_generation', flat=True)[0]
+    forget_generation(user.pk)
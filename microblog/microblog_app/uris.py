@@ -0,0 +1,79 @@
+"""
+Resource URIs built from templates reversed once per process, instead of calling
+reverse() for every object and related field of every bundle.
+
+A template is the URI reversed with a placeholder pk, in which the placeholder is then
+replaced by the pk of each object with plain string formatting.
+"""
+import re
+from django.core.urlresolvers import get_script_prefix, NoReverseMatch
+from django.utils.http import urlquote
+from tastypie.bundle import Bundle
+
+# Matches the pk group of the tastypie URLs, \w[\w/-]*
+PK_PLACEHOLDER = 'PkPlaceholder0'
+
+_templates = {}
+_patterns = {}
+
+
+def cached_reverse(resource, url_name, **kwargs):
+    """
+    Returns the URI of the resource's url_name URL for kwargs. If there's a pk kwarg it's
+    filled in a template cached for the other kwargs, otherwise the whole URI is cached.
+    """
+    pk = kwargs.pop('pk', None)
+    if resource._meta.api_name is not None:
+        kwargs['api_name'] = resource._meta.api_name
+    key = (get_script_prefix(), resource._meta.urlconf_namespace, url_name, tuple(sorted(kwargs.items())), 'pk' if pk is not None else None)
+    template = _templates.get(key)
+    if template is None:
+        if pk is None:
+            template = resource._build_reverse_url(url_name, kwargs=kwargs)
+        else:
+            kwargs['pk'] = PK_PLACEHOLDER
+            uri = resource._build_reverse_url(url_name, kwargs=kwargs)
+            template = uri.replace('%', '%%').replace(PK_PLACEHOLDER, '%s')
+        _templates[key] = template
+    if pk is None:
+        return template
+    return template % (pk if isinstance(pk, (int, long)) else urlquote(pk))
+
+
+def parse_pk(resource, uri):
+    """
+    Returns the pk in the detail URI of the resource, or None if uri isn't one. It's matched
+    with a pattern compiled from the cached template, instead of resolving the whole URI.
+    """
+    key = (get_script_prefix(), resource._meta.urlconf_namespace, resource._meta.api_name, resource._meta.resource_name)
+    pattern = _patterns.get(key)
+    if pattern is None:
+        try:
+            template = cached_reverse(resource, 'api_dispatch_detail', resource_name=resource._meta.resource_name, pk=PK_PLACEHOLDER)
+        except NoReverseMatch:
+            return None
+        prefix, suffix = template.split(PK_PLACEHOLDER)
+        pattern = _patterns[key] = re.compile(r'^%s(?P<pk>\w[\w/-]*)%s$' % (re.escape(prefix), re.escape(suffix)))
+    match = pattern.match(uri)
+    return match.group('pk') if match else None
+
+
+class CachedUriMixin(object):
+    """
+    Builds the resource URIs of a ModelResource with cached_reverse.
+    """
+
+    def get_resource_uri(self, bundle_or_obj):
+        obj = bundle_or_obj.obj if isinstance(bundle_or_obj, Bundle) else bundle_or_obj
+        return self.get_resource_uri_for_pk(obj.pk)
+
+    def get_resource_uri_for_pk(self, pk):
+        if pk is None:
+            raise NoReverseMatch("Can't build the URI of an object without pk.")
+        return cached_reverse(self, 'api_dispatch_detail', resource_name=self._meta.resource_name, pk=pk)
+
+    def get_resource_list_uri(self):
+        try:
+            return cached_reverse(self, 'api_dispatch_list', resource_name=self._meta.resource_name)
+        except NoReverseMatch:
+            return None
@@ -0,0 +1,70 @@
+#! /usr/local/bin/python
+"""
+Compares the JSON encoding throughput of tastypie's Serializer and
+microblog_app.serializers.FastJSONSerializer on feed pages.
+
+Pages are built like the ones dispatch_feed returns: post bundles with the full bundle
+of their user, a few users posting every page. No database is needed.
+
+Usage (run from the repository root):
+    python utils/bench-serializer.py [page size] [seconds]
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'microblog'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'microblog.settings')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from django.utils import timezone
+from tastypie.bundle import Bundle
+from tastypie.serializers import Serializer
+from microblog_app.serializers import FastJSONSerializer, get_json_module, is_accelerated
+
+
+def feed_page(size):
+    now = timezone.now()
+    users = []
+    for i in range(1, 6):
+        users.append(Bundle(data={
+            'id': i, 'username': 'user%i' % i, 'first_name': 'First', 'last_name': 'Last',
+            'email': 'user%i@example.com' % i, 'avatar_url': '', 'followers_count': 10 * i,
+            'following_count': i, 'posts_count': 100 * i, 'followed_by_current_user': i % 2 == 0,
+            'resource_uri': '/api/v1/user/%i/' % i,
+        }))
+    posts = []
+    for i in range(1, size + 1):
+        date = now - datetime.timedelta(minutes=i)
+        posts.append(Bundle(data={
+            'id': i, 'text': u'post number %i with some text \u2603' % i, 'user': users[i % 5],
+            'in_reply_to': None, 'created_date': date, 'modified_date': date,
+            'likes_count': i % 7, 'shares_count': i % 3, 'replies_count': 0,
+            'liked_by_current_user': False, 'shared_by_current_user': False,
+            'resource_uri': '/api/v1/post/%i/' % i,
+        }))
+    return {'meta': {'limit': size, 'offset': 0, 'total_count': 1000, 'next': None, 'previous': None}, 'objects': posts}
+
+
+def bench(serializer, page, seconds):
+    pages = 0
+    size = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        size = len(serializer.to_json(page))
+        pages += 1
+    elapsed = time.time() - start
+    return pages / elapsed, size
+
+
+if __name__ == '__main__':
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    page = feed_page(page_size)
+    module = get_json_module()
+    print 'Encoder: %s (%s)' % (module.__name__, 'C accelerated' if is_accelerated(module) else 'pure Python')
+    print 'Feed pages of %i posts' % page_size
+    for name, serializer in (('tastypie', Serializer()), ('fast', FastJSONSerializer())):
+        rate, size = bench(serializer, page, seconds)
+        print '%-10s %8.1f pages/s %8.2f MB/s %7i bytes/page' % (name, rate, rate * size / 1024.0 / 1024, size)
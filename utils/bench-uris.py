@@ -0,0 +1,59 @@
+#! /usr/local/bin/python
+"""
+Compares the CPU time of building resource URIs with reverse(), as tastypie does, and
+with the templates cached by microblog_app.uris.
+
+For every 1,000 posts it builds the URI of the post and of its related user, like a feed
+page does, and prints the CPU time taken by each method.
+
+Usage (run from the repository root):
+    python utils/bench-uris.py [rounds]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'microblog'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'microblog.settings')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from tastypie.resources import ModelResource
+from microblog.urls import v1_api
+from microblog_app.models import Post, User
+
+OBJECTS = 1000
+
+
+def bench(build, rounds):
+    post_resource = v1_api.canonical_resource_for('post')
+    user_resource = v1_api.canonical_resource_for('user')
+    users = [User(pk=i) for i in range(1, 101)]
+    posts = [Post(pk=i, user=users[i % 100]) for i in range(1, OBJECTS + 1)]
+    best = None
+    for i in range(rounds):
+        start = time.clock()
+        for post in posts:
+            build(post_resource, user_resource, post)
+        elapsed = time.clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def with_reverse(post_resource, user_resource, post):
+    ModelResource.get_resource_uri(post_resource, post)
+    ModelResource.get_resource_uri(user_resource, post.user)
+
+
+def with_templates(post_resource, user_resource, post):
+    post_resource.get_resource_uri(post)
+    user_resource.get_resource_uri_for_pk(post.user_id)
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    reverse_time = bench(with_reverse, rounds)
+    template_time = bench(with_templates, rounds)
+    print 'CPU ms per %i objects (2 URIs each), best of %i rounds' % (OBJECTS, rounds)
+    print 'reverse():  %8.2f' % (reverse_time * 1000)
+    print 'templates:  %8.2f' % (template_time * 1000)
+    print 'saved:      %8.2f (%.1fx faster)' % ((reverse_time - template_time) * 1000, reverse_time / template_time)
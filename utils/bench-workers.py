@@ -0,0 +1,83 @@
+#! /usr/local/bin/python
+"""
+Compares throughput per MB of RAM of sync and gevent gunicorn workers.
+
+For each worker class it starts gunicorn with microblog/gunicorn_conf.py, fires
+requests at the given API path from a number of concurrent client threads, and reads
+the resident memory of the master and its workers from /proc.
+
+Usage (run from the repository root, with DATABASE_URL set):
+    python utils/bench-workers.py /api/v1/feed/?api_user=user1&api_key=... [seconds] [clients]
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+PORT = 8765
+WORKER_CLASSES = ['sync', 'gevent']
+
+
+def rss_mb(pid):
+    """
+    Resident memory of a process and its children, in MB.
+    """
+    pids = [pid] + [int(p) for p in subprocess.check_output(['pgrep', '-P', str(pid)]).split()]
+    total_kb = 0
+    for p in pids:
+        with open('/proc/%i/status' % p) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    total_kb += int(line.split()[1])
+    return total_kb / 1024.0
+
+
+def load(url, seconds, clients):
+    done = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def client():
+        while time.time() < deadline:
+            urllib2.urlopen(url).read()
+            with lock:
+                done[0] += 1
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return done[0] / float(seconds)
+
+
+def run(worker_class, path, seconds, clients):
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class)
+    server = subprocess.Popen(
+        ['python', 'microblog/manage.py', 'run_gunicorn', '-c', 'microblog/gunicorn_conf.py', '-b', '127.0.0.1:%i' % PORT],
+        env=env)
+    try:
+        time.sleep(3)
+        url = 'http://127.0.0.1:%i%s' % (PORT, path)
+        throughput = load(url, seconds, clients)
+        memory = rss_mb(server.pid)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return throughput, memory
+
+
+def main():
+    path = sys.argv[1]
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    for worker_class in WORKER_CLASSES:
+        throughput, memory = run(worker_class, path, seconds, clients)
+        print '%-7s %8.1f req/s %8.1f MB %8.3f req/s per MB' % (worker_class, throughput, memory, throughput / memory)
+
+
+if __name__ == '__main__':
+    main()